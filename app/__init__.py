@@ -1,20 +1,36 @@
+import sys
 from flask import Flask
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
-from elasticsearch import Elasticsearch
 from config import config
 from app.my_extensions.file_logger import FileLogger
+from app.my_extensions.es_client import ResilientElasticsearch
+from app.my_extensions.assets import Assets
+from app.my_extensions.compress import Compress
+from app.my_extensions.avatars import Avatars
+from app.my_extensions.metrics import Metrics
+from app.my_extensions.jobs import JobQueue
+from app.my_extensions.profiler import Profiler
+from app.my_extensions.ratelimit import RateLimiter
+from app.my_extensions.template_cache import TemplateCache
+from app.backfill import backfill_command
 
 
 login_manager = LoginManager()
 db = SQLAlchemy()
-migrate = Migrate()
 file_logger = FileLogger()
 bootstrap = Bootstrap()
 moment = Moment()
+metrics = Metrics()
+assets = Assets()
+compress = Compress()
+avatars = Avatars()
+jobs = JobQueue()
+profiler = Profiler()
+ratelimiter = RateLimiter()
+template_cache = TemplateCache()
 
 # 工厂函数，根据config生成app
 def create_app(config_name):
@@ -26,14 +42,42 @@ def create_app(config_name):
 
     # extensions init
     db.init_app(app)
-    migrate.init_app(app, db)
+    # Flask-Migrate会import alembic(100多毫秒)，但只有flask db命令才用到。
+    # flask db是Flask-Migrate通过entry point注册的命令，Flask在加载app之前就import了flask_migrate，
+    # 所以只在flask_migrate已经被import(或者配置了EAGER_MIGRATE)时才初始化，web worker启动时不用付这个代价。
+    if app.config['EAGER_MIGRATE'] or 'flask_migrate' in sys.modules:
+        from flask_migrate import Migrate
+        Migrate(app, db)
     login_manager.init_app(app)
     login_manager.login_view = 'main.login'
     file_logger.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    ratelimiter.init_app(app)
+    assets.init_app(app)
+    compress.init_app(app)
+    avatars.init_app(app)
+    template_cache.init_app(app)
+    jobs.init_app(app)
+    # flask backfill，分批回填数据(见backfill.py)
+    app.cli.add_command(backfill_command)
     # 没有extension wraps elastisearch, 所以向app增加一个实例。全文搜索功能都写在search.py中，那个是抽象模块，可以换成其他引擎。
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
+    # 客户端在第一次调用时才创建，带超时、重试和熔断，见my_extensions/es_client.py
+    app.elasticsearch = ResilientElasticsearch(
+        app.config['ELASTICSEARCH_URL'],
+        maxsize=app.config['ELASTICSEARCH_MAXSIZE'],
+        timeout=app.config['ELASTICSEARCH_TIMEOUT'],
+        max_retries=app.config['ELASTICSEARCH_MAX_RETRIES'],
+        operation_timeouts={'search': app.config['ELASTICSEARCH_SEARCH_TIMEOUT']},
+        failure_threshold=app.config['ELASTICSEARCH_BREAKER_THRESHOLD'],
+        reset_timeout=app.config['ELASTICSEARCH_BREAKER_RESET']) \
+        if app.config['ELASTICSEARCH_URL'] else None
+    from app.search_cache import query_cache
+    query_cache.configure(app.config)
+    from app.streaming import stream_flush
+    app.add_template_global(stream_flush)
 
 
     # 注册蓝图（Flask模块化）
@@ -0,0 +1,54 @@
+import time
+
+from sqlalchemy import func, select
+
+'''
+    冷热分离：把旧帖子从post表搬到post_archive表(flask archive posts)。
+
+    首页(followed_posts)、explore、个人主页的前几页都只看最近的帖子，post表和它的索引小了，这些查询就快了；
+    很旧的帖子只有个人主页翻到很后面、搜索结果、Post.get_including_archived()会用到，它们会接着查归档表(见models.py)。
+
+    @ 分批：每批按id顺序取batch_size个要归档的帖子，INSERT ... SELECT到归档表再DELETE，一批一个事务，
+      写锁只持有一小会儿，网站不用停。批和批之间可以sleep，给其他写入让路。
+      按id的范围(而不是IN列表)搬，不受SQLite参数个数(999)的限制。
+
+    @ 不会归档id最大的那个帖子: SQLite的INTEGER PRIMARY KEY是max(id) + 1，post表空了新帖子的id会从头开始，和归档表重复。
+
+    @ Elasticsearch里的索引不动(搬的时候用的是Core，不会触发SearchableMixin的事件)，所以旧帖子还能搜到。
+'''
+
+
+def archive_posts(engine, cutoff, batch_size=1000, sleep=0, progress=None):
+    '''
+        把timestamp早于cutoff的帖子搬到归档表
+        :param progress: 每搬完一批调用一次progress(archived)
+        :return: 搬了多少个
+    '''
+    from app.models import Post, PostArchive
+    post, archive = Post.__table__, PostArchive.__table__
+    columns = [column.name for column in archive.columns]
+
+    archived = 0
+    with engine.connect() as conn:
+        max_id = conn.execute(select([func.max(post.c.id)])).scalar()
+        if max_id is None:
+            return 0
+        condition = (post.c.timestamp < cutoff) & (post.c.id < max_id)
+        last_id = 0
+        while True:
+            ids = [id for id, in conn.execute(select([post.c.id]).where(condition).where(post.c.id > last_id)
+                                              .order_by(post.c.id).limit(batch_size))]
+            if not ids:
+                break
+            batch = condition & post.c.id.between(ids[0], ids[-1])
+            with conn.begin():
+                conn.execute(archive.insert().from_select(
+                    columns, select([post.c[name] for name in columns]).where(batch)))
+                conn.execute(post.delete().where(batch))
+            archived += len(ids)
+            last_id = ids[-1]
+            if progress:
+                progress(archived)
+            if sleep:
+                time.sleep(sleep)
+    return archived
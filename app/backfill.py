@@ -0,0 +1,173 @@
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+'''
+    大表的数据回填(backfill)：迁移脚本里只做DDL(op.add_column等)，填数据放到 flask backfill <name> 里分批做。
+    一条UPDATE把整张表改完的话，SQLite整个过程都锁着库，PostgreSQL的从库也会卡住。
+
+    @ 定义：在迁移脚本里用@backfill注册一个函数，它负责更新主键在[start, stop)之间的行，返回更新的行数:
+
+        from app.backfill import backfill
+
+        @backfill('user_post_count', 'user')
+        def fill_post_count(conn, start, stop):
+            return conn.execute(sa.text(
+                'UPDATE user SET post_count = (SELECT COUNT(*) FROM post WHERE post.user_id = user.id) '
+                'WHERE id >= :start AND id < :stop'), start=start, stop=stop).rowcount
+
+      flask backfill 会加载migrations/versions/下的所有迁移脚本，所以不需要在别处import。
+      回填开始之后新写入的行应该已经由新代码填好了，所以只走到开始时的max(主键)为止。
+
+    @ 分批：按主键范围走，每批一个事务，批和批之间可以sleep或者限制每秒行数，和线上流量一起跑。
+      主键有大段空洞时(例如归档之后)，每批开始前先找下一个存在的主键，跳过空的范围。
+
+    @ 断点续跑：进度(最后处理到的主键)记在backfill_checkpoint表，和那一批的UPDATE在同一个事务里提交，
+      中断后再运行同一个命令从断点接着走。--restart从头开始。
+'''
+
+_backfills = {}
+
+
+class Backfill:
+    def __init__(self, name, table, fn):
+        self.name = name
+        self.table = table
+        self.fn = fn
+        self.description = (fn.__doc__ or '').strip()
+
+
+def backfill(name, table):
+    '''注册一个backfill，table是表名'''
+    def decorator(fn):
+        _backfills[name] = Backfill(name, table, fn)
+        return fn
+    return decorator
+
+
+def load_migration_backfills(directory):
+    '''import所有迁移脚本，让里面的@backfill生效'''
+    from alembic.script import ScriptDirectory
+    for revision in ScriptDirectory(directory).walk_revisions():
+        revision.module
+    return _backfills
+
+
+def run_backfill(engine, name, batch_size=1000, sleep=0, max_rate=None, restart=False, progress=None):
+    '''
+        :param max_rate: 每秒最多处理多少行(按主键范围算)，None表示不限制
+        :param progress: 每一批之后调用progress(checkpoint的dict, 当前速度rows/s, 预计剩余秒数)
+        :return: 这次运行更新的行数
+    '''
+    from sqlalchemy import MetaData, Table
+    from app.models import BackfillCheckpoint
+    job = _backfills[name]
+    checkpoints = BackfillCheckpoint.__table__
+
+    with engine.connect() as conn:
+        table = Table(job.table, MetaData(), autoload_with=conn)
+        pk, = table.primary_key.columns
+        checkpoint = conn.execute(checkpoints.select().where(checkpoints.c.name == name)).first()
+        if checkpoint is None or restart:
+            max_id = conn.execute(select([func.max(pk)])).scalar() or 0
+            state = {'name': name, 'last_id': None, 'max_id': max_id, 'rows_done': 0,
+                     'started_at': datetime.utcnow(), 'updated_at': datetime.utcnow(), 'finished_at': None}
+            with conn.begin():
+                conn.execute(checkpoints.delete().where(checkpoints.c.name == name))
+                conn.execute(checkpoints.insert(), state)
+        else:
+            state = dict(checkpoint)
+        if state['finished_at'] is not None:
+            return 0
+
+        updated = 0
+        started = time.monotonic()
+        first_id = None
+        start = state['last_id'] + 1 if state['last_id'] is not None else None
+        while True:
+            # 跳过主键的空洞
+            query = select([func.min(pk)])
+            if start is not None:
+                query = query.where(pk >= start)
+            start = conn.execute(query).scalar()
+            if start is None or start > state['max_id']:
+                break
+            if first_id is None:
+                first_id = start
+            stop = min(start + batch_size, state['max_id'] + 1)
+            batch_started = time.monotonic()
+            with conn.begin():
+                rows = job.fn(conn, start, stop) or 0
+                state.update(last_id=stop - 1, rows_done=state['rows_done'] + rows, updated_at=datetime.utcnow())
+                conn.execute(checkpoints.update().where(checkpoints.c.name == name).values(
+                    last_id=state['last_id'], rows_done=state['rows_done'], updated_at=state['updated_at']))
+            updated += rows
+
+            elapsed = time.monotonic() - started
+            rate = updated / elapsed if elapsed else 0
+            # ETA按主键范围估计: 这次运行走过的范围 / 用时
+            ids_per_second = (stop - first_id) / elapsed if elapsed else 0
+            eta = (state['max_id'] + 1 - stop) / ids_per_second if ids_per_second else 0
+            if progress:
+                progress(state, rate, eta)
+
+            pause = sleep
+            if max_rate:
+                pause = max(pause, (stop - start) / max_rate - (time.monotonic() - batch_started))
+            if pause > 0:
+                time.sleep(pause)
+            start = stop
+
+        with conn.begin():
+            conn.execute(checkpoints.update().where(checkpoints.c.name == name).values(
+                finished_at=datetime.utcnow()))
+    return updated
+
+
+@click.command('backfill')
+@click.argument('name', required=False)
+@click.option('--batch-size', default=1000, help='每批(每个事务)的主键范围')
+@click.option('--sleep', default=0.0, help='每批之间sleep多少秒')
+@click.option('--max-rate', default=None, type=int, help='每秒最多处理多少行')
+@click.option('--restart', is_flag=True, help='忽略断点，从头开始')
+@click.option('-d', '--directory', default=None, help='迁移脚本目录，默认和flask db的一样')
+@with_appcontext
+def backfill_command(name, batch_size, sleep, max_rate, restart, directory):
+    '''分批回填数据(迁移脚本里用@backfill注册)，不带参数时列出所有backfill和进度'''
+    from app import db
+    from app.models import BackfillCheckpoint
+    if directory is None:
+        migrate = current_app.extensions.get('migrate')
+        directory = migrate.directory if migrate else 'migrations'
+    backfills = load_migration_backfills(directory)
+
+    if name is None:
+        for job in backfills.values():
+            checkpoint = BackfillCheckpoint.query.get(job.name)
+            if checkpoint is None:
+                status = 'not started'
+            elif checkpoint.finished_at:
+                status = 'finished at {}, {} rows'.format(checkpoint.finished_at, checkpoint.rows_done)
+            else:
+                status = 'at id {} of {}, {} rows'.format(checkpoint.last_id, checkpoint.max_id, checkpoint.rows_done)
+            click.echo('{:<30} {:<12} {}  {}'.format(job.name, job.table, status, job.description))
+        return
+    if name not in backfills:
+        raise click.ClickException('unknown backfill {}'.format(name))
+
+    state = {'last': 0.0}
+
+    def report(checkpoint, rate, eta):
+        now = time.monotonic()
+        if now - state['last'] >= 5 or checkpoint['last_id'] >= checkpoint['max_id']:
+            state['last'] = now
+            click.echo('{}: id {}/{}, {} rows, {:.0f} rows/s, eta {:.0f}s'.format(
+                name, checkpoint['last_id'], checkpoint['max_id'], checkpoint['rows_done'], rate, eta))
+
+    updated = run_backfill(db.engine, name, batch_size=batch_size, sleep=sleep, max_rate=max_rate,
+                           restart=restart, progress=report)
+    click.echo('{}: done, {} rows updated in this run'.format(name, updated))
@@ -0,0 +1,81 @@
+import time
+from datetime import datetime
+
+from sqlalchemy import Text, cast, func, literal, select
+
+'''
+    群发私信给所有粉丝(/broadcast)，在后台任务里运行(tasks.broadcast_message)。
+    没开JOBS_ENABLED时在web进程的后台线程里运行，请求不等它发完(见my_extensions/jobs.py)。
+
+    send_message一条私信一个ORM对象，再对收件人重新count一次未读数、add_notification一次；
+    粉丝有5万个的话就是5万次这样的操作。这里换成按批的集合操作:
+
+    @ 按follower_id的顺序每次取chunk_size个粉丝(keyset分页，followers表上有(followed_id, follower_id)的索引)
+    @ 这一批的Message用Core的executemany一次插入
+    @ 这一批收件人的未读数提醒: 一条DELETE删掉旧的，一条INSERT ... SELECT按(recipient_id, timestamp)索引算出新的未读数，
+      和导航栏轮询的/notifications格式一样
+    @ 一批一个事务，进度(发到了哪个粉丝)和这一批的私信一起提交，后台任务失败重试时从断点接着发，不会重复发
+'''
+
+
+def send_broadcast(engine, broadcast_id, chunk_size=1000, sleep=0, progress=None):
+    '''
+        :param progress: 每发完一批调用progress(recipients_done, recipients_total, 当前速度messages/s)
+        :return: 这次运行发出去的私信数
+    '''
+    from app.models import Broadcast, Message, Notification, User, followers
+    broadcasts, messages, notifications, users = (
+        Broadcast.__table__, Message.__table__, Notification.__table__, User.__table__)
+
+    sent = 0
+    with engine.connect() as conn:
+        broadcast = conn.execute(broadcasts.select().where(broadcasts.c.id == broadcast_id)).first()
+        if broadcast is None or broadcast.finished_at is not None:
+            return 0
+        if broadcast.started_at is None:
+            with conn.begin():
+                conn.execute(broadcasts.update().where(broadcasts.c.id == broadcast_id).values(
+                    started_at=datetime.utcnow()))
+        sender_id, body, total = broadcast.sender_id, broadcast.body, broadcast.recipients_total
+        done, last_id = broadcast.recipients_done or 0, broadcast.last_follower_id or 0
+        of_sender = followers.c.followed_id == sender_id
+
+        started = time.monotonic()
+        while True:
+            ids = [id for id, in conn.execute(
+                select([followers.c.follower_id]).distinct().where(of_sender)
+                .where(followers.c.follower_id > last_id).order_by(followers.c.follower_id).limit(chunk_size))]
+            if not ids:
+                break
+            # 按范围(而不是IN列表)选这一批收件人，不受SQLite参数个数的限制
+            recipients = select([followers.c.follower_id]).where(of_sender).where(
+                followers.c.follower_id.between(ids[0], ids[-1]))
+            unread = select([func.count(messages.c.id)]).where(messages.c.recipient_id == users.c.id).where(
+                messages.c.timestamp > func.coalesce(users.c.last_message_read_time, datetime(1900, 1, 1))
+            ).as_scalar()
+            now = datetime.utcnow()
+            with conn.begin():
+                conn.execute(messages.insert(), [
+                    {'sender_id': sender_id, 'recipient_id': id, 'body': body, 'timestamp': now} for id in ids
+                ])
+                conn.execute(notifications.delete().where(notifications.c.name == 'unread_message_count')
+                             .where(notifications.c.user_id.in_(recipients)))
+                conn.execute(notifications.insert().from_select(
+                    ['name', 'user_id', 'timestamp', 'payload_json'],
+                    select([literal('unread_message_count'), users.c.id, literal(time.time()), cast(unread, Text)])
+                    .where(users.c.id.in_(recipients))))
+                done, last_id = done + len(ids), ids[-1]
+                conn.execute(broadcasts.update().where(broadcasts.c.id == broadcast_id).values(
+                    recipients_done=done, last_follower_id=last_id, updated_at=datetime.utcnow()))
+            sent += len(ids)
+
+            if progress:
+                elapsed = time.monotonic() - started
+                progress(done, total, sent / elapsed if elapsed else 0)
+            if sleep:
+                time.sleep(sleep)
+
+        with conn.begin():
+            conn.execute(broadcasts.update().where(broadcasts.c.id == broadcast_id).values(
+                finished_at=datetime.utcnow(), updated_at=datetime.utcnow()))
+    return sent
@@ -0,0 +1,362 @@
+import threading
+from array import array
+from bisect import bisect_left
+from time import monotonic
+
+from app import metrics
+
+'''
+    进程内的关注关系图(SOCIAL_GRAPH_ENABLED=True时)，is_following、关注数/粉丝数不用再查followers表。
+
+    @ 数据结构：CSR(compressed sparse row)邻接表，两个方向各一份
+        offsets[user_id] ~ offsets[user_id + 1] 是这个用户在neighbors里的区间，区间里的id是排好序的，
+        所以"a是否关注了b"就是在a的区间里bisect找b，O(log 出度)。
+        offsets是array('q')(每个用户8字节)，neighbors是array('i')(每条边4字节)，两个方向加起来每条边8字节，
+        比Python的set/dict小一个数量级(见benchmarks/graph.py)。
+
+    @ 更新：CSR本身是只读的，启动后的关注/取关记在overlay里(新增的边、删除的边)，查询时base + overlay。
+        overlay超过SOCIAL_GRAPH_OVERLAY_LIMIT条时在后台线程里compact()重建CSR: 在锁里拷贝一份overlay，
+        不拿锁重建(O(最大用户id)，几百万用户要好几秒)，重建期间的查询还是用旧的CSR + overlay，
+        重建期间新的变更另外记一份，换上新CSR时在它上面再应用一次。
+
+    @ 线程：查询也拿锁(只拿一下，拷贝overlay里这个用户的集合)，不会在别的线程改集合的时候迭代它。
+        catch up查数据库的时候不拿锁，同时只有一个线程在catch up。
+
+    @ 多个worker：User.follow/unfollow除了改followers表，还会写一条FollowChange(自增id就是变更序号)。
+        每个进程记下自己看到的最后一个序号，最多每SOCIAL_GRAPH_CATCHUP_INTERVAL秒查一次新的变更(catch up)。
+        本进程自己的变更在commit后马上应用(不用等catch up)，apply是幂等的，catch up时再应用一次也没关系。
+
+    @ 加载：第一个请求之前在后台线程里从followers表按(follower_id, followed_id)顺序批量读一遍，
+        粉丝方向的CSR由它转置得到。加载完之前User的方法还是查数据库。
+'''
+
+GRAPH_EDGES = metrics.gauge('social_graph_edges', '进程内关注关系图的边数(不含overlay)')
+GRAPH_OVERLAY = metrics.gauge('social_graph_overlay_size', '关注关系图overlay里的变更数')
+GRAPH_BYTES = metrics.gauge('social_graph_bytes', '关注关系图CSR数组占用的字节数')
+
+
+class CSR:
+    '''一个方向的邻接表'''
+
+    def __init__(self, offsets=None, neighbors=None):
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.neighbors = neighbors if neighbors is not None else array('i')
+
+    @classmethod
+    def from_sorted(cls, pairs, max_id):
+        '''pairs: 按(a, b)排好序的可迭代对象，重复的边只保留一条'''
+        offsets = array('q', bytes(8 * (max_id + 2)))
+        neighbors = array('i')
+        append = neighbors.append
+        last = None
+        for pair in pairs:
+            if pair == last:
+                continue
+            a, b = pair
+            if a + 1 >= len(offsets):
+                # max_id是加载前查的，加载期间新注册的用户id可能更大
+                offsets.frombytes(bytes(8 * (a + 2 - len(offsets))))
+            append(b)
+            offsets[a + 1] += 1
+            last = pair
+        total = 0
+        for i in range(len(offsets)):
+            total += offsets[i]
+            offsets[i] = total
+        return cls(offsets, neighbors)
+
+    def transpose(self, max_id):
+        '''反方向的CSR(计数排序，不用再按另一列排序查一次数据库)。按行顺序填，每一行自然是排好序的'''
+        max_id = max(max_id, len(self.offsets) - 2, max(self.neighbors, default=0))
+        offsets = array('q', bytes(8 * (max_id + 2)))
+        for b in self.neighbors:
+            offsets[b + 1] += 1
+        total = 0
+        for i in range(len(offsets)):
+            total += offsets[i]
+            offsets[i] = total
+        neighbors = array('i', bytes(4 * len(self.neighbors)))
+        cursor = array('q', offsets)
+        for a in range(len(self.offsets) - 1):
+            for i in range(self.offsets[a], self.offsets[a + 1]):
+                b = self.neighbors[i]
+                neighbors[cursor[b]] = a
+                cursor[b] += 1
+        return CSR(offsets, neighbors)
+
+    def _bounds(self, a):
+        if a + 1 >= len(self.offsets):
+            return 0, 0
+        return self.offsets[a], self.offsets[a + 1]
+
+    def contains(self, a, b):
+        lo, hi = self._bounds(a)
+        i = bisect_left(self.neighbors, b, lo, hi)
+        return i < hi and self.neighbors[i] == b
+
+    def row(self, a):
+        lo, hi = self._bounds(a)
+        return self.neighbors[lo:hi]
+
+    def degree(self, a):
+        lo, hi = self._bounds(a)
+        return hi - lo
+
+    @property
+    def nbytes(self):
+        return self.offsets.itemsize * len(self.offsets) + self.neighbors.itemsize * len(self.neighbors)
+
+
+class FollowGraph:
+    def __init__(self):
+        self.ready = False
+        self.last_seq = 0
+        self._out = CSR()      # follower -> followed
+        self._in = CSR()       # followed -> follower
+        self._reset_overlay()
+        self._last_catch_up = 0.0
+        self._lock = threading.RLock()
+        self._catch_up_lock = threading.Lock()
+        # compact期间的变更，None表示没有在compact
+        self._compaction_log = None
+
+    def _reset_overlay(self):
+        # 相对于CSR新增/删除的边，两个方向各建一个索引，方便按用户列出和计数
+        self._added_out, self._added_in = {}, {}
+        self._removed_out, self._removed_in = {}, {}
+        self._overlay_size = 0
+
+    def load(self, pairs, max_id, last_seq):
+        '''pairs按(follower, followed)排序'''
+        out_csr = CSR.from_sorted(pairs, max_id)
+        in_csr = out_csr.transpose(max_id)
+        with self._lock:
+            self._out, self._in = out_csr, in_csr
+            self._reset_overlay()
+            self.last_seq = last_seq
+            self.ready = True
+            self._compaction_log = None
+        self._update_metrics()
+
+    def apply(self, follower_id, followed_id, following):
+        '''应用一次关注(following=True)/取关，幂等'''
+        with self._lock:
+            if self._compaction_log is not None:
+                self._compaction_log.append((follower_id, followed_id, following))
+            in_base = self._out.contains(follower_id, followed_id)
+            if following:
+                self._discard(self._removed_out, self._removed_in, follower_id, followed_id)
+                if not in_base:
+                    self._add(self._added_out, self._added_in, follower_id, followed_id)
+            else:
+                self._discard(self._added_out, self._added_in, follower_id, followed_id)
+                if in_base:
+                    self._add(self._removed_out, self._removed_in, follower_id, followed_id)
+
+    def _add(self, out_index, in_index, a, b):
+        if b not in out_index.setdefault(a, set()):
+            out_index[a].add(b)
+            in_index.setdefault(b, set()).add(a)
+            self._overlay_size += 1
+
+    def _discard(self, out_index, in_index, a, b):
+        if b in out_index.get(a, ()):
+            out_index[a].discard(b)
+            in_index[b].discard(a)
+            self._overlay_size -= 1
+
+    def is_following(self, follower_id, followed_id):
+        with self._lock:
+            if followed_id in self._added_out.get(follower_id, ()):
+                return True
+            if followed_id in self._removed_out.get(follower_id, ()):
+                return False
+            return self._out.contains(follower_id, followed_id)
+
+    def followed_ids(self, user_id):
+        with self._lock:
+            csr, added, removed = self._out, set(self._added_out.get(user_id, ())), \
+                set(self._removed_out.get(user_id, ()))
+        return self._merged(csr.row(user_id), added, removed)
+
+    def follower_ids(self, user_id):
+        with self._lock:
+            csr, added, removed = self._in, set(self._added_in.get(user_id, ())), \
+                set(self._removed_in.get(user_id, ()))
+        return self._merged(csr.row(user_id), added, removed)
+
+    def followed_count(self, user_id):
+        with self._lock:
+            return self._out.degree(user_id) + len(self._added_out.get(user_id, ())) - \
+                len(self._removed_out.get(user_id, ()))
+
+    def follower_count(self, user_id):
+        with self._lock:
+            return self._in.degree(user_id) + len(self._added_in.get(user_id, ())) - \
+                len(self._removed_in.get(user_id, ()))
+
+    @staticmethod
+    def _merged(ids, added, removed):
+        if added or removed:
+            ids = sorted((set(ids) | added) - removed)
+        return list(ids)
+
+    @property
+    def compacting(self):
+        return self._compaction_log is not None
+
+    def compact(self):
+        '''
+            把overlay合并进CSR。逐个用户拷贝区间，没有变化的用户直接整段复制。
+            重建的时候不拿锁，查询和apply照常进行。已经有一个compact在进行时返回False
+        '''
+        with self._lock:
+            if self._compaction_log is not None:
+                return False
+            self._compaction_log = []
+            out_csr, in_csr = self._out, self._in
+            added_out = {a: set(b) for a, b in self._added_out.items()}
+            removed_out = {a: set(b) for a, b in self._removed_out.items()}
+            added_in = {a: set(b) for a, b in self._added_in.items()}
+            removed_in = {a: set(b) for a, b in self._removed_in.items()}
+        try:
+            max_id = max([len(out_csr.offsets) - 2] + list(added_out) + list(added_in))
+            new_out = self._rebuilt(out_csr, added_out, removed_out, max_id)
+            new_in = self._rebuilt(in_csr, added_in, removed_in, max_id)
+        except BaseException:
+            with self._lock:
+                self._compaction_log = None
+            raise
+        with self._lock:
+            # 重建期间load()过的话，新的CSR已经过时了
+            if self._compaction_log is None or self._out is not out_csr:
+                self._compaction_log = None
+                return False
+            log, self._compaction_log = self._compaction_log, None
+            self._out, self._in = new_out, new_in
+            self._reset_overlay()
+            # 重建期间的变更是相对旧CSR的，apply是幂等的，在新CSR上再应用一次
+            for follower_id, followed_id, following in log:
+                self.apply(follower_id, followed_id, following)
+        self._update_metrics()
+        return True
+
+    def compact_in_background(self):
+        '''在后台线程里compact，已经在compact时什么都不做。返回线程或None'''
+        if self.compacting:
+            return None
+        thread = threading.Thread(target=self.compact, name='social-graph-compact', daemon=True)
+        thread.start()
+        return thread
+
+    def _rebuilt(self, csr, added, removed, max_id):
+        offsets = array('q', [0])
+        neighbors = array('i')
+        for user_id in range(max_id + 1):
+            if user_id in added or user_id in removed:
+                neighbors.extend(self._merged(csr.row(user_id), added.get(user_id, set()),
+                                              removed.get(user_id, set())))
+            else:
+                neighbors.extend(csr.row(user_id))
+            offsets.append(len(neighbors))
+        return CSR(offsets, neighbors)
+
+    @property
+    def overlay_size(self):
+        return self._overlay_size
+
+    @property
+    def nbytes(self):
+        return self._out.nbytes + self._in.nbytes
+
+    def _update_metrics(self):
+        GRAPH_EDGES.set(len(self._out.neighbors))
+        GRAPH_OVERLAY.set(self._overlay_size)
+        GRAPH_BYTES.set(self.nbytes)
+
+    def catch_up(self, interval, overlay_limit, batch_size=10000):
+        '''最多每interval秒查一次别的进程写的FollowChange。overlay太大时在后台compact'''
+        now = monotonic()
+        if not self.ready or now - self._last_catch_up < interval:
+            return
+        # 别的线程正在catch up就不等了
+        if not self._catch_up_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_catch_up = now
+            from app.models import FollowChange
+            while True:
+                changes = FollowChange.query.with_entities(
+                    FollowChange.id, FollowChange.follower_id, FollowChange.followed_id, FollowChange.following
+                ).filter(FollowChange.id > self.last_seq).order_by(FollowChange.id).limit(batch_size).all()
+                with self._lock:
+                    for seq, follower_id, followed_id, following in changes:
+                        self.apply(follower_id, followed_id, following)
+                        self.last_seq = max(self.last_seq, seq)
+                if len(changes) < batch_size:
+                    break
+        finally:
+            self._catch_up_lock.release()
+        if self._overlay_size > overlay_limit:
+            self.compact_in_background()
+        self._update_metrics()
+
+
+social_graph = FollowGraph()
+
+
+def load_social_graph(app, batch_size=50000):
+    from app import db
+    from app.models import User, FollowChange, followers
+    with app.app_context():
+        try:
+            # 先记下变更序号再加载，加载期间的变更之后catch up时会再应用一次
+            last_seq = db.session.query(db.func.max(FollowChange.id)).scalar() or 0
+            max_id = db.session.query(db.func.max(User.id)).scalar() or 0
+            pairs = db.session.query(followers.c.follower_id, followers.c.followed_id).order_by(
+                followers.c.follower_id, followers.c.followed_id).yield_per(batch_size)
+            social_graph.load((tuple(p) for p in pairs), max_id, last_seq)
+        except Exception:
+            app.logger.exception('loading social graph failed')
+        finally:
+            db.session.remove()
+
+
+def changes_pruned(app):
+    '''加载之后的FollowChange是不是已经被flask graph prune删掉了一部分(这时catch up追不上，要重新加载)'''
+    from app import db
+    from app.models import FollowChange
+    with app.app_context():
+        try:
+            first = db.session.query(db.func.min(FollowChange.id)).scalar()
+        finally:
+            db.session.remove()
+    return first is not None and first > social_graph.last_seq + 1
+
+
+def start_loading(app):
+    thread = threading.Thread(target=load_social_graph, args=(app,), name='social-graph-load', daemon=True)
+    thread.start()
+    return thread
+
+
+def collect_changes(session, flush_context=None, instances=None):
+    '''
+        session的before_flush事件，把这次flush的新FollowChange记在session._graph_changes里，
+        commit之后apply_changes，rollback就丢掉(commit之后对象会过期，再读属性要查数据库，所以在这里就记下值)。
+        同一个事务可能flush好几次(例如User.follow里的delete()会autoflush)，所以是累加的
+    '''
+    changes = [(obj.follower_id, obj.followed_id, obj.following)
+               for obj in session.new if getattr(obj, '__tablename__', None) == 'follow_change']
+    if changes:
+        if getattr(session, '_graph_changes', None) is None:
+            session._graph_changes = []
+        session._graph_changes.extend(changes)
+
+
+def apply_changes(changes):
+    '''在after_commit里调用，本进程的变更马上生效'''
+    if not social_graph.ready:
+        return
+    for follower_id, followed_id, following in changes:
+        social_graph.apply(follower_id, followed_id, following)
@@ -1,15 +1,25 @@
 from app.main import main
 from app import db
-from flask import render_template, flash, redirect, url_for, request, current_app, g, jsonify
+from flask import render_template, flash, redirect, url_for, request, current_app, g, jsonify, session
 from flask_login import login_user, logout_user, current_user, login_required
 from .forms import LoginForm, RegistrationForm, EditProfileForm, PostForm, SearchForm, MessageForm
-from app.models import User, Post, Message, Notification
+from app.models import User, Post, Message, Notification, Broadcast
+from app.suggest import suggest_index, start_building
+from app import graph
+from app.tasks import update_unread_message_count, broadcast_message
+from app.streaming import render_page, deferred_page
 from werkzeug.urls import url_parse
 from datetime import datetime
 
 
+# 这些endpoint不更新last_seen(也就不用加载current_user)，整个请求不碰数据库
+NO_DATABASE_ENDPOINTS = {'main.suggest'}
+
+
 @main.before_request
 def before_request():
+    if request.endpoint in NO_DATABASE_ENDPOINTS:
+        return
     if current_user.is_authenticated:
         current_user.last_seen = datetime.utcnow()
         # 不用db.session.add的原因是每次current_user都会调用@login_manager.user_loader(在models.py)里，里面有query.
@@ -21,6 +31,20 @@ def before_request():
 
 
 
+@main.before_app_first_request
+def build_suggest_index():
+    '''在后台加载自动补全的前缀索引'''
+    if current_app.config['SUGGEST_ENABLED']:
+        start_building(current_app._get_current_object())
+
+
+@main.before_app_first_request
+def load_social_graph():
+    '''在后台加载关注关系图，加载完之前is_following等还是查数据库。flask serve已经在master里加载过了就不用了'''
+    if current_app.config['SOCIAL_GRAPH_ENABLED'] and not graph.social_graph.ready:
+        graph.start_loading(current_app._get_current_object())
+
+
 @main.route('/', methods=['GET', 'POST'])
 @main.route('/index/', methods=['GET', 'POST'])
 @login_required
@@ -39,12 +63,13 @@ def index():
 
     # 分页功能由Flask-SQLAlchemy提供的paginate方法完成, paginate返回的是Pagination对象,里面有has_next, has_prev, next_num, prev_num
     page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    # 查询推迟到模板渲染到post列表时才执行，流式渲染时<head>和导航栏可以先发出去(见app/streaming.py)
     # url_for, if the names of those arguments are not referenced in the URL directly, then Flask will include them in the URL as query arguments.
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title='Home page', form=form, posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
+    posts, next_url, prev_url = deferred_page(
+        lambda: current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False),
+        lambda num: url_for('main.index', page=num))
+    return render_page('index.html', title='Home page', form=form, posts=posts, next_url=next_url,
+                       prev_url=prev_url)
 
 
 
@@ -114,7 +139,7 @@ def user_profile(username):
     '''查看user profile'''
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    posts = user.posts_page(page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.user_profile', username=user.username, page=posts.next_num) if posts.has_next else None
     prev_url = url_for('main.user_profile', username=user.username, page=posts.prev_num) if posts.has_prev else None
     return render_template('profile.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url)
@@ -184,11 +209,11 @@ def unfollow(username):
 def explore():
     '''发现其他用户的posts'''
     page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
     # url_for,if the names of those arguments are not referenced in the URL directly, then Flask will include them in the URL as query arguments.
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
-    return render_template('explore.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url)
+    posts, next_url, prev_url = deferred_page(
+        lambda: Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False),
+        lambda num: url_for('main.explore', page=num))
+    return render_page('explore.html', title='Explore', posts=posts, next_url=next_url, prev_url=prev_url)
 
 
 @main.route('/search')
@@ -211,6 +236,32 @@ def search():
                            next_url=next_url, prev_url=prev_url)
 
 
+@main.route('/user_cards')
+@login_required
+def user_cards():
+    '''
+        多个用户的弹出框数据(JSON)，/user_cards?u=name1&u=name2。
+        页面加载完后一次取回当前页所有作者的名片，鼠标悬停时在浏览器里渲染，不用每次悬停都请求/user/<username>/popup
+    '''
+    usernames = list(dict.fromkeys(request.args.getlist('u')))[:current_app.config['USER_CARDS_MAX']]
+    cards = {}
+    for user, followers_count, followed_count, following in User.cards(usernames, current_user):
+        cards[user.username] = {
+            'id': user.id,
+            'username': user.username,
+            'url': url_for('main.user_profile', username=user.username),
+            'avatar': user.avatar(64),
+            'about_me': user.about_me,
+            'last_seen': user.last_seen.isoformat() + 'Z' if user.last_seen else None,
+            'followers': followers_count,
+            'following': followed_count,
+            'is_self': user.id == current_user.id,
+            'is_following': following,
+            'follow_url': url_for('main.unfollow' if following else 'main.follow', username=user.username),
+        }
+    return jsonify(cards)
+
+
 @main.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
@@ -228,14 +279,43 @@ def send_message(recipient):
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user, body=form.message.data)
         db.session.add(msg)
-        # 发送私信同时提醒私信发生
-        user.add_notification('unread_message_count', user.new_messages_num())
         db.session.commit()
+        # 发送私信同时提醒私信发生。commit之后再入队，worker才读得到这条私信
+        update_unread_message_count.delay(user.id, dedup_key='unread_message_count:{}'.format(user.id))
         flash('Your message has been sent')
         return redirect(url_for('main.user_profile', username=recipient))
     return render_template('send_message.html', title='Send Message', form=form, recipient=recipient)
 
 
+@main.route('/broadcast', methods=['GET', 'POST'])
+@login_required
+def broadcast():
+    '''群发私信给所有粉丝，在后台任务里分批发送(见app/broadcast.py)'''
+    form = MessageForm()
+    if form.validate_on_submit():
+        broadcast = Broadcast(sender=current_user, body=form.message.data,
+                              recipients_total=current_user.followers_count())
+        db.session.add(broadcast)
+        db.session.commit()
+        broadcast_message.delay(broadcast.id, dedup_key='broadcast:{}'.format(broadcast.id))
+        flash('Your message is being sent to your followers')
+        return redirect(url_for('main.broadcasts'))
+    return render_template('send_message.html', title='Broadcast', form=form, recipient='all your followers')
+
+
+@main.route('/broadcasts')
+@login_required
+def broadcasts():
+    '''群发的私信和发送进度'''
+    page = request.args.get('page', 1, type=int)
+    broadcasts = current_user.broadcasts.order_by(Broadcast.timestamp.desc()).paginate(
+        page, current_app.config['POSTS_PER_PAGE'], False)
+    next_url = url_for('main.broadcasts', page=broadcasts.next_num) if broadcasts.has_next else None
+    prev_url = url_for('main.broadcasts', page=broadcasts.prev_num) if broadcasts.has_prev else None
+    return render_template('broadcasts.html', title='Broadcasts', broadcasts=broadcasts.items,
+                           next_url=next_url, prev_url=prev_url)
+
+
 @main.route('/messages')
 @login_required
 def check_messages():
@@ -266,4 +346,20 @@ def notifications():
         'name': n.name,
         'data': n.get_data(),
         'timestamp': n.timestamp
-    } for n in notifications])
\ No newline at end of file
+    } for n in notifications])
+
+
+@main.route('/suggest')
+def suggest():
+    '''搜索框自动补全，返回标题以q开头的post和用户名以q开头的用户。只查内存里的前缀索引(见suggest.py)'''
+    # 不用login_required，它要通过user_loader查数据库。session是签名过的，有Flask-Login记的用户id就是登录了
+    # (Flask-Login 0.4用user_id，0.5以后用_user_id)
+    if not (session.get('_user_id') or session.get('user_id')):
+        return current_app.login_manager.unauthorized()
+    q = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    return jsonify([{
+        'kind': kind,
+        'id': id,
+        'text': text
+    } for kind, id, text in suggest_index.search(q, limit)])
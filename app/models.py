@@ -1,12 +1,23 @@
-from app import db, login_manager
+from app import db, login_manager, metrics, jobs
+from flask import current_app, url_for
+from flask_sqlalchemy import Pagination
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from hashlib import md5
 from app.search import add_to_index, remove_from_index, query_index
+from app.search_cache import query_cache
+from app import suggest
+from app import graph
+from app.graph import social_graph
+from app import tasks
 import json
 from time import time
 
+# 已经commit到数据库、但还没写进Elasticsearch的对象数
+INDEX_QUEUE_DEPTH = metrics.gauge('search_index_queue_depth', '等待写入Elasticsearch的对象数')
+
+
 class SearchableMixin(object):
     '''
         glue layer between SQLALchemy and Elasticsearch，实现自动更新两边数据库
@@ -23,17 +34,22 @@ class SearchableMixin(object):
         :param expression:
         :param page:
         :param per_page:
-        :return: 根据Elatsticsearch的id得到相对应的SQLAlchemy对象， 和总结果数
+        :return: 根据Elatsticsearch的id得到相对应的SQLAlchemy对象(list)， 和总结果数
         '''
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
+        if not ids:
+            return [], total
+        return cls.hydrate(ids), total
+
+    @classmethod
+    def hydrate(cls, ids):
+        '''根据Elasticsearch返回的id查出对象(list)，顺序和ids一样'''
         when = []
         for i in range(len(ids)):
             when.append((ids[i], i))
         # SQL的in, case语句, ensures that the results from the database come in the same order as the IDs are given.
         return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
+            db.case(when, value=cls.id)).all()
 
     @classmethod
     def before_commit(cls, session):
@@ -47,19 +63,63 @@ class SearchableMixin(object):
             'update': list(session.dirty),
             'delete': list(session.deleted)
         }
+        # 还没写进Elasticsearch的对象数，after_commit里每写一个减一，rollback了就全部减掉
+        session._index_pending = sum(isinstance(obj, SearchableMixin)
+                                     for objs in session._changes.values() for obj in objs)
+        INDEX_QUEUE_DEPTH.inc(session._index_pending)
+        # 自动补全索引(见suggest.py)要的是Post.title和User.username的变化
+        session._suggest_changes = suggest.collect_changes(session)
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+        # JOBS_ENABLED时交给后台任务(见tasks.py)，请求不用等Elasticsearch
+        deferred = jobs.enabled
+        try:
+            for operation, objs in (('add', session._changes['add']), ('update', session._changes['update']),
+                                    ('delete', session._changes['delete'])):
+                for obj in objs:
+                    if not isinstance(obj, SearchableMixin):
+                        continue
+                    if deferred:
+                        cls._sync_later(obj)
+                    elif operation == 'delete':
+                        remove_from_index(obj.__tablename__, obj)
+                    else:
+                        add_to_index(obj.__tablename__, obj)
+                    session._index_pending -= 1
+                    INDEX_QUEUE_DEPTH.dec()
+        finally:
+            # 中途抛异常的话，剩下的也不会再写了
+            cls._discard_pending(session)
+        # 索引变了，让这些index的搜索缓存失效
+        for index in {obj.__tablename__ for objs in session._changes.values()
+                      for obj in objs if isinstance(obj, SearchableMixin)}:
+            query_cache.bump_generation(index)
+        suggest.apply_changes(session._suggest_changes)
+        graph.apply_changes(getattr(session, '_graph_changes', None) or [])
         session._changes = None
+        session._suggest_changes = None
+        session._graph_changes = None
+
+    @classmethod
+    def after_rollback(cls, session):
+        # before_commit之后flush或者COMMIT失败，after_commit不会执行
+        cls._discard_pending(session)
+        session._changes = None
+        session._suggest_changes = None
+        session._graph_changes = None
+
+    @staticmethod
+    def _discard_pending(session):
+        pending = getattr(session, '_index_pending', 0)
+        if pending:
+            INDEX_QUEUE_DEPTH.dec(pending)
+        session._index_pending = 0
+
+    @staticmethod
+    def _sync_later(obj):
+        tasks.sync_search_index.delay(obj.__tablename__, obj.id,
+                                      dedup_key='search:{}:{}'.format(obj.__tablename__, obj.id))
 
     @classmethod
     def reindex(cls):
@@ -71,11 +131,17 @@ class SearchableMixin(object):
 # SQLAlchemy自带的事件模型
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+# 本进程的关注/取关，commit后马上更新关注关系图(见graph.py)。
+# 在每次flush之前收集，不能等到before_commit: 中途autoflush过的对象已经不在session.new里了
+db.event.listen(db.session, 'before_flush', graph.collect_changes)
 
 # following和followed的关联表(第三张表), 因为是自引用关系(都是指向User表)，没有data只有foreign keys，所以不用model class.
 followers = db.Table('followers',
                      db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+                     # 按followed_id查粉丝(群发私信按follower_id分批取粉丝)
+                     db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
                      )
 
 
@@ -122,7 +188,9 @@ class User(db.Model, UserMixin):
         return check_password_hash(self.password_hash, password)
 
     def avatar(self, size):
-        '''获取头像地址'''
+        '''获取头像地址。AVATAR_LOCAL时用本地生成的identicon(见my_extensions/avatars.py)'''
+        if current_app.config['AVATAR_LOCAL']:
+            return url_for('avatar', user_id=self.id, size=size)
         digest = md5(self.email.lower().encode('utf-8')).hexdigest()
         return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
 
@@ -130,15 +198,96 @@ class User(db.Model, UserMixin):
         '''关注'''
         if not self.is_following(user):
             self.followed.append(user)
+            self._record_follow_change(user, True)
+            # 已经关注了，不要再出现在"你可能认识的人"里
+            FollowSuggestion.query.filter_by(user_id=self.id, suggested_id=user.id).delete()
 
     def unfollow(self, user):
         '''取关'''
         if self.is_following(user):
             self.followed.remove(user)
+            self._record_follow_change(user, False)
+
+    def _record_follow_change(self, user, following):
+        '''给别的进程的关注关系图catch up用。没开SOCIAL_GRAPH_ENABLED时没人读，不写(不然表会一直变大)'''
+        if current_app.config['SOCIAL_GRAPH_ENABLED']:
+            db.session.add(FollowChange(follower_id=self.id, followed_id=user.id, following=following))
+
+    @staticmethod
+    def _social_graph():
+        '''SOCIAL_GRAPH_ENABLED并且已经加载完时返回进程内的关注关系图，否则返回None(查数据库)'''
+        if not current_app.config['SOCIAL_GRAPH_ENABLED'] or not social_graph.ready:
+            return None
+        social_graph.catch_up(current_app.config['SOCIAL_GRAPH_CATCHUP_INTERVAL'],
+                              current_app.config['SOCIAL_GRAPH_OVERLAY_LIMIT'])
+        return social_graph
 
     def is_following(self, user):
+        graph = self._social_graph()
+        if graph is not None:
+            return graph.is_following(self.id, user.id)
         return self.followed.filter(followers.c.followed_id == user.id).count() > 0
 
+    def followers_count(self):
+        graph = self._social_graph()
+        if graph is not None:
+            return graph.follower_count(self.id)
+        return self.followers.count()
+
+    def followed_count(self):
+        graph = self._social_graph()
+        if graph is not None:
+            return graph.followed_count(self.id)
+        return self.followed.count()
+
+    @classmethod
+    def cards(cls, usernames, viewer):
+        '''
+            一次查多个用户的名片(弹出框用)，查询次数是固定的，不随用户数增加:
+            用户一条，粉丝数、关注数、viewer关注了其中哪些人各一条(关注关系图加载好时这三条都不用查)
+            :return: [(user, 粉丝数, 关注数, viewer是否关注了他)]
+        '''
+        users = cls.query.filter(cls.username.in_(usernames)).all() if usernames else []
+        ids = [user.id for user in users]
+        graph = cls._social_graph()
+        if not ids:
+            follower_counts, followed_counts, following = {}, {}, set()
+        elif graph is not None:
+            follower_counts = {id: graph.follower_count(id) for id in ids}
+            followed_counts = {id: graph.followed_count(id) for id in ids}
+            following = {id for id in ids if graph.is_following(viewer.id, id)}
+        else:
+            follower_counts = dict(db.session.query(followers.c.followed_id, db.func.count()).filter(
+                followers.c.followed_id.in_(ids)).group_by(followers.c.followed_id))
+            followed_counts = dict(db.session.query(followers.c.follower_id, db.func.count()).filter(
+                followers.c.follower_id.in_(ids)).group_by(followers.c.follower_id))
+            following = {id for id, in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == viewer.id, followers.c.followed_id.in_(ids))}
+        return [(user, follower_counts.get(user.id, 0), followed_counts.get(user.id, 0), user.id in following)
+                for user in users]
+
+    def follow_suggestions(self, limit):
+        '''"你可能认识的人"，flask recommend who-to-follow离线算好的(见recommend.py)，走(user_id, score)索引'''
+        return User.query.join(FollowSuggestion, FollowSuggestion.suggested_id == User.id).filter(
+            FollowSuggestion.user_id == self.id).order_by(FollowSuggestion.score.desc()).limit(limit).all()
+
+    def posts_page(self, page, per_page):
+        '''
+            个人主页的分页。前面几页只查热表(post)，翻到热表的帖子翻完了才去查归档表(post_archive, 见archive.py)，
+            归档的帖子都比热表里的旧，所以两段接起来就是按时间倒序的
+        '''
+        offset = (page - 1) * per_page
+        hot = self.posts.order_by(Post.timestamp.desc())
+        hot_total = hot.count()
+        if offset + per_page < hot_total:
+            # 后面还有热表的帖子，has_next一定为True，不用再数归档表
+            return Pagination(None, page, per_page, hot_total, hot.offset(offset).limit(per_page).all())
+        items = hot.offset(offset).limit(per_page).all() if offset < hot_total else []
+        archived = PostArchive.query.filter_by(user_id=self.id)
+        items += archived.order_by(PostArchive.timestamp.desc()).offset(
+            max(offset - hot_total, 0)).limit(per_page - len(items)).all()
+        return Pagination(None, page, per_page, hot_total + archived.count(), items)
+
     def followed_posts(self):
         # Post.query.join(...).filter(...).order_by(...)
         # join的第一个参数为关联表(自引用的第三张表)，第二个参数为条件
@@ -180,9 +329,46 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return '<Post {}>'.format(self.title)
 
+    @classmethod
+    def get_including_archived(cls, id):
+        '''
+            按id找帖子，热表里找不到时再找归档表，可能返回PostArchive(只读，没有搜索索引的事件，只有author)。
+            Post.query.get()只查热表，一定返回Post或None
+        '''
+        return cls.query.get(id) or PostArchive.query.get(id)
+
+    @classmethod
+    def hydrate(cls, ids):
+        '''搜索结果里已经归档了的帖子(Elasticsearch里还在)从归档表里查，返回list'''
+        posts = {post.id: post for post in super().hydrate(ids)}
+        missing = [id for id in ids if id not in posts]
+        if missing:
+            posts.update((post.id, post) for post in PostArchive.query.filter(PostArchive.id.in_(missing)))
+        return [posts[id] for id in ids if id in posts]
+
+
+class PostArchive(db.Model):
+    '''
+        归档的旧帖子(冷数据)，字段和Post一样，id也沿用Post的。flask archive posts把旧帖子从post表搬过来(见archive.py)
+        只有个人主页翻到很后面、搜索结果、Post.get_including_archived会查这张表
+    '''
+    __tablename__ = 'post_archive'
+    __table_args__ = (db.Index('ix_post_archive_user_id_timestamp', 'user_id', 'timestamp'),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    title = db.Column(db.String(32))
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    author = db.relationship('User')
+
+    def __repr__(self):
+        return '<PostArchive {}>'.format(self.title)
+
 
 class Message(db.Model):
     '''私信数据库模型, 还有来自Model User的backref: author, recipient'''
+    # 查某个用户的未读私信数(new_messages_num、群发时的批量更新)
+    __table_args__ = (db.Index('ix_message_recipient_id_timestamp', 'recipient_id', 'timestamp'),)
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -195,6 +381,92 @@ class Message(db.Model):
         return '<Message {}>'.format(self.body)
 
 
+class FollowChange(db.Model):
+    '''
+        关注/取关的变更日志，id就是变更序号。
+        其他进程的关注关系图(graph.py)按序号catch up，followers表本身没有"什么时候变的"这个信息
+    '''
+    __tablename__ = 'follow_change'
+    id = db.Column(db.Integer, primary_key=True)
+    follower_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    followed_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # True是关注，False是取关
+    following = db.Column(db.Boolean)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<FollowChange {} {} {}>'.format(self.follower_id, 'follow' if self.following else 'unfollow',
+                                                self.followed_id)
+
+
+class FollowSuggestion(db.Model):
+    '''推荐关注，每个用户top k个，score是共同关注的人数'''
+    __tablename__ = 'follow_suggestion'
+    __table_args__ = (db.Index('ix_follow_suggestion_user_id_score', 'user_id', 'score'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    suggested_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    score = db.Column(db.Integer)
+    # 这一批推荐是什么时候算的
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<FollowSuggestion {} -> {} ({})>'.format(self.user_id, self.suggested_id, self.score)
+
+
+class BackfillCheckpoint(db.Model):
+    '''flask backfill的进度，一个backfill一行(见backfill.py)'''
+    __tablename__ = 'backfill_checkpoint'
+    name = db.Column(db.String(64), primary_key=True)
+    # 已经处理到的主键(含)，和回填开始时的max(主键)
+    last_id = db.Column(db.Integer)
+    max_id = db.Column(db.Integer)
+    rows_done = db.Column(db.Integer, default=0)
+    started_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<BackfillCheckpoint {} {}/{}>'.format(self.name, self.last_id, self.max_id)
+
+
+class Broadcast(db.Model):
+    '''群发给所有粉丝的私信，同时记录发送进度(见broadcast.py)'''
+    __tablename__ = 'broadcast'
+    id = db.Column(db.Integer, primary_key=True)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # 创建时的粉丝数，发送过程中新增的粉丝也会收到，所以recipients_done可能比它大一点
+    recipients_total = db.Column(db.Integer)
+    recipients_done = db.Column(db.Integer, default=0)
+    # 已经发到的粉丝id(含)，失败重试时从这里接着发
+    last_follower_id = db.Column(db.Integer, default=0)
+    started_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    sender = db.relationship('User', backref=db.backref('broadcasts', lazy='dynamic'))
+
+    def progress(self):
+        '''已完成的百分比'''
+        if self.finished_at is not None:
+            return 100
+        if not self.recipients_total:
+            return 0
+        return min(100 * (self.recipients_done or 0) // self.recipients_total, 99)
+
+    def rate(self):
+        '''发送速度(messages/s)'''
+        if self.started_at is None or self.updated_at is None:
+            return 0
+        elapsed = (self.updated_at - self.started_at).total_seconds()
+        return (self.recipients_done or 0) / elapsed if elapsed > 0 else 0
+
+    def __repr__(self):
+        return '<Broadcast {} {}/{}>'.format(self.id, self.recipients_done, self.recipients_total)
+
+
 class Notification(db.Model):
     '''私信提醒模型'''
     id = db.Column(db.Integer, primary_key=True)
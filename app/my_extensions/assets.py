@@ -0,0 +1,188 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+from urllib.request import urlopen
+
+from flask import abort, request, send_file, url_for
+from werkzeug.security import safe_join
+
+from app.my_extensions.compress import _brotli
+
+
+'''
+# 为什么要自己托管静态文件
+
+bootstrap/base.html和moment.include_moment()默认从CDN加载Bootstrap、jQuery和moment.js。
+CDN在我们的网络里被墙或者限速，而且冷启动时还要多做几次DNS查询和TLS握手。
+
+# 做法
+
+    flask assets build
+
+1. 把Bootstrap(css、js、字体)、jQuery从Flask-Bootstrap自带的static目录复制出来，moment.js从cdnjs下载
+   (内网可以先下载好放到ASSETS_SOURCE_DIR，同名文件优先用那里的)
+2. 文件名带上内容的hash，例如bootstrap.min.3a5e6f....css。内容变了文件名就变，所以可以放心地让浏览器缓存一年(immutable)
+3. 每个文件再生成.gz和.br(brotli在requirements.txt里，没装的话build会警告，只有.gz)，请求时按Accept-Encoding选最小的，不用每次请求都压缩
+4. manifest.json记录 逻辑名 -> 带hash的文件名，模板里用asset_url('bootstrap.min.css')得到URL
+
+没有build过(没有manifest.json)时asset_url返回None，模板退回到原来的CDN。
+'''
+
+
+_BOOTSTRAP_STATIC = 'flask_bootstrap'
+
+# 逻辑名 -> 来源。'flask_bootstrap:xxx'表示Flask-Bootstrap包里static目录下的文件
+VENDOR_ASSETS = [
+    ('glyphicons-halflings-regular.eot', _BOOTSTRAP_STATIC + ':fonts/glyphicons-halflings-regular.eot'),
+    ('glyphicons-halflings-regular.svg', _BOOTSTRAP_STATIC + ':fonts/glyphicons-halflings-regular.svg'),
+    ('glyphicons-halflings-regular.ttf', _BOOTSTRAP_STATIC + ':fonts/glyphicons-halflings-regular.ttf'),
+    ('glyphicons-halflings-regular.woff', _BOOTSTRAP_STATIC + ':fonts/glyphicons-halflings-regular.woff'),
+    ('glyphicons-halflings-regular.woff2', _BOOTSTRAP_STATIC + ':fonts/glyphicons-halflings-regular.woff2'),
+    # css引用了上面的字体，所以要放在字体之后，才能把url(../fonts/xxx)改成带hash的文件名
+    ('bootstrap.min.css', _BOOTSTRAP_STATIC + ':css/bootstrap.min.css'),
+    ('bootstrap.min.js', _BOOTSTRAP_STATIC + ':js/bootstrap.min.js'),
+    ('jquery.min.js', _BOOTSTRAP_STATIC + ':jquery.min.js'),
+    ('moment-with-locales.min.js', 'https://cdnjs.cloudflare.com/ajax/libs/moment.js/2.18.1/moment-with-locales.min.js'),
+]
+
+# 已经压缩过的格式，再gzip没有意义
+_COMPRESSIBLE = ('.css', '.js', '.svg', '.ttf', '.eot', '.map')
+
+_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def _read_source(source, source_dir):
+    name = source.rsplit('/', 1)[-1]
+    if source_dir and os.path.exists(os.path.join(source_dir, name)):
+        with open(os.path.join(source_dir, name), 'rb') as f:
+            return f.read()
+    if source.startswith(_BOOTSTRAP_STATIC + ':'):
+        import flask_bootstrap
+        path = os.path.join(os.path.dirname(flask_bootstrap.__file__), 'static', source.split(':', 1)[1])
+        with open(path, 'rb') as f:
+            return f.read()
+    with urlopen(source, timeout=30) as response:
+        return response.read()
+
+
+def _rewrite_css_urls(css, manifest):
+    '''url(../fonts/a.woff?#iefix) -> url(a.<hash>.woff?#iefix)，同一个目录下'''
+    def replace(match):
+        quote, url = match.groups()
+        path, sep, rest = url, '', ''
+        suffix = re.search(r'[?#]', url)
+        if suffix:
+            path, sep, rest = url[:suffix.start()], url[suffix.start()], url[suffix.start() + 1:]
+        hashed = manifest.get(os.path.basename(path))
+        if hashed is None:
+            return match.group(0)
+        return 'url({0}{1}{2}{3}{0})'.format(quote, hashed, sep, rest)
+    return _CSS_URL.sub(replace, css.decode('utf-8')).encode('utf-8')
+
+
+def _hashed_name(name, content):
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    base, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(base, digest, ext)
+
+
+def _write_variants(directory, filename, content, brotli):
+    with open(os.path.join(directory, filename), 'wb') as f:
+        f.write(content)
+    if not filename.endswith(_COMPRESSIBLE):
+        return
+    with open(os.path.join(directory, filename + '.gz'), 'wb') as f:
+        # mtime=0，同样的内容生成同样的.gz
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is None:
+        return
+    with open(os.path.join(directory, filename + '.br'), 'wb') as f:
+        f.write(brotli.compress(content, quality=11))
+
+
+class Assets:
+    def __init__(self, app=None):
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_DIR', os.path.join(app.root_path, 'static', 'dist'))
+        app.config.setdefault('ASSETS_SOURCE_DIR', None)
+        app.config.setdefault('ASSETS_URL_PREFIX', '/assets')
+        app.config.setdefault('ASSETS_MAX_AGE', 365 * 24 * 3600)
+        app.extensions['assets'] = self
+        self.directory = app.config['ASSETS_DIR']
+        self.max_age = app.config['ASSETS_MAX_AGE']
+        self.load_manifest()
+        app.add_url_rule(app.config['ASSETS_URL_PREFIX'] + '/<path:filename>', 'assets', self.serve)
+        app.add_template_global(self.url, 'asset_url')
+
+    def load_manifest(self):
+        path = os.path.join(self.directory, 'manifest.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+
+    def url(self, name):
+        '''模板里的asset_url(name)。没有build过返回None'''
+        hashed = self.manifest.get(name)
+        if hashed is None:
+            return None
+        return url_for('assets', filename=hashed)
+
+    def build(self, source_dir=None, assets=VENDOR_ASSETS, log=print):
+        '''
+            把VENDOR_ASSETS复制/下载到ASSETS_DIR，生成带hash的文件名、.gz/.br和manifest.json
+            先写到临时目录，全部成功后再替换，下载失败不会破坏上一次build的结果
+        '''
+        building = self.directory + '.building'
+        if os.path.exists(building):
+            shutil.rmtree(building)
+        os.makedirs(building)
+        manifest = {}
+        brotli = _brotli()
+        if brotli is None:
+            log('WARNING: brotli is not installed (pip install -r requirements.txt), only .gz variants are built')
+        for name, source in assets:
+            content = _read_source(source, source_dir)
+            if name.endswith('.css'):
+                content = _rewrite_css_urls(content, manifest)
+            manifest[name] = _hashed_name(name, content)
+            _write_variants(building, manifest[name], content, brotli)
+            log('{} -> {} ({} bytes)'.format(name, manifest[name], len(content)))
+        with open(os.path.join(building, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.rename(building, self.directory)
+        self.manifest = manifest
+        return manifest
+
+    def serve(self, filename):
+        # 只提供manifest里的文件(不是.gz/.br本身)
+        if filename not in self.manifest.values():
+            abort(404)
+        path = safe_join(self.directory, filename)
+        encoding = None
+        accept = request.accept_encodings
+        for candidate, ext in (('br', '.br'), ('gzip', '.gz')):
+            if accept[candidate] and os.path.exists(path + ext):
+                encoding, path = candidate, path + ext
+                break
+        response = send_file(path, mimetype=_mimetype(filename), conditional=True, cache_timeout=self.max_age)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(self.max_age)
+        return response
+
+
+def _mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import Response, abort, request
+
+
+'''
+# 本地生成的identicon头像
+
+原来User.avatar()返回gravatar.com的URL，每一行post都要浏览器去第三方网站拿图片，内网(air-gapped)部署时根本访问不了。
+现在 /avatar/<user_id>/<size> 在服务器上生成和gravatar identicon类似的图案(5x5、左右对称)，纯Python写PNG，不需要PIL。
+
+    1. 图案只由user_id决定，同一个URL的内容永远不变，所以ETag固定，Cache-Control是immutable
+    2. 生成过的写到磁盘 AVATAR_CACHE_DIR/<size>/<user_id>.png，重启后不用再生成
+    3. 磁盘上面再加一层进程内的LRU(最多AVATAR_MEMORY_CACHE个)，热门用户的头像不用读文件
+    4. 只允许AVATAR_SIZES里的尺寸、只给存在的用户生成(内存和磁盘里都没有时查一次数据库)，
+       避免有人用任意尺寸或者任意user_id把磁盘写满。不需要登录
+    5. flask avatars prerender 可以预先生成常用尺寸(64/70)
+
+这个路由注册在app上而不是main蓝图上，main.before_request每次都会commit last_seen，头像请求不需要。
+'''
+
+
+_VERSION = 1
+_GRID = 5
+
+
+def _png(width, height, rows):
+    '''rows: 每一行的RGB字节(不含filter字节)'''
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    raw = b''.join(b'\x00' + row for row in rows)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw, 9)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def render_identicon(user_id, size):
+    '''返回PNG的字节'''
+    digest = hashlib.md5('identicon:{}'.format(user_id).encode('utf-8')).digest()
+    # 颜色取hash的后3个字节，调暗一点，白色背景上看得清
+    color = bytes(64 + b // 2 for b in digest[-3:])
+    background = b'\xf0\xf0\xf0'
+    # 左边3列由hash的bit决定，右边2列是镜像
+    cells = [[False] * _GRID for _ in range(_GRID)]
+    bit = 0
+    for x in range((_GRID + 1) // 2):
+        for y in range(_GRID):
+            on = digest[bit // 8] >> (bit % 8) & 1
+            cells[y][x] = cells[y][_GRID - 1 - x] = bool(on)
+            bit += 1
+
+    padding = size // 12
+    cell_size = (size - 2 * padding) // _GRID
+    padding = (size - cell_size * _GRID) // 2
+    edge = background * padding
+    tail = background * (size - padding - cell_size * _GRID)
+    cell_rows = [edge + b''.join((color if on else background) * cell_size for on in row) + tail
+                 for row in cells]
+    blank = background * size
+    rows = []
+    for y in range(size):
+        cell_y = (y - padding) // cell_size if y >= padding else -1
+        rows.append(cell_rows[cell_y] if 0 <= cell_y < _GRID else blank)
+    return _png(size, size, rows)
+
+
+class Avatars:
+    def __init__(self, app=None):
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AVATAR_LOCAL', True)
+        app.config.setdefault('AVATAR_CACHE_DIR', os.path.join(app.instance_path, 'avatars'))
+        app.config.setdefault('AVATAR_MEMORY_CACHE', 1024)
+        app.config.setdefault('AVATAR_SIZES', (32, 64, 70, 128, 256))
+        app.extensions['avatars'] = self
+        self.cache_dir = app.config['AVATAR_CACHE_DIR']
+        self.memory_cache_size = app.config['AVATAR_MEMORY_CACHE']
+        self.sizes = set(app.config['AVATAR_SIZES'])
+        app.add_url_rule('/avatar/<int:user_id>/<int:size>', 'avatar', self.serve)
+
+    def _path(self, user_id, size):
+        return os.path.join(self.cache_dir, str(size), '{}.png'.format(user_id))
+
+    def get(self, user_id, size):
+        '''内存LRU -> 磁盘 -> 生成。用户不存在时返回None'''
+        from app import metrics
+        key = (user_id, size)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+        if data is not None:
+            metrics.cache_requests.labels(cache='avatar', result='hit').inc()
+            return data
+        metrics.cache_requests.labels(cache='avatar', result='miss').inc()
+
+        path = self._path(user_id, size)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            from app.models import User
+            if User.query.get(user_id) is None:
+                return None
+            data = self.render_to_disk(user_id, size)
+        with self._lock:
+            self._memory[key] = data
+            while len(self._memory) > self.memory_cache_size:
+                self._memory.popitem(last=False)
+        return data
+
+    def render_to_disk(self, user_id, size):
+        data = render_identicon(user_id, size)
+        path = self._path(user_id, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再rename，其他进程不会读到写了一半的文件
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return data
+
+    def serve(self, user_id, size):
+        if size not in self.sizes:
+            abort(404)
+        etag = 'identicon-v{}-{}-{}'.format(_VERSION, user_id, size)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            data = self.get(user_id, size)
+            if data is None:
+                abort(404)
+            response = Response(data, mimetype='image/png')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+    def prerender(self, user_ids, sizes):
+        '''预先生成到磁盘，已经存在的跳过。返回生成的个数'''
+        count = 0
+        for user_id in user_ids:
+            for size in sizes:
+                if not os.path.exists(self._path(user_id, size)):
+                    self.render_to_disk(user_id, size)
+                    count += 1
+        return count
@@ -0,0 +1,110 @@
+import gzip
+import zlib
+
+from flask import request
+
+
+'''
+# 响应压缩
+
+HTML、JSON这些文本压缩后一般只有原来的1/4~1/5。在after_request里按Accept-Encoding选br(装了brotli才有)或者gzip。
+
+不压缩的情况：
+    1. 太小(COMPRESS_MIN_SIZE字节以下)，压缩省不了多少，还多花CPU
+    2. 已经有Content-Encoding的(例如/assets里预先压缩好的文件)
+    3. 不在COMPRESS_MIMETYPES里的类型(图片、字体这些本身就是压缩格式)
+    4. send_file这种direct_passthrough的响应
+
+# 流式响应(stream_template)
+
+边渲染边发送的响应不知道总长度，整个压缩的话要等全部渲染完，就失去了流式的意义。
+所以用zlib的compressobj一块一块地压缩，每块之后Z_SYNC_FLUSH，浏览器收到一块就能解压显示一块。
+'''
+
+
+_DEFAULT_MIMETYPES = ['text/html', 'text/css', 'text/plain', 'text/xml', 'application/json',
+                      'application/javascript', 'image/svg+xml']
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+class Compress:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_ENABLED', True)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.config.setdefault('COMPRESS_BR_QUALITY', 4)
+        app.config.setdefault('COMPRESS_MIMETYPES', _DEFAULT_MIMETYPES)
+        app.extensions['compress'] = self
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.level = app.config['COMPRESS_LEVEL']
+        self.br_quality = app.config['COMPRESS_BR_QUALITY']
+        self.mimetypes = set(app.config['COMPRESS_MIMETYPES'])
+        if app.config['COMPRESS_ENABLED']:
+            app.after_request(self.after_request)
+
+    def _choose_encoding(self, streamed):
+        accept = request.accept_encodings
+        # brotli没有像zlib那样方便的sync flush接口，流式响应只用gzip
+        if not streamed and accept['br'] and _brotli() is not None:
+            return 'br'
+        if accept['gzip']:
+            return 'gzip'
+        return None
+
+    def after_request(self, response):
+        if response.status_code < 200 or response.status_code in (204, 206, 304) or \
+                response.direct_passthrough or \
+                'Content-Encoding' in response.headers or \
+                response.mimetype not in self.mimetypes:
+            return response
+        streamed = response.is_streamed
+        if not streamed and (response.content_length or 0) < self.min_size:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self._choose_encoding(streamed)
+        if encoding is None:
+            return response
+
+        if streamed:
+            response.response = _gzip_stream(response.response, self.level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if encoding == 'br':
+                data = _brotli().compress(data, quality=self.br_quality)
+            else:
+                data = gzip.compress(data, compresslevel=self.level)
+            response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        # 压缩后的内容和原来的不一样，强ETag不再成立
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def _gzip_stream(chunks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
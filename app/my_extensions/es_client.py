@@ -0,0 +1,151 @@
+import threading
+from time import monotonic
+
+
+'''
+# 为什么要lazy
+
+import elasticsearch本身就要几十毫秒，而且很多进程(flask db、flask shell、大部分请求)根本不用Elasticsearch。
+所以create_app里只创建这个代理对象，第一次真正调用(search/index/delete)时才import并创建Elasticsearch客户端。
+
+# 连接池
+
+elasticsearch-py底层用urllib3的连接池，默认就是keep-alive。maxsize是每个节点的连接数，
+gunicorn多线程worker里线程数大于maxsize的话，多出来的线程要等连接，所以ELASTICSEARCH_MAXSIZE最好不小于线程数。
+
+# 超时、重试和熔断(circuit breaker)
+
+Elasticsearch变慢或挂掉时，如果每个请求都等到超时，/search和每次commit post都会卡住，worker很快就被占满。
+    1. 每次调用有一个总的时间预算(按操作配置，search要快，index可以慢一点)，重试也算在里面
+    2. 重试次数有上限(max_retries)，由call()自己做: 不sleep，每次的request_timeout是预算剩下的时间，
+       预算用完就不再重试。(elasticsearch-py自带的重试每次之前sleep 2^n-1秒，而且每次都等满request_timeout，
+       一次失败的search会花掉好几倍的预算，所以客户端的max_retries是0)
+    3. 连续失败failure_threshold次后熔断器打开(open)，之后reset_timeout秒内的调用直接抛CircuitOpenError，不发请求(fail fast)
+    4. reset_timeout秒后进入half-open，放一个请求过去试探，成功就关闭(closed)，失败就继续open
+
+调用方(search.py)捕获ElasticsearchUnavailable，query_index返回空结果，写索引的失败只记日志。
+'''
+
+
+class ElasticsearchUnavailable(Exception):
+    '''Elasticsearch不可用(熔断器打开，或者这次调用失败)'''
+
+
+class CircuitOpenError(ElasticsearchUnavailable):
+    '''熔断器打开，没有发请求'''
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        '''不允许调用时抛CircuitOpenError'''
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            # half-open时只放一个试探请求
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            raise CircuitOpenError('Elasticsearch circuit breaker is open')
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = monotonic()
+                self._trial_in_flight = False
+
+
+class ResilientElasticsearch:
+    def __init__(self, url, maxsize=10, timeout=10, max_retries=1, operation_timeouts=None,
+                 failure_threshold=5, reset_timeout=30):
+        self.url = url
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # {'search': 1.0, 'index': 5.0}, 没配置的操作用timeout
+        self.operation_timeouts = operation_timeouts or {}
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        # search.py里用 if not current_app.elasticsearch 判断有没有开启全文搜索，不能因此触发创建客户端
+        return True
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from elasticsearch import Elasticsearch
+                    self._client = Elasticsearch([self.url], maxsize=self.maxsize, timeout=self.timeout,
+                                                 max_retries=0)
+        return self._client
+
+    def reset(self):
+        '''丢掉已经创建的客户端(例如fork之后，子进程不能和父进程共用socket)，下次调用时重新创建'''
+        self._client = None
+
+    def call(self, operation, **kwargs):
+        '''
+            经过熔断器调用client的operation方法(index/delete/search...)
+            失败时抛ElasticsearchUnavailable(CircuitOpenError是它的子类)，其他错误(例如404、查询语法错误)原样抛出
+            kwargs里的request_timeout是这次调用的总预算(包括重试)
+        '''
+        from elasticsearch.exceptions import ConnectionError, TransportError
+
+        self.breaker.before_call()
+        budget = kwargs.pop('request_timeout', self.operation_timeouts.get(operation, self.timeout))
+        deadline = monotonic() + budget
+        attempt = 0
+        while True:
+            try:
+                result = getattr(self.client, operation)(request_timeout=max(deadline - monotonic(), 0.001),
+                                                          **kwargs)
+            except ConnectionError as e:
+                # 包括ConnectionTimeout
+                error = e
+            except TransportError as e:
+                if not (isinstance(e.status_code, int) and (e.status_code >= 500 or e.status_code == 429)):
+                    # 4xx是请求本身的问题，不代表Elasticsearch不可用
+                    self.breaker.record_success()
+                    raise
+                error = e
+            except Exception:
+                # 例如SerializationError，Elasticsearch是有响应的
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+            attempt += 1
+            if attempt > self.max_retries or monotonic() >= deadline:
+                self.breaker.record_failure()
+                # 不用str(e): 不是Elasticsearch返回的错误(例如代理的502)时TransportError.__str__会抛TypeError
+                raise ElasticsearchUnavailable('{} {}'.format(error.status_code, error.error)) from error
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
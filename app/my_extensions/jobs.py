@@ -0,0 +1,330 @@
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from flask import current_app
+
+
+'''
+# 后台任务
+
+请求里不必马上做完的事(重新计算私信提醒、写Elasticsearch)放进队列，由 flask jobs worker 启动的worker进程去做，
+视图可以先返回。
+
+    from app import jobs
+
+    @jobs.job(max_attempts=5)
+    def update_unread_message_count(user_id):
+        ...
+
+    update_unread_message_count.delay(user.id, dedup_key='unread:{}'.format(user.id))
+    update_unread_message_count.delay(user.id, eta=60)     # 60秒以后再执行
+
+任务函数在worker里的app context中执行，参数要能json序列化(传id，不要传对象)。
+
+# 队列
+
+一个单独的SQLite文件(JOBS_DATABASE，WAL模式)，和业务数据库分开，入队不会和业务的写入抢锁，worker重启后任务还在。
+
+    1. dedup_key: 同一个key只会有一个还没开始的任务(部分唯一索引)，重复的delay()直接忽略。
+       任务开始执行后同样的key又可以入队，所以执行期间的新变化不会丢
+    2. 重试: 抛异常后过 JOBS_RETRY_BACKOFF * 2^(第几次-1) 秒(加一点随机)再试，超过max_attempts次标为failed
+    3. worker进程死了: running状态超过JOBS_VISIBILITY_TIMEOUT秒的任务会被其他worker重新领取，所以任务要能重复执行
+    4. 周期任务: @jobs.job(every=秒)，worker的父进程按时入队(dedup_key是periodic:<name>，多台机器也只有一份)
+    5. 成功的任务直接删除，failed的留着(flask jobs status可以看到)
+
+JOBS_ENABLED=False(默认)时delay()直接在当前进程里同步执行，和以前一样，开发时不用启动worker。
+但是@jobs.job(background=True)的任务(例如群发私信，要很久)在当前进程的一个后台线程里执行，请求不用等它做完。
+这种线程没有重试，进程退出时还没做完的就丢了(任务自己记进度的话，可以重新delay接着做)，要可靠就开JOBS_ENABLED。
+
+# 可观测
+
+job_queue_depth(到期还没执行的任务数)、job_queue_lag_seconds(最老的到期任务等了多久)由worker父进程定时更新，
+jobs_processed_total按任务名和结果计数，job_duration_seconds是执行耗时。多进程时要配置METRICS_DIR才能在/metrics看到。
+'''
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    args TEXT NOT NULL,
+    dedup_key TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    run_at REAL NOT NULL,
+    enqueued_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    locked_by TEXT,
+    locked_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_jobs_pending_dedup_key ON jobs (dedup_key)
+    WHERE status = 'pending' AND dedup_key IS NOT NULL;
+'''
+
+
+class Job:
+    '''@jobs.job返回的对象，直接调用就是同步执行'''
+
+    def __init__(self, queue, fn, max_attempts, every, background):
+        self.queue = queue
+        self.fn = fn
+        self.name = '{}.{}'.format(fn.__module__, fn.__name__)
+        self.max_attempts = max_attempts
+        self.every = every
+        self.background = background
+        self.__doc__ = fn.__doc__
+
+    def __call__(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+
+    def delay(self, *args, dedup_key=None, eta=None, **kwargs):
+        '''
+            入队。JOBS_ENABLED为False时直接执行(background=True的在后台线程里执行)
+            :param eta: 秒数(多少秒之后)或datetime(UTC)
+        '''
+        if not self.queue.enabled:
+            if self.background:
+                self.queue.run_in_thread(current_app._get_current_object(), self, args, kwargs)
+            else:
+                self.fn(*args, **kwargs)
+            return
+        if isinstance(eta, datetime):
+            eta = (eta - datetime.utcnow()).total_seconds()
+        self.queue.enqueue(self.name, args, kwargs, dedup_key=dedup_key, delay=eta or 0,
+                           max_attempts=self.max_attempts)
+
+
+class JobQueue:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.path = None
+        self._jobs = {}
+        # 每个线程一个连接
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_ENABLED', False)
+        app.config.setdefault('JOBS_DATABASE', os.path.join(app.instance_path, 'jobs.db'))
+        app.config.setdefault('JOBS_VISIBILITY_TIMEOUT', 300)
+        app.config.setdefault('JOBS_RETRY_BACKOFF', 2)
+        app.extensions['jobs'] = self
+        self.enabled = app.config['JOBS_ENABLED']
+        self.path = app.config['JOBS_DATABASE']
+        self.visibility_timeout = app.config['JOBS_VISIBILITY_TIMEOUT']
+        self.retry_backoff = app.config['JOBS_RETRY_BACKOFF']
+
+        if hasattr(self, 'processed'):
+            return
+        from app import metrics
+        self.processed = metrics.counter('jobs_processed_total', '执行完的后台任务数, result为success/retry/failed',
+                                         ['job', 'result'])
+        self.duration = metrics.histogram('job_duration_seconds', '后台任务的执行耗时', ['job'])
+        self.depth = metrics.gauge('job_queue_depth', '到期还没执行的后台任务数')
+        self.lag = metrics.gauge('job_queue_lag_seconds', '最老的到期后台任务已经等了多少秒')
+
+    def job(self, max_attempts=5, every=None, background=False):
+        '''
+            装饰器。every: 周期任务的间隔(秒)
+            background: 没有开JOBS_ENABLED时也不在请求里同步执行，而是放到后台线程里
+        '''
+        def decorator(fn):
+            job = Job(self, fn, max_attempts, every, background)
+            self._jobs[job.name] = job
+            return job
+        return decorator
+
+    def _db(self):
+        # sqlite3的连接不能跨线程用(多线程的开发服务器、flask serve --threads)，也不能跨fork用，
+        # 所以每个线程一个连接，pid变了(或者换了JOBS_DATABASE)就重新连
+        local = self._local
+        key = (os.getpid(), self.path)
+        if getattr(local, 'key', None) != key:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            local.conn, local.key = conn, key
+        return local.conn
+
+    def enqueue(self, name, args=(), kwargs=None, dedup_key=None, delay=0, max_attempts=5):
+        '''返回True表示入队了，False表示有相同dedup_key的任务还没执行'''
+        now = time.time()
+        cursor = self._db().execute(
+            'INSERT OR IGNORE INTO jobs (name, args, dedup_key, run_at, enqueued_at, max_attempts) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (name, json.dumps([list(args), kwargs or {}]), dedup_key, now + delay, now, max_attempts))
+        return cursor.rowcount == 1
+
+    def claim(self, worker_id):
+        '''领取一个到期的任务，返回(id, name, args, kwargs, attempts, max_attempts)或None'''
+        db = self._db()
+        now = time.time()
+        # BEGIN IMMEDIATE先拿到写锁，select和update之间不会被别的worker抢走
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                "SELECT id, name, args, attempts, max_attempts FROM jobs "
+                "WHERE (status = 'pending' AND run_at <= ?) OR (status = 'running' AND locked_at < ?) "
+                "ORDER BY run_at LIMIT 1", (now, now - self.visibility_timeout)).fetchone()
+            if row is None:
+                db.execute('COMMIT')
+                return None
+            job_id, name, args, attempts, max_attempts = row
+            db.execute("UPDATE jobs SET status = 'running', locked_by = ?, locked_at = ?, attempts = attempts + 1 "
+                       "WHERE id = ?", (worker_id, now, job_id))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        args, kwargs = json.loads(args)
+        return job_id, name, args, kwargs, attempts + 1, max_attempts
+
+    def complete(self, job_id):
+        self._db().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def fail(self, job_id, attempts, max_attempts, error):
+        '''还能重试就改回pending并推迟，否则标为failed。返回True表示会重试'''
+        if attempts < max_attempts:
+            delay = self.retry_backoff * 2 ** (attempts - 1) * random.uniform(1, 1.5)
+            # 同一个dedup_key已经有新的pending任务时，这个就不用再重试了(新的会做同样的事)
+            try:
+                self._db().execute(
+                    "UPDATE jobs SET status = 'pending', run_at = ?, locked_by = NULL, last_error = ? WHERE id = ?",
+                    (time.time() + delay, error, job_id))
+            except sqlite3.IntegrityError:
+                self.complete(job_id)
+            return True
+        self._db().execute("UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?", (error, job_id))
+        return False
+
+    def stats(self):
+        '''返回(到期的pending数, 最老的到期任务等了多少秒, 按状态的计数)'''
+        db = self._db()
+        now = time.time()
+        due, oldest = db.execute("SELECT COUNT(*), MIN(run_at) FROM jobs WHERE status = 'pending' AND run_at <= ?",
+                                 (now,)).fetchone()
+        counts = dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return due, (now - oldest) if oldest else 0.0, counts
+
+    def run_in_thread(self, app, job, args, kwargs):
+        '''JOBS_ENABLED为False时执行background=True的任务，返回线程'''
+        def run():
+            from app import db
+            start = time.perf_counter()
+            try:
+                with app.app_context():
+                    try:
+                        job.fn(*args, **kwargs)
+                    finally:
+                        db.session.remove()
+            except Exception:
+                self.processed.labels(job=job.name, result='failed').inc()
+                app.logger.exception('job {} failed in background thread'.format(job.name))
+            else:
+                self.processed.labels(job=job.name, result='success').inc()
+            self.duration.labels(job=job.name).observe(time.perf_counter() - start)
+
+        thread = threading.Thread(target=run, name='job-{}'.format(job.name), daemon=True)
+        thread.start()
+        return thread
+
+    def run_one(self, app, worker_id):
+        '''执行一个任务，没有到期的任务时返回False'''
+        from app import db
+        claimed = self.claim(worker_id)
+        if claimed is None:
+            return False
+        job_id, name, args, kwargs, attempts, max_attempts = claimed
+        job = self._jobs.get(name)
+        start = time.perf_counter()
+        try:
+            if job is None:
+                raise LookupError('unknown job {}'.format(name))
+            with app.app_context():
+                try:
+                    job.fn(*args, **kwargs)
+                finally:
+                    db.session.remove()
+        except Exception:
+            error = traceback.format_exc()
+            retry = self.fail(job_id, attempts, max_attempts, error)
+            self.processed.labels(job=name, result='retry' if retry else 'failed').inc()
+            app.logger.warning('job {} (attempt {}/{}) failed:\n{}'.format(name, attempts, max_attempts, error))
+        else:
+            self.complete(job_id)
+            self.processed.labels(job=name, result='success').inc()
+        self.duration.labels(job=name).observe(time.perf_counter() - start)
+        return True
+
+    def work(self, app, poll_interval=1.0, should_stop=lambda: False):
+        '''一个worker进程的主循环'''
+        worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        while not should_stop():
+            if not self.run_one(app, worker_id):
+                time.sleep(poll_interval)
+
+    def run_workers(self, app, processes=2, poll_interval=1.0):
+        '''
+            flask jobs worker: fork出processes个worker进程，父进程负责周期任务入队、更新队列的metrics、
+            重启意外退出的worker。SIGTERM/SIGINT时通知worker做完手上的任务再退出
+        '''
+        from app import db
+        # 信号处理函数里只改普通的变量：在那里调multiprocessing.Event.set()，
+        # 如果主线程正好在Event.wait()里持有同一把锁，就死锁了
+        stopping = multiprocessing.Event()
+        received = []
+        context = multiprocessing.get_context('fork')
+
+        def child():
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, lambda *_: received.append(True))
+            # 不要用父进程的数据库连接和Elasticsearch连接
+            db.get_engine(app).dispose()
+            if app.elasticsearch is not None:
+                app.elasticsearch.reset()
+            self.work(app, poll_interval, lambda: bool(received) or stopping.is_set())
+
+        def start():
+            process = context.Process(target=child, name='jobs-worker')
+            process.start()
+            return process
+
+        signal.signal(signal.SIGTERM, lambda *_: received.append(True))
+        signal.signal(signal.SIGINT, lambda *_: received.append(True))
+        workers = [start() for _ in range(processes)]
+        app.logger.info('started {} job workers on {}'.format(processes, self.path))
+
+        periodic = [job for job in self._jobs.values() if job.every]
+        next_run = {job.name: time.time() for job in periodic}
+        while not received:
+            now = time.time()
+            for job in periodic:
+                if now >= next_run[job.name]:
+                    self.enqueue(job.name, dedup_key='periodic:{}'.format(job.name), max_attempts=job.max_attempts)
+                    next_run[job.name] = now + job.every
+            due, lag, _ = self.stats()
+            self.depth.set(due)
+            self.lag.set(lag)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    app.logger.warning('job worker {} exited with {}, restarting'.format(process.pid, process.exitcode))
+                    workers[i] = start()
+            time.sleep(poll_interval)
+
+        stopping.set()
+        for process in workers:
+            process.join()
@@ -0,0 +1,475 @@
+import glob
+import hmac
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+from flask import Response, abort, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+# Prometheus风格的metrics
+
+Counter(只增不减), Gauge(可增可减), Histogram(固定bucket的分布)。导出地址默认是/metrics，格式是Prometheus的text exposition format。
+
+# 多进程(gunicorn多个worker)
+
+每个worker进程的数据各自是不同的，如果只放在进程内存里，/metrics只能看到处理本次请求的那个worker的数据。
+所以配置了METRICS_DIR之后，每个进程把数值写在METRICS_DIR下自己的mmap文件里(只有自己写，所以写入不用跨进程锁)，
+导出的时候读所有进程的文件再相加。思路参考prometheus_client的multiprocess mode。
+
+    export METRICS_DIR=/tmp/allenblog_metrics    # 每次部署前要清空这个目录
+
+没有配置METRICS_DIR，就只用进程内的dict(开发环境、单进程)。
+
+# 谁能看/metrics
+
+和/_profile一样，不让的话返回404。
+    1. 配置了METRICS_TOKEN: 请求要带上token(Authorization: Bearer <token>，Prometheus的bearer_token；
+       或者X-Metrics-Token头、?token=)
+    2. 没配置: 只有METRICS_ALLOWED_IPS(默认本机)直接来的请求可以看。经过反向代理的请求(有X-Forwarded-For)不算，
+       不然nginx转发过来的请求都是127.0.0.1
+'''
+
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _MemoryStore:
+    '''进程内的存储, key -> float'''
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def collect(self):
+        '''返回 (key, value) 的列表'''
+        with self._lock:
+            return [(key, value) for key, value in self._values.items()]
+
+
+class _MmapFile:
+    '''
+        一个进程独占的mmap文件。格式：
+        开头8字节: 已用字节数(int32) + 4字节padding
+        之后每个条目: key长度(int32) + key(utf-8, 补齐到使得double 8字节对齐) + value(double)
+    '''
+    _INITIAL_SIZE = 1 << 16
+
+    def __init__(self, path):
+        self._f = open(path, 'a+b')
+        if os.fstat(self._f.fileno()).st_size == 0:
+            self._f.truncate(self._INITIAL_SIZE)
+        self._capacity = os.fstat(self._f.fileno()).st_size
+        self._m = mmap.mmap(self._f.fileno(), self._capacity)
+        self._positions = {}
+        self._used = struct.unpack_from('i', self._m, 0)[0]
+        if self._used == 0:
+            self._used = 8
+            struct.pack_into('i', self._m, 0, self._used)
+        for key, _, pos in self._read_entries(self._m, self._used):
+            self._positions[key] = pos
+
+    @staticmethod
+    def _read_entries(m, used):
+        pos = 8
+        while pos < used:
+            length = struct.unpack_from('i', m, pos)[0]
+            key = m[pos + 4:pos + 4 + length].decode('utf-8')
+            pos += 4 + length + (8 - (length + 4) % 8)
+            value = struct.unpack_from('d', m, pos)[0]
+            yield key, value, pos
+            pos += 8
+
+    @classmethod
+    def read_file(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < 8:
+            return []
+        used = struct.unpack_from('i', data, 0)[0]
+        return [(key, value) for key, value, _ in cls._read_entries(data, used)]
+
+    def _init_value(self, key):
+        encoded = key.encode('utf-8')
+        padded = encoded + b' ' * (8 - (len(encoded) + 4) % 8)
+        entry = struct.pack('i{}sd'.format(len(padded)), len(encoded), padded, 0.0)
+        while self._used + len(entry) > self._capacity:
+            self._capacity *= 2
+            self._f.truncate(self._capacity)
+            self._m = mmap.mmap(self._f.fileno(), self._capacity)
+        self._m[self._used:self._used + len(entry)] = entry
+        # 先写数据再更新已用字节数，读的进程就不会读到写了一半的条目
+        self._used += len(entry)
+        struct.pack_into('i', self._m, 0, self._used)
+        self._positions[key] = self._used - 8
+
+    def get(self, key):
+        pos = self._positions.get(key)
+        if pos is None:
+            return 0.0
+        return struct.unpack_from('d', self._m, pos)[0]
+
+    def set(self, key, value):
+        if key not in self._positions:
+            self._init_value(key)
+        struct.pack_into('d', self._m, self._positions[key], value)
+
+
+class _MmapStore:
+    '''
+        counter_<pid>.db 存Counter和Histogram，进程死了数据也保留(总量不能变少)
+        gauge_<pid>.db 存Gauge，只统计还活着的进程
+    '''
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._files = {}
+
+    def _file(self, kind):
+        # fork之后pid变了，要换成新进程自己的文件
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._files = {}
+        if kind not in self._files:
+            path = os.path.join(self._directory, '{}_{}.db'.format(kind, pid))
+            self._files[kind] = _MmapFile(path)
+        return self._files[kind]
+
+    @staticmethod
+    def _kind(key):
+        return 'gauge' if key.startswith('["gauge"') else 'counter'
+
+    def inc(self, key, amount):
+        with self._lock:
+            f = self._file(self._kind(key))
+            f.set(key, f.get(key) + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            self._file(self._kind(key)).set(key, value)
+
+    def collect(self):
+        totals = {}
+        for path in glob.glob(os.path.join(self._directory, '*.db')):
+            kind, pid = os.path.basename(path)[:-3].split('_')
+            if kind == 'gauge' and not _pid_alive(int(pid)):
+                continue
+            for key, value in _MmapFile.read_file(path):
+                totals[key] = totals.get(key, 0.0) + value
+        return list(totals.items())
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._children_lock = threading.Lock()
+
+    def labels(self, **labels):
+        values = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(values)
+        if child is None:
+            with self._children_lock:
+                child = self._children.setdefault(values, self._child(tuple(zip(self.labelnames, values))))
+        return child
+
+    def _key(self, suffix, labels):
+        return json.dumps([self.kind, self.name, suffix, labels])
+
+    def _store(self):
+        return self._registry.store
+
+
+class _CounterChild:
+    def __init__(self, metric, labels):
+        self._metric = metric
+        self._key = metric._key('_total' if not metric.name.endswith('_total') else '', labels)
+
+    def inc(self, amount=1):
+        self._metric._store().inc(self._key, amount)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _child(self, labels):
+        return _CounterChild(self, labels)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self, metric, labels):
+        self._metric = metric
+        self._key = metric._key('', labels)
+
+    def inc(self, amount=1):
+        self._metric._store().inc(self._key, amount)
+
+    def dec(self, amount=1):
+        self._metric._store().inc(self._key, -amount)
+
+    def set(self, value):
+        self._metric._store().set(self._key, value)
+
+
+class Gauge(_Metric):
+    '''多进程时各进程的值相加(例如各worker的队列长度加起来就是总的队列长度)'''
+    kind = 'gauge'
+
+    def _child(self, labels):
+        return _GaugeChild(self, labels)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _HistogramChild:
+    def __init__(self, metric, labels):
+        self._metric = metric
+        self._upper_bounds = metric.buckets
+        # 每个bucket存的是落在这个区间的次数(非累加)，导出时再累加
+        self._bucket_keys = [metric._key('_bucket', labels + (('le', _format_value(b)),))
+                             for b in metric.buckets]
+        self._sum_key = metric._key('_sum', labels)
+        self._count_key = metric._key('_count', labels)
+
+    def observe(self, value):
+        store = self._metric._store()
+        store.inc(self._bucket_keys[bisect_left(self._upper_bounds, value)], 1)
+        store.inc(self._sum_key, value)
+        store.inc(self._count_key, 1)
+
+    def time(self):
+        return _Timer(self.observe)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(registry, name, documentation, labelnames)
+        buckets = tuple(sorted(float(b) for b in buckets))
+        if buckets[-1] != float('inf'):
+            buckets += (float('inf'),)
+        self.buckets = buckets
+
+    def _child(self, labels):
+        return _HistogramChild(self, labels)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class _Timer:
+    '''with histogram.time(): ...'''
+
+    def __init__(self, callback):
+        self._callback = callback
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._callback(perf_counter() - self._start)
+
+
+class Metrics:
+    '''
+        用法与其他extension一样，metrics = Metrics(), metrics.init_app(app)
+        在模块里定义指标: REQUESTS = metrics.counter('xxx_total', '说明', ['label'])
+    '''
+
+    def __init__(self, app=None):
+        self.store = _MemoryStore()
+        self._metrics = []
+        self.request_latency = self.histogram(
+            'http_request_duration_seconds', 'HTTP请求耗时(按endpoint)', ['endpoint', 'method', 'status'])
+        self.request_db_time = self.histogram(
+            'http_request_db_seconds', '每个HTTP请求花在数据库上的时间(按endpoint)', ['endpoint'])
+        self.db_query_latency = self.histogram(
+            'db_query_duration_seconds', '单条SQL的耗时')
+        self.cache_requests = self.counter(
+            'cache_requests_total', '缓存查询次数, result为hit或miss, 用来算命中率', ['cache', 'result'])
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_PATH', '/metrics')
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_ALLOWED_IPS', ('127.0.0.1', '::1'))
+        app.extensions['metrics'] = self
+        self.token = app.config['METRICS_TOKEN']
+        self.allowed_ips = tuple(app.config['METRICS_ALLOWED_IPS'])
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        if app.config['METRICS_DIR']:
+            os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+            self.store = _MmapStore(app.config['METRICS_DIR'])
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule(app.config['METRICS_PATH'], 'metrics', self.export)
+
+        # 监听所有Engine, 不用等到app context里才拿得到db.engine
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _registries.add(self)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def _before_request(self):
+        g._metrics_start = perf_counter()
+        g._metrics_db_time = 0.0
+
+    def _after_request(self, response):
+        start = g.pop('_metrics_start', None)
+        if start is not None:
+            endpoint = request.endpoint or 'unknown'
+            self.request_latency.labels(endpoint=endpoint, method=request.method,
+                                        status=response.status_code).observe(perf_counter() - start)
+            self.request_db_time.labels(endpoint=endpoint).observe(g.pop('_metrics_db_time', 0.0))
+        return response
+
+    def _allowed(self):
+        if self.token:
+            authorization = request.headers.get('Authorization', '')
+            token = (authorization[7:] if authorization.startswith('Bearer ') else
+                     request.headers.get('X-Metrics-Token') or request.args.get('token') or '')
+            return hmac.compare_digest(token.encode(), self.token.encode())
+        return request.remote_addr in self.allowed_ips and 'X-Forwarded-For' not in request.headers
+
+    def export(self):
+        if not self._allowed():
+            abort(404)
+        return Response(self.generate_latest(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    def generate_latest(self):
+        samples = {}
+        for key, value in self.store.collect():
+            kind, name, suffix, labels = json.loads(key)
+            samples.setdefault(name, []).append((suffix, tuple(tuple(l) for l in labels), value))
+
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation.replace('\n', ' ')))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            metric_samples = sorted(samples.get(metric.name, []))
+            if metric.kind == 'histogram':
+                lines.extend(self._histogram_lines(metric, metric_samples))
+                continue
+            for suffix, labels, value in metric_samples:
+                lines.append('{}{}{} {}'.format(metric.name, suffix, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram_lines(metric, metric_samples):
+        # 按label分组，bucket从小到大累加
+        series = {}
+        for suffix, labels, value in metric_samples:
+            if suffix == '_bucket':
+                base, le = labels[:-1], labels[-1][1]
+                series.setdefault(base, {'buckets': {}})['buckets'][le] = value
+            else:
+                series.setdefault(labels, {'buckets': {}})[suffix] = value
+        lines = []
+        for labels, data in sorted(series.items()):
+            cumulative = 0.0
+            for bound in metric.buckets:
+                le = _format_value(bound)
+                cumulative += data['buckets'].get(le, 0.0)
+                lines.append('{}_bucket{} {}'.format(
+                    metric.name, _format_labels(labels + (('le', le),)), _format_value(cumulative)))
+            lines.append('{}_sum{} {}'.format(metric.name, _format_labels(labels), _format_value(data.get('_sum', 0.0))))
+            lines.append('{}_count{} {}'.format(metric.name, _format_labels(labels), _format_value(data.get('_count', 0.0))))
+        return lines
+
+
+_registries = set()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_metrics_query_start', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('_metrics_query_start')
+    if not starts:
+        return
+    elapsed = perf_counter() - starts.pop()
+    for registry in _registries:
+        registry.db_query_latency.observe(elapsed)
+    if g and hasattr(g, '_metrics_db_time'):
+        g._metrics_db_time += elapsed
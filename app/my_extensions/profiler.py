@@ -0,0 +1,210 @@
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from fnmatch import fnmatch
+
+from flask import Response, abort, request
+
+
+'''
+# 采样profiler
+
+某个页面线上变慢的时候，metrics只能看到总时间和SQL时间，看不到Python的时间花在哪里。
+这里用一个后台线程每隔interval秒用sys._current_frames()取一次正在被profile的请求线程的调用栈，
+按endpoint累计折叠栈(collapsed stack，"a;b;c 次数"，每一层是"文件:函数")，
+可以直接交给flamegraph.pl或者speedscope画火焰图:
+
+    curl -H 'X-Profiler-Token: ...' 'http://host/_profile?endpoint=main.index' > index.folded
+    flamegraph.pl index.folded > index.svg
+
+    /_profile                       每个endpoint的样本数和profiler自己的开销
+    /_profile?endpoint=main.index   这个endpoint的折叠栈
+    /_profile?reset=1               清空
+
+# 哪些请求会被profile
+
+PROFILER_ENDPOINTS里的endpoint(可以写通配符，如main.*)每个请求都profile，其他请求按PROFILER_SAMPLE_RATE的比例随机profile。
+用线程而不是SIGPROF信号: 信号只能在主线程处理，gunicorn的gthread worker、开发服务器的请求都不在主线程。
+
+# 开销
+
+没被选中的请求只多一次random()。采样线程取栈的时候拿着GIL，请求线程要等它，
+所以记下每次采样花的时间，采样间隔至少是 采样耗时 / PROFILER_MAX_OVERHEAD，开销不会超过这个比例。
+没有请求在被profile时采样线程不醒。
+
+数据在进程内存里，多个worker时/_profile只看得到处理这次请求的那个worker的。
+没有配置PROFILER_TOKEN时不注册/_profile。
+'''
+
+
+class Profiler:
+    def __init__(self, app=None):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # 线程id -> endpoint
+        self._active = {}
+        # endpoint -> {折叠栈: 次数}
+        self._stacks = {}
+        self._thread = None
+        self.samples = 0
+        self.sampling_time = 0.0
+        self.started = time.time()
+        # fork之后子进程里没有采样线程，锁也可能是fork时被采样线程拿着的状态，全部换新的
+        os.register_at_fork(after_in_child=self._after_fork)
+        if app is not None:
+            self.init_app(app)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._active = {}
+        self._thread = None
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILER_ENABLED', False)
+        app.config.setdefault('PROFILER_ENDPOINTS', [])
+        app.config.setdefault('PROFILER_SAMPLE_RATE', 0.01)
+        app.config.setdefault('PROFILER_INTERVAL', 0.005)
+        app.config.setdefault('PROFILER_MAX_OVERHEAD', 0.01)
+        app.config.setdefault('PROFILER_MAX_STACKS', 5000)
+        app.config.setdefault('PROFILER_TOKEN', None)
+        app.config.setdefault('PROFILER_PATH', '/_profile')
+        app.extensions['profiler'] = self
+        self.enabled = app.config['PROFILER_ENABLED']
+        self.endpoints = list(app.config['PROFILER_ENDPOINTS'])
+        self.sample_rate = app.config['PROFILER_SAMPLE_RATE']
+        self.base_interval = self.interval = app.config['PROFILER_INTERVAL']
+        self.max_overhead = app.config['PROFILER_MAX_OVERHEAD']
+        self.max_stacks = app.config['PROFILER_MAX_STACKS']
+        self.token = app.config['PROFILER_TOKEN']
+        if not self.enabled:
+            return
+
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        if self.token:
+            app.add_url_rule(app.config['PROFILER_PATH'], 'profiler', self.export)
+
+    def _selected(self, endpoint):
+        if any(fnmatch(endpoint, pattern) for pattern in self.endpoints):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _before_request(self):
+        endpoint = request.endpoint
+        if endpoint is None or endpoint == 'profiler' or not self._selected(endpoint):
+            return
+        self._ensure_thread()
+        self._active[threading.get_ident()] = endpoint
+        self._wakeup.set()
+
+    def _teardown_request(self, exc):
+        self._active.pop(threading.get_ident(), None)
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            self._wakeup.clear()
+            if not self._active:
+                self._wakeup.wait()
+                continue
+            time.sleep(self.interval)
+            start = time.perf_counter()
+            frames = sys._current_frames()
+            for ident, endpoint in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is not None and ident != own:
+                    self._record(endpoint, _collapse(frame))
+            del frames
+            cost = time.perf_counter() - start
+            with self._lock:
+                self.sampling_time += cost
+            # 采样耗时 / 间隔 <= max_overhead
+            self.interval = max(self.base_interval, cost / self.max_overhead)
+
+    def _record(self, endpoint, stack):
+        with self._lock:
+            stacks = self._stacks.setdefault(endpoint, {})
+            if stack not in stacks and len(stacks) >= self.max_stacks:
+                stack = '[truncated]'
+            stacks[stack] = stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def reset(self):
+        with self._lock:
+            self._stacks = {}
+            self.samples = 0
+            self.sampling_time = 0.0
+            self.started = time.time()
+
+    def collapsed(self, endpoint):
+        '''折叠栈的文本，一行一个"栈 次数"'''
+        with self._lock:
+            stacks = dict(self._stacks.get(endpoint, {}))
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(stacks.items()))
+
+    def summary(self):
+        with self._lock:
+            counts = {endpoint: sum(stacks.values()) for endpoint, stacks in self._stacks.items()}
+            samples, sampling_time = self.samples, self.sampling_time
+        elapsed = time.time() - self.started
+        lines = ['# pid {}, {} samples in {:.0f}s, interval {:.1f}ms, sampler busy {:.3%} of the time'.format(
+            os.getpid(), samples, elapsed, self.interval * 1000, sampling_time / elapsed if elapsed else 0)]
+        lines.extend('{} {}'.format(endpoint, count)
+                     for endpoint, count in sorted(counts.items(), key=lambda item: -item[1]))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        token = request.headers.get('X-Profiler-Token') or request.args.get('token') or ''
+        if not hmac.compare_digest(token.encode(), self.token.encode()):
+            abort(404)
+        if request.args.get('reset'):
+            self.reset()
+            return Response('reset\n', mimetype='text/plain')
+        endpoint = request.args.get('endpoint')
+        body = self.collapsed(endpoint) if endpoint else self.summary()
+        return Response(body, mimetype='text/plain')
+
+
+def _collapse(frame, max_depth=128):
+    '''从最外层到最里层，"文件:函数;文件:函数..."。从Flask的wsgi_app开始，前面服务器的栈每个请求都一样，去掉'''
+    names = []
+    while frame is not None and len(names) < max_depth:
+        code = frame.f_code
+        names.append('{}:{}'.format(_short_path(code.co_filename), code.co_name))
+        if code.co_name == 'wsgi_app' and code.co_filename.endswith(os.path.join('flask', 'app.py')):
+            break
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+_paths = {}
+
+
+def _short_path(filename):
+    '''site-packages下的显示包里的路径，项目里的显示相对路径'''
+    short = _paths.get(filename)
+    if short is None:
+        short = filename
+        for marker in ('site-packages' + os.sep, 'dist-packages' + os.sep):
+            if marker in filename:
+                short = filename.split(marker, 1)[1]
+                break
+        else:
+            root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) + os.sep
+            if filename.startswith(root):
+                short = filename[len(root):]
+        _paths[filename] = short
+    return short
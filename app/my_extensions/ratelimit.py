@@ -0,0 +1,186 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import Response, g, request, session
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+'''
+# 限流和过载保护
+
+一个客户端不停地请求/search、/user/<username>/popup、/notifications就能占满所有worker，
+所以在app的before_request里(比蓝图的before_request早，还没有加载current_user、没有写last_seen)做两件事:
+
+1. 令牌桶限流: RATELIMIT_LIMITS里的endpoint，每个(用户, endpoint)一个桶，每秒补充rate个令牌，最多burst个，
+   每个请求拿一个，拿不到就返回429和Retry-After(还要等多少秒才有令牌)。
+   用户是session里Flask-Login记的用户id(不查数据库)，没登录的按IP。
+
+2. 过载保护: 每个进程同时处理的请求数超过RATELIMIT_MAX_IN_FLIGHT时，直接返回503和Retry-After，
+   不去排队等数据库。整个服务最多同时处理 worker数 x RATELIMIT_MAX_IN_FLIGHT 个请求。
+   gunicorn的sync worker一次本来就只处理一个请求，这个只对多线程(--threads)有用。
+
+# 多进程
+
+令牌桶放在RATELIMIT_FILE这个mmap文件里，所有worker共用，限额对整个服务生效，而不是每个worker各算各的。
+文件是一个固定大小的哈希表，每个槽32字节: key的hash(uint64) + 令牌数(double) + 上次更新的时间(double)。
+槽分成RATELIMIT_STRIPES段，每段一把fcntl锁(锁文件里的一个字节，不同段的请求互不等待)，
+同一个进程里的线程之间fcntl锁不互斥，所以每段还有一把threading.Lock。
+一个key在自己那段里最多往后找8个槽，都被别的key占了就覆盖最久没更新的那个(很久没更新的桶本来就是满的)。
+
+没有配置RATELIMIT_FILE或者没有fcntl(Windows)时，令牌桶只在进程内存里。
+'''
+
+
+_SLOT = struct.Struct('Qdd8x')
+_PROBES = 8
+
+
+class _MemoryBuckets:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, allowed = _refill_and_take(tokens, updated, rate, burst, now)
+            self._buckets[key] = (tokens, now)
+        return allowed, tokens
+
+
+class _MmapBuckets:
+    def __init__(self, path, slots, stripes):
+        self._per_stripe = max(slots // stripes, _PROBES)
+        self._stripes = stripes
+        size = self._per_stripe * stripes * _SLOT.size
+        self._f = open(path, 'a+b')
+        if os.fstat(self._f.fileno()).st_size != size:
+            # 第一次用，或者改了大小: 重新建一个全空的表
+            fcntl.lockf(self._f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._f.fileno()).st_size != size:
+                    self._f.truncate(0)
+                    self._f.truncate(size)
+            finally:
+                fcntl.lockf(self._f, fcntl.LOCK_UN)
+        self._m = mmap.mmap(self._f.fileno(), size)
+        self._after_fork()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._locks = [threading.Lock() for _ in range(self._stripes)]
+
+    def take(self, key, rate, burst, now):
+        h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        stripe = h % self._stripes
+        first = stripe * self._per_stripe
+        start = (h // self._stripes) % self._per_stripe
+        with self._locks[stripe]:
+            fcntl.lockf(self._f, fcntl.LOCK_EX, 1, stripe)
+            try:
+                oldest, oldest_updated = None, None
+                for i in range(_PROBES):
+                    offset = (first + (start + i) % self._per_stripe) * _SLOT.size
+                    slot_key, tokens, updated = _SLOT.unpack_from(self._m, offset)
+                    if slot_key == h:
+                        break
+                    if slot_key == 0:
+                        tokens, updated = burst, now
+                        break
+                    if oldest is None or updated < oldest_updated:
+                        oldest, oldest_updated = offset, updated
+                else:
+                    offset, tokens, updated = oldest, burst, now
+                tokens, allowed = _refill_and_take(tokens, updated, rate, burst, now)
+                _SLOT.pack_into(self._m, offset, h, tokens, now)
+            finally:
+                fcntl.lockf(self._f, fcntl.LOCK_UN, 1, stripe)
+        return allowed, tokens
+
+
+def _refill_and_take(tokens, updated, rate, burst, now):
+    tokens = min(burst, tokens + max(now - updated, 0) * rate)
+    if tokens >= 1:
+        return tokens - 1, True
+    return tokens, False
+
+
+class RateLimiter:
+    def __init__(self, app=None):
+        self.limits = {}
+        self.max_in_flight = None
+        self.buckets = _MemoryBuckets()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        # endpoint -> (每秒多少个请求, 最多攒多少个)
+        app.config.setdefault('RATELIMIT_LIMITS', {})
+        app.config.setdefault('RATELIMIT_MAX_IN_FLIGHT', None)
+        app.config.setdefault('RATELIMIT_RETRY_AFTER', 1)
+        app.config.setdefault('RATELIMIT_FILE', None)
+        app.config.setdefault('RATELIMIT_SLOTS', 65536)
+        app.config.setdefault('RATELIMIT_STRIPES', 256)
+        app.extensions['ratelimit'] = self
+        if not app.config['RATELIMIT_ENABLED']:
+            return
+        self.limits = dict(app.config['RATELIMIT_LIMITS'])
+        self.max_in_flight = app.config['RATELIMIT_MAX_IN_FLIGHT']
+        self.retry_after = app.config['RATELIMIT_RETRY_AFTER']
+        if app.config['RATELIMIT_FILE'] and fcntl is not None:
+            self.buckets = _MmapBuckets(app.config['RATELIMIT_FILE'], app.config['RATELIMIT_SLOTS'],
+                                        app.config['RATELIMIT_STRIPES'])
+        else:
+            # 每个app自己的桶，不沿用上一个app的(测试里每个用例都create_app一次)
+            self.buckets = _MemoryBuckets()
+
+        if not hasattr(self, 'rejected'):
+            from app import metrics
+            self.rejected = metrics.counter('ratelimit_rejected_total', '被限流(429)或者过载保护(503)拒绝的请求数',
+                                            ['endpoint', 'reason'])
+        # 放在最前面，在其他before_request(包括蓝图的)之前拒绝
+        app.before_request_funcs.setdefault(None, []).insert(0, self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _before_request(self):
+        endpoint = request.endpoint
+        if endpoint is None or endpoint == 'static':
+            return
+        if self.max_in_flight:
+            with self._in_flight_lock:
+                if self._in_flight >= self.max_in_flight:
+                    return self._reject(endpoint, 'overload', 503, self.retry_after)
+                self._in_flight += 1
+            g._ratelimit_in_flight = True
+
+        limit = self.limits.get(endpoint)
+        if limit is not None:
+            rate, burst = limit
+            # Flask-Login 0.4用user_id，0.5以后用_user_id
+            identity = session.get('_user_id') or session.get('user_id') or request.remote_addr
+            allowed, tokens = self.buckets.take('{}\0{}'.format(endpoint, identity), rate, burst, time.time())
+            if not allowed:
+                return self._reject(endpoint, 'rate', 429, (1 - tokens) / rate)
+
+    def _teardown_request(self, exc):
+        if g.pop('_ratelimit_in_flight', False):
+            with self._in_flight_lock:
+                self._in_flight -= 1
+
+    def _reject(self, endpoint, reason, status, retry_after):
+        self.rejected.labels(endpoint=endpoint, reason=reason).inc()
+        body = 'Too Many Requests' if status == 429 else 'Service Unavailable'
+        return Response(body, status, {'Retry-After': str(max(int(math.ceil(retry_after)), 1))},
+                        mimetype='text/plain')
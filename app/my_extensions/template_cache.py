@@ -0,0 +1,57 @@
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+
+'''
+# 模板的字节码缓存和预热
+
+Jinja第一次用到一个模板时要解析、生成Python代码再compile，base.html、bootstrap/base.html、_post.html这些
+每个新启动的worker(部署、max-requests重启)都要编译一遍，所以重启之后的头几个请求特别慢。
+
+1. TEMPLATE_CACHE_DIR: Jinja的FileSystemBytecodeCache，编译好的字节码存在这个目录，
+   新进程直接读出来(marshal)，不用再解析和compile。模板改了(checksum不一样)或者Python版本不一样会自动重新编译。
+   构建/部署的时候执行一次 flask templates compile 把所有模板编译进去。
+
+2. warm_up(): 把所有模板(app/templates和扩展的，例如bootstrap/)都加载进Jinja的内存缓存。
+   flask serve在master里fork之前调用(见app/serve.py)，worker一启动就有编译好的模板。
+'''
+
+
+class TemplateCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TEMPLATE_CACHE_DIR', None)
+        app.config.setdefault('TEMPLATE_WARM_UP', True)
+        app.extensions['template_cache'] = self
+        directory = app.config['TEMPLATE_CACHE_DIR']
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    @staticmethod
+    def warm_up(app):
+        '''加载所有模板，返回(模板数, 用时)'''
+        start = time.perf_counter()
+        names = app.jinja_env.list_templates()
+        for name in names:
+            try:
+                app.jinja_env.get_template(name)
+            except Exception:
+                app.logger.exception('loading template {} failed'.format(name))
+        return len(names), time.perf_counter() - start
+
+    def compile(self, app, clear=False):
+        '''把所有模板编译进字节码缓存(flask templates compile)'''
+        cache = app.jinja_env.bytecode_cache
+        if cache is None:
+            raise RuntimeError('TEMPLATE_CACHE_DIR is not configured')
+        if clear:
+            cache.clear()
+        # 内存里已经加载过的模板不会再写字节码缓存，所以先清掉
+        app.jinja_env.cache.clear()
+        return self.warm_up(app)
@@ -0,0 +1,163 @@
+import multiprocessing
+import time
+
+try:
+    import numpy as np
+    import scipy.sparse as sp
+except ImportError:
+    np = sp = None
+
+'''
+    "你可能认识的人"(who to follow)离线计算，flask recommend who-to-follow 运行，结果写进follow_suggestion表。
+
+    @ 算法：朋友的朋友(friends of friends)。A是关注关系的稀疏矩阵(A[u, v] = 1表示u关注了v)，
+        (A @ A)[u, v] = u关注的人里有多少个关注了v，这就是v对u的推荐分数(overlap)。
+        去掉u自己和u已经关注了的人，每个用户取分数最高的top_k个。
+
+    @ 内存：followers表按批导出成两个int32数组再建CSR矩阵(每条边约8字节)；
+        A @ A整个算出来会很大，所以每次只算chunk_size个用户那几行(A[rows] @ A)，算完取top_k就扔掉。
+
+    @ 并行：用fork出来的进程池，子进程共享父进程里已经建好的矩阵(copy-on-write，不用pickle传过去)，
+        每个子进程算一个chunk，把(user_id, suggested_id, score)三个数组传回来，父进程写数据库。
+        一次只提交processes * 2个chunk，结果来不及写的时候不会在队列里越堆越多。
+
+    numpy和scipy是可选依赖(pip install numpy scipy)，只有这个命令需要，网站本身不需要。
+'''
+
+
+class MissingDependency(Exception):
+    pass
+
+
+# fork之前设置，子进程直接用(copy-on-write)
+_adjacency = None
+
+
+def export_adjacency(conn, batch_size=100000):
+    '''从followers表按批导出，返回scipy的CSR矩阵(行是follower，列是followed)'''
+    from sqlalchemy import func, select
+    from app.models import User, followers
+
+    max_id = conn.execute(select([func.max(User.id)])).scalar() or 0
+    rows, cols = [], []
+    result = conn.execution_options(stream_results=True).execute(
+        select([followers.c.follower_id, followers.c.followed_id]))
+    while True:
+        batch = result.fetchmany(batch_size)
+        if not batch:
+            break
+        edges = np.array(batch, dtype=np.int32)
+        rows.append(edges[:, 0])
+        cols.append(edges[:, 1])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int32)
+    adjacency = sp.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(max_id + 1, max_id + 1))
+    # followers表里可能有重复的边，重复的会被加成2
+    adjacency.data[:] = 1
+    return adjacency
+
+
+def top_candidates(adjacency, start, stop, top_k):
+    '''
+        计算用户start ~ stop-1的推荐，全部是向量化的。
+        :return: (user_ids, suggested_ids, scores)三个数组，按user_id、分数从高到低排序
+    '''
+    rows = adjacency[start:stop]
+    scores = rows @ adjacency
+    # 去掉自己和已经关注了的人: 这些位置是1的矩阵逐元素乘上去，再从分数里减掉
+    exclude = rows + sp.eye(stop - start, adjacency.shape[1], k=start, dtype=np.int32, format='csr')
+    exclude.data[:] = 1
+    scores = scores - scores.multiply(exclude)
+    scores.eliminate_zeros()
+    scores.sort_indices()
+
+    # 每一行按分数降序排(分数相同时按id升序，因为stable排序保持了CSR里列的顺序)。
+    # 排序键是 行号 * (最大分数 + 1) + (最大分数 - 分数)，一次int64的stable argsort(基数排序)，比lexsort快很多
+    counts = np.diff(scores.indptr)
+    local_rows = np.repeat(np.arange(stop - start, dtype=np.int64), counts)
+    max_score = int(scores.data.max()) if scores.nnz else 0
+    order = np.argsort(local_rows * (max_score + 1) + (max_score - scores.data), kind='stable')
+    # 排序不改变行的分组，每一行还是在indptr[i] ~ indptr[i + 1]，组内的位置就是名次
+    rank = np.arange(scores.nnz) - np.repeat(scores.indptr[:-1], counts)
+    order = order[rank < top_k]
+    return local_rows[order] + start, scores.indices[order].astype(np.int64), scores.data[order].astype(np.int64)
+
+
+def _compute_chunk(args):
+    start, stop, top_k = args
+    return start, stop, top_candidates(_adjacency, start, stop, top_k)
+
+
+def _write_chunk(conn, start, stop, result, computed_at):
+    from app.models import FollowSuggestion
+    table = FollowSuggestion.__table__
+    user_ids, suggested_ids, scores = result
+    with conn.begin():
+        conn.execute(table.delete().where(table.c.user_id >= start).where(table.c.user_id < stop))
+        if len(user_ids):
+            conn.execute(table.insert(), [
+                {'user_id': user_id, 'suggested_id': suggested_id, 'score': score, 'timestamp': computed_at}
+                for user_id, suggested_id, score in zip(user_ids.tolist(), suggested_ids.tolist(), scores.tolist())
+            ])
+
+
+def compute_who_to_follow(engine, top_k=20, chunk_size=10000, processes=None, progress=None):
+    '''
+        :param engine: SQLAlchemy engine(db.engine)
+        :param processes: 进程数，默认CPU核数；1表示不用进程池
+        :param progress: 每写完一个chunk调用一次progress(users_done, users_total, suggestions_written)
+        :return: 写入的推荐条数
+    '''
+    global _adjacency
+    from datetime import datetime
+
+    if np is None or sp is None:
+        raise MissingDependency('who-to-follow needs numpy and scipy: pip install numpy scipy')
+
+    with engine.connect() as conn:
+        _adjacency = export_adjacency(conn)
+    total_users = _adjacency.shape[0]
+    tasks = [(start, min(start + chunk_size, total_users), top_k) for start in range(0, total_users, chunk_size)]
+    processes = processes or multiprocessing.cpu_count()
+    computed_at = datetime.utcnow()
+
+    pool = None
+    if processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        # fork之前把连接池清掉，子进程不要继承父进程的数据库连接
+        engine.dispose()
+        pool = multiprocessing.get_context('fork').Pool(processes)
+    written = 0
+    try:
+        wave = max(processes * 2, 1)
+        with engine.connect() as conn:
+            for i in range(0, len(tasks), wave):
+                batch = tasks[i:i + wave]
+                results = pool.imap(_compute_chunk, batch) if pool else map(_compute_chunk, batch)
+                for start, stop, result in results:
+                    _write_chunk(conn, start, stop, result, computed_at)
+                    written += len(result[0])
+                    if progress:
+                        progress(stop, total_users, written)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        _adjacency = None
+    return written
+
+
+def print_progress(echo):
+    '''给progress参数用的，每10秒输出一次进度'''
+    started = time.monotonic()
+    state = {'last': 0.0}
+
+    def report(done, total, written):
+        now = time.monotonic()
+        if now - state['last'] < 10 and done < total:
+            return
+        state['last'] = now
+        elapsed = now - started
+        rate = done / elapsed if elapsed else 0
+        eta = (total - done) / rate if rate else 0
+        echo('{}/{} users, {} suggestions, {:.0f} users/s, eta {:.0f}s'.format(done, total, written, rate, eta))
+    return report
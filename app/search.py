@@ -1,4 +1,7 @@
 from flask import current_app
+from app import metrics
+from app.my_extensions.es_client import ElasticsearchUnavailable, CircuitOpenError
+from app.search_cache import query_cache
 
 '''
     @ Elasticsearch参考：http://www.ruanyifeng.com/blog/2017/08/elasticsearch.html
@@ -20,21 +23,53 @@ from flask import current_app
 '''
 
 
+ES_REQUEST_LATENCY = metrics.histogram('es_request_duration_seconds', 'Elasticsearch调用耗时', ['operation'])
+ES_REQUEST_FAILURES = metrics.counter('es_request_failures_total', 'Elasticsearch调用失败次数', ['operation'])
+ES_CIRCUIT_OPEN = metrics.counter('es_circuit_open_rejections_total', '熔断器打开时被直接拒绝的调用', ['operation'])
+
+
+def _call(operation, **kwargs):
+    '''
+        经过熔断器调用current_app.elasticsearch的operation方法(index/delete/search)，并记录耗时和失败次数
+        Elasticsearch不可用时抛ElasticsearchUnavailable
+    '''
+    try:
+        with ES_REQUEST_LATENCY.labels(operation=operation).time():
+            return current_app.elasticsearch.call(operation, **kwargs)
+    except CircuitOpenError:
+        ES_CIRCUIT_OPEN.labels(operation=operation).inc()
+        raise
+    except Exception:
+        ES_REQUEST_FAILURES.labels(operation=operation).inc()
+        raise
+
+
 # model是SQLALchemy的model。index和document_type都是Elasticsearch的术语，用index来命名。id需要unique，所以可以借用SQLALchemy的model的id。如果用这个方法添加elasticsearch已经拥有的条目，这个条目会被覆盖。且id这样用可以很方便地连接两个数据库(Elasticsearch是引擎，也可以算是数据库)。
-def add_to_index(index, model):
+def add_to_index(index, model, raise_errors=False):
+    '''raise_errors: 后台任务里调用时把ElasticsearchUnavailable抛出去，让任务重试'''
     if not current_app.elasticsearch:
         return
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id,
-                                    body=payload)
+    try:
+        _call('index', index=index, doc_type=index, id=model.id, body=payload)
+    except ElasticsearchUnavailable as e:
+        if raise_errors:
+            raise
+        # 数据库已经commit了，不能因为Elasticsearch挂了让请求500。漏掉的可以用reindex()补回来
+        current_app.logger.warning('add_to_index %s %s failed: %s', index, model.id, e)
 
 
-def remove_from_index(index, model):
+def remove_from_index(index, model, raise_errors=False):
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+    try:
+        _call('delete', index=index, doc_type=index, id=model.id)
+    except ElasticsearchUnavailable as e:
+        if raise_errors:
+            raise
+        current_app.logger.warning('remove_from_index %s %s failed: %s', index, model.id, e)
 
 
 def query_index(index, query, page, per_page):
@@ -43,15 +78,24 @@ def query_index(index, query, page, per_page):
     :param query: text you wanna get
     :param page: 因为没有像SQLAlchemy的Pagination对象，所以要用'from'参数去构造算法去分页
     :param per_page: 每页的items
-    :return:
+    :return: 先查缓存(见search_cache.py)。Elasticsearch不可用(超时、熔断)时降级为缓存里的旧结果或空结果
     '''
     if not current_app.elasticsearch:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index,
-        # 这些都是Elasticsearch的语法，具体看doc
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
+    key = query_cache.key(index, query, page, per_page)
+    cached = query_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = query_cache.generation(index)
+    try:
+        search = _call(
+            'search', index=index, doc_type=index,
+            # 这些都是Elasticsearch的语法，具体看doc
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page})
+    except ElasticsearchUnavailable as e:
+        current_app.logger.warning('query_index %s failed: %s', index, e)
+        return query_cache.get_stale(key) or ([], 0)
     # {
     # 	'took': 2,
     # 	'timed_out': False,
@@ -77,6 +121,7 @@ def query_index(index, query, page, per_page):
     # }
     # 列表构造式, list comprehension
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
+    query_cache.set(key, ids, search['hits']['total'], generation)
     # 返回的第一个是一个包含查询结果的列表，里面存着符合的id, 也就是SQLALChemy model的id， 。第二个是总结果数。
     return ids, search['hits']['total']
 
@@ -0,0 +1,117 @@
+import sys
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from app import metrics
+
+'''
+    /search的结果缓存: (index, 规范化后的query, page, per_page) -> (ids, total)
+
+    @ 失效：条目最多缓存SEARCH_CACHE_TTL秒，过了TTL一定不再命中。
+      每个index还有一个generation(版本号)，SearchableMixin.after_commit写索引后调用bump_generation，
+      缓存条目记下写入时的generation，generation变了就提前失效(只会让条目更早失效，不会延长TTL)。
+      SEARCH_CACHE_MAX_STALE_GENERATIONS > 0 时，允许命中落后几个版本的条目(热门查询在频繁发帖时也能命中)。
+
+    @ 容量：LRU，最多SEARCH_CACHE_MAX_ENTRIES条，超过就淘汰最久没用的。
+
+    @ 降级：Elasticsearch不可用时，query_index用get_stale拿缓存里的旧结果(不管generation)，没有才返回空结果。
+
+    generation是进程内的，多个worker时别的worker的写入不会让本进程的缓存失效；
+    JOBS_ENABLED时bump_generation在后台任务写Elasticsearch之前，紧接着的查询可能把旧结果缓存成新版本。这两种都靠TTL兜底。
+'''
+
+CACHE_ENTRIES = metrics.gauge('search_cache_entries', '搜索缓存的条目数')
+CACHE_BYTES = metrics.gauge('search_cache_bytes', '搜索缓存大约占用的内存(字节)')
+
+
+def normalize_query(query):
+    '''大小写、多余空格不同的查询算同一个'''
+    return ' '.join(query.lower().split())
+
+
+def _entry_size(key, ids):
+    return sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key) + \
+        sys.getsizeof(ids) + 28 * len(ids)
+
+
+class QueryCache:
+    def __init__(self, max_entries=10000, ttl=300, max_stale_generations=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_stale_generations = max_stale_generations
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        self.max_entries = config['SEARCH_CACHE_MAX_ENTRIES']
+        self.ttl = config['SEARCH_CACHE_TTL']
+        self.max_stale_generations = config['SEARCH_CACHE_MAX_STALE_GENERATIONS']
+
+    @staticmethod
+    def key(index, query, page, per_page):
+        return index, normalize_query(query), page, per_page
+
+    def generation(self, index):
+        return self._generations.get(index, 0)
+
+    def bump_generation(self, index):
+        with self._lock:
+            self._generations[index] = self._generations.get(index, 0) + 1
+
+    def get(self, key):
+        '''命中返回(ids, total)，否则返回None'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                generation, expires_at, ids, total = entry
+                current = self._generations.get(key[0], 0)
+                expired = monotonic() >= expires_at
+                if not expired and current - generation <= self.max_stale_generations:
+                    self._entries.move_to_end(key)
+                    metrics.cache_requests.labels(cache='search', result='hit').inc()
+                    return list(ids), total
+                if expired:
+                    self._remove(key)
+        metrics.cache_requests.labels(cache='search', result='miss').inc()
+        return None
+
+    def get_stale(self, key):
+        '''不管generation和TTL，有就返回，用于Elasticsearch不可用时降级'''
+        with self._lock:
+            entry = self._entries.get(key)
+        return (list(entry[2]), entry[3]) if entry is not None else None
+
+    def set(self, key, ids, total, generation):
+        '''generation要用查询之前取的值，避免查询期间有写入时把旧结果标成新版本'''
+        if self.max_entries <= 0:
+            return
+        ids = tuple(ids)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (generation, monotonic() + self.ttl, ids, total)
+            self._bytes += _entry_size(key, ids)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            CACHE_ENTRIES.set(len(self._entries))
+            CACHE_BYTES.set(self._bytes)
+
+    def _remove(self, key):
+        _, _, ids, _ = self._entries.pop(key)
+        self._bytes -= _entry_size(key, ids)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            CACHE_ENTRIES.set(0)
+            CACHE_BYTES.set(0)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self._bytes, 'generations': dict(self._generations)}
+
+
+query_cache = QueryCache()
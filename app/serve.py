@@ -0,0 +1,85 @@
+import multiprocessing
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+'''
+    生产环境的web服务(flask serve)，用gunicorn的prefork模型。app.run()是Werkzeug的开发服务器，只有一个进程。
+
+    @ preload: master进程里先create_app、import所有模块、加载所有模板和关注关系图(graph.py)，再fork出worker，
+      这些内存是copy-on-write共享的，worker启动也快。
+      自动补全的前缀索引(suggest.py)不在master里建: 它没有变更日志可以追，
+      master里的快照会一直停在启动的时候，所以还是每个worker第一次请求时自己建。
+
+    @ fork之后(post_fork): 数据库连接池和Elasticsearch客户端都不能和master共用socket，丢掉重新建。
+      关注关系图靠FollowChange追上master加载之后的变更；如果这些记录已经被flask graph prune删了，就重新加载。
+
+    @ --max-requests: 每个worker处理这么多请求之后退出，master再fork一个新的，内存不会一直涨。
+      加上随机的jitter，worker不会同时重启。
+
+    @ kill -HUP <master pid>: 平滑重启worker，先起新的worker，老的worker处理完手上的请求再退出(--graceful-timeout)，
+      不会断开正在处理的请求。新worker还是从master fork的，所以代码不会更新；
+      发布新代码要kill -USR2 <master pid>(用同样的命令启动新的master)，新的起来之后再kill -TERM老的master。
+
+    gunicorn不支持Windows，只有这个命令需要它，所以在用到的时候才检查有没有装。
+'''
+
+
+class MissingDependency(Exception):
+    pass
+
+
+def default_workers():
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def warm_up(app):
+    '''在master里fork之前做，worker共享结果'''
+    from app import graph, template_cache
+    if app.config['TEMPLATE_WARM_UP']:
+        count, elapsed = template_cache.warm_up(app)
+        app.logger.info('loaded {} templates in {:.0f}ms'.format(count, elapsed * 1000))
+    if app.config['SOCIAL_GRAPH_ENABLED']:
+        graph.load_social_graph(app)
+
+
+def post_fork(app):
+    '''在每个worker里fork之后马上做'''
+    from app import db, graph
+    with app.app_context():
+        db.get_engine(app).dispose()
+    if app.elasticsearch is not None:
+        app.elasticsearch.reset()
+    if graph.social_graph.ready and graph.changes_pruned(app):
+        graph.start_loading(app)
+
+
+def serve(app, bind='127.0.0.1:8000', workers=None, threads=1, max_requests=0, max_requests_jitter=0,
+          timeout=30, graceful_timeout=30):
+    if BaseApplication is None:
+        raise MissingDependency('flask serve needs gunicorn: pip install gunicorn==22.0.0')
+
+    options = {
+        'bind': bind,
+        'workers': workers or default_workers(),
+        'threads': threads,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests_jitter,
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'preload_app': True,
+        'post_fork': lambda server, worker: post_fork(app),
+    }
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            warm_up(app)
+            return app
+
+    Application().run()
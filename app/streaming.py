@@ -0,0 +1,107 @@
+from flask import Response, current_app, g, get_flashed_messages, render_template, stream_with_context
+from markupsafe import Markup, escape
+
+'''
+    流式渲染(STREAM_TEMPLATES=True时): 先把<head>和导航栏发给浏览器，浏览器可以先去加载css/js，
+    同时服务器再去查post列表、渲染剩下的部分。
+
+    @ Deferred: 把分页查询包起来，推迟到模板真的用到posts/next_url/prev_url时才执行。
+      不包的话，在视图函数里就已经查完了，流式也就没有意义了。
+
+    @ 在哪里flush：Jinja的template.stream()每个输出节点产生一小段字符串，一段一段地发送太碎(gzip也压不好)，
+      所以攒起来，遇到模板里的{{ stream_flush() }}(base.html里在导航栏之后)或者攒够STREAM_BUFFER_SIZE时才发送。
+
+    @ 代价：响应头(状态码)在渲染前就发出去了，渲染中途出错没法再变成500页面。所以只在列表页(index/explore)用。
+
+    @ session: Set-Cookie也在渲染前就发出去了，模板里再改session(例如get_flashed_messages取出flash)不会保存，
+      同一条flash每次都会显示。所以flash在创建Response之前取出来，作为flashed_messages传给模板(base.html)。
+'''
+
+_FLUSH_MARKER = '<!--flush-->'
+
+
+class Deferred:
+    '''第一次使用时才调用fn，结果缓存起来。可以迭代、判断真假、转成字符串'''
+
+    def __init__(self, fn):
+        self._fn = fn
+        self._evaluated = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self._evaluated:
+            self._value = self._fn()
+            self._evaluated = True
+        return self._value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __html__(self):
+        return escape(self.value)
+
+
+def deferred_page(paginate, url_for_page):
+    '''
+        返回posts, next_url, prev_url三个Deferred，它们共用一次paginate()
+        :param paginate: 无参数的函数，返回Flask-SQLAlchemy的Pagination
+        :param url_for_page: 参数是页码，返回那一页的URL
+    '''
+    page = Deferred(paginate)
+    posts = Deferred(lambda: page.value.items)
+    next_url = Deferred(lambda: url_for_page(page.value.next_num) if page.value.has_next else None)
+    prev_url = Deferred(lambda: url_for_page(page.value.prev_num) if page.value.has_prev else None)
+    return posts, next_url, prev_url
+
+
+def stream_flush():
+    '''模板里的{{ stream_flush() }}，不是流式渲染时什么都不输出'''
+    return Markup(_FLUSH_MARKER) if g.get('_streaming') else ''
+
+
+def _buffered(chunks, buffer_size):
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        # Jinja产生的可能是Markup，Markup和str相加会把str转义，先转成普通的str
+        chunk = str(chunk)
+        # flush标记本身(一个HTML注释)也发出去，无害
+        if _FLUSH_MARKER in chunk:
+            head, tail = chunk.rsplit(_FLUSH_MARKER, 1)
+            buffer.append(head + _FLUSH_MARKER)
+            yield ''.join(buffer)
+            buffer, size = [tail], len(tail)
+            continue
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def render_page(template_name, **context):
+    '''配置了STREAM_TEMPLATES时流式渲染，否则就是render_template'''
+    app = current_app._get_current_object()
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+
+    context['flashed_messages'] = get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    def generate():
+        # stream_with_context保证了生成器里还在这个请求的context里，g是这个请求的
+        g._streaming = True
+        for chunk in _buffered(template.generate(context), app.config['STREAM_BUFFER_SIZE']):
+            yield chunk
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
@@ -0,0 +1,185 @@
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import inspect as sa_inspect
+
+from app import metrics
+
+'''
+    搜索框的自动补全(search-as-you-type): 输入前缀，返回标题以它开头的post和用户名以它开头的用户。
+
+    @ 数据结构：一个排好序的list，每个条目是一个字符串 "规范化的文本\\0kind\\0id\\0原文"，
+      查前缀就是bisect找到第一个 >= prefix 的位置，然后往后扫到不再以prefix开头为止，O(log n + k)，
+      不查数据库也不查Elasticsearch。100万条标题也是微秒级(见benchmarks/suggest.py)。
+
+    @ 更新：启动后第一个请求之前在后台线程里从数据库批量加载(加载完之前返回空结果)，
+      之后SearchableMixin.after_commit把新增/修改/删除的Post和User同步进来(insort)。
+      多个worker时每个进程各有一份，别的进程的写入要等到重启才看得到。
+
+    @ 内存：最多SUGGEST_MAX_ENTRIES条。满了之后新的条目不再加入(计数见suggest_index_dropped_total)。
+      加载时先加载用户，再从新到旧加载post，所以满了丢掉的是最旧的post。
+'''
+
+SUGGEST_ENTRIES = metrics.gauge('suggest_index_entries', '自动补全索引的条目数')
+SUGGEST_DROPPED = metrics.counter('suggest_index_dropped_total', '自动补全索引满了而没有加入的条目数')
+
+_SEP = '\0'
+
+
+def normalize(text):
+    return ' '.join(text.lower().split()).replace(_SEP, '')
+
+
+class PrefixIndex:
+    def __init__(self, max_entries=1000000):
+        self.max_entries = max_entries
+        self.ready = False
+        self._entries = []
+        # kind -> {id: entry}, 删除/修改时用来找到旧的条目
+        self._by_id = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _entry(kind, id, text):
+        return _SEP.join((normalize(text), kind, str(id), text.replace(_SEP, '')))
+
+    def build(self, items):
+        '''items: 可迭代的(kind, id, text)。一次性排序，比一条条insort快得多'''
+        entries = []
+        by_id = {}
+        for kind, id, text in items:
+            if not text:
+                continue
+            if len(entries) >= self.max_entries:
+                SUGGEST_DROPPED.inc()
+                continue
+            entry = self._entry(kind, id, text)
+            entries.append(entry)
+            by_id.setdefault(kind, {})[id] = entry
+        entries.sort()
+        with self._lock:
+            self._entries = entries
+            self._by_id = by_id
+            self.ready = True
+        SUGGEST_ENTRIES.set(len(entries))
+
+    def add(self, kind, id, text):
+        '''新增或修改(同一个kind和id只保留最新的文本)'''
+        with self._lock:
+            entry = self._entry(kind, id, text) if text else None
+            if entry is not None and self._by_id.get(kind, {}).get(id) == entry:
+                return
+            self._remove(kind, id)
+            if entry is None:
+                return
+            if len(self._entries) >= self.max_entries:
+                SUGGEST_DROPPED.inc()
+                return
+            insort(self._entries, entry)
+            self._by_id.setdefault(kind, {})[id] = entry
+        SUGGEST_ENTRIES.set(len(self._entries))
+
+    def remove(self, kind, id):
+        with self._lock:
+            self._remove(kind, id)
+        SUGGEST_ENTRIES.set(len(self._entries))
+
+    def _remove(self, kind, id):
+        entry = self._by_id.get(kind, {}).pop(id, None)
+        if entry is None:
+            return
+        i = bisect_left(self._entries, entry)
+        if i < len(self._entries) and self._entries[i] == entry:
+            del self._entries[i]
+
+    def search(self, prefix, limit=10, kind=None):
+        '''返回[(kind, id, text)]，按规范化后的文本排序'''
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        entries = self._entries
+        results = []
+        i = bisect_left(entries, prefix)
+        while i < len(entries) and len(results) < limit:
+            entry = entries[i]
+            if not entry.startswith(prefix):
+                break
+            _, entry_kind, id, text = entry.split(_SEP, 3)
+            if kind is None or entry_kind == kind:
+                results.append((entry_kind, int(id), text))
+            i += 1
+        return results
+
+
+suggest_index = PrefixIndex()
+
+
+def _load_items(batch_size=10000):
+    '''先用户，再从新到旧的post'''
+    from app.models import User, Post
+    from app import db
+    for id, username in db.session.query(User.id, User.username).yield_per(batch_size):
+        yield 'user', id, username
+    for id, title in db.session.query(Post.id, Post.title).order_by(Post.id.desc()).yield_per(batch_size):
+        yield 'post', id, title
+
+
+def build_suggest_index(app):
+    with app.app_context():
+        suggest_index.max_entries = app.config['SUGGEST_MAX_ENTRIES']
+        try:
+            suggest_index.build(_load_items())
+        except Exception:
+            app.logger.exception('building suggest index failed')
+        finally:
+            from app import db
+            db.session.remove()
+
+
+def start_building(app):
+    '''在后台线程里加载，不阻塞请求'''
+    thread = threading.Thread(target=build_suggest_index, args=(app,), name='suggest-index-build', daemon=True)
+    thread.start()
+    return thread
+
+
+def collect_changes(session):
+    '''
+        在before_commit里调用。只收集新增、删除，以及title/username真的改了的Post和User
+        (before_request每次都会改current_user.last_seen，不能每个请求都去更新索引)
+    '''
+    changes = []
+    for obj in session.new:
+        if _text_field(obj):
+            changes.append(('add', obj))
+    for obj in session.dirty:
+        field = _text_field(obj)
+        if field and sa_inspect(obj).attrs[field].history.has_changes():
+            changes.append(('add', obj))
+    for obj in session.deleted:
+        if _text_field(obj):
+            changes.append(('delete', obj))
+    return changes
+
+
+def apply_changes(changes):
+    '''在after_commit里调用，这时新对象已经有id了'''
+    if not suggest_index.ready:
+        return
+    for action, obj in changes:
+        field = _text_field(obj)
+        if action == 'add':
+            suggest_index.add(obj.__tablename__, obj.id, getattr(obj, field))
+        else:
+            suggest_index.remove(obj.__tablename__, obj.id)
+
+
+def _text_field(obj):
+    return _TEXT_FIELDS.get(getattr(obj, '__tablename__', None))
+
+
+# kind(也就是表名) -> 用来补全的字段
+_TEXT_FIELDS = {'post': 'title', 'user': 'username'}
@@ -0,0 +1,52 @@
+import time
+
+from app import jobs
+
+'''
+    后台任务(见my_extensions/jobs.py)。参数只传id，执行时再从数据库读最新的状态，所以重复执行、晚一点执行都没关系。
+'''
+
+
+@jobs.job()
+def update_unread_message_count(user_id):
+    '''重新计算用户的未读私信数，写进提醒(导航栏的数字)'''
+    from app import db
+    from app.models import User
+    user = User.query.get(user_id)
+    if user is None:
+        return
+    user.add_notification('unread_message_count', user.new_messages_num())
+    db.session.commit()
+
+
+# 粉丝多的时候要发很久，没开JOBS_ENABLED时也不能在请求里同步执行
+@jobs.job(background=True)
+def broadcast_message(broadcast_id):
+    '''群发私信给所有粉丝(见broadcast.py)，失败重试时从上次发到的粉丝接着发'''
+    from flask import current_app
+    from app import db
+    from app.broadcast import send_broadcast
+    started = time.monotonic()
+    sent = send_broadcast(db.engine, broadcast_id, chunk_size=current_app.config['BROADCAST_CHUNK_SIZE'],
+                          progress=lambda done, total, rate: current_app.logger.debug(
+                              'broadcast %s: %s/%s, %.0f messages/s', broadcast_id, done, total, rate))
+    elapsed = time.monotonic() - started
+    current_app.logger.info('broadcast %s: sent %s messages in %.1fs (%.0f messages/s)',
+                            broadcast_id, sent, elapsed, sent / elapsed if elapsed else 0)
+
+
+@jobs.job(max_attempts=10)
+def sync_search_index(index, id):
+    '''把数据库里的最新内容写进Elasticsearch，数据库里已经没有了就从索引里删掉'''
+    from elasticsearch import NotFoundError
+    from app.models import SearchableMixin
+    from app.search import add_to_index, remove_from_index
+    model = {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}[index]
+    obj = model.query.filter_by(id=id).first()
+    if obj is not None:
+        add_to_index(index, obj, raise_errors=True)
+        return
+    try:
+        remove_from_index(index, model(id=id), raise_errors=True)
+    except NotFoundError:
+        pass
@@ -0,0 +1,86 @@
+'''
+    冷热分离(app/archive.py)的benchmark: 归档前后post表和索引的大小、各页面的延迟。
+
+        python benchmarks/archive.py
+        python benchmarks/archive.py --posts 1000000 --hot-fraction 0.05
+
+    seed.py产生的帖子按分钟一个往前排，归档最旧的(1 - hot-fraction)。
+    表和索引的大小来自SQLite的dbstat虚拟表(编译时没打开SQLITE_ENABLE_DBSTAT_VTAB就只显示数据库文件大小)。
+'''
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from seed import create_benchmark_app, login, seed
+
+TABLES = ('post', 'post_archive', 'ix_post_timestamp', 'ix_post_title', 'ix_post_archive_user_id_timestamp')
+
+
+def sizes(app):
+    from app import db
+    with app.app_context():
+        try:
+            rows = db.session.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name').fetchall()
+        except Exception:
+            return None
+    return dict(rows)
+
+
+def measure(client, url, requests):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get(url)
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200, (url, response.status_code)
+    return statistics.median(samples) * 1000
+
+
+def report(app, client, urls, requests, path):
+    import os
+    table_sizes = sizes(app)
+    if table_sizes is None:
+        print('  database file {:.1f} MB'.format(os.path.getsize(path) / 1e6))
+    else:
+        for name in TABLES:
+            print('  {:<36} {:>10.1f} KB'.format(name, table_sizes.get(name, 0) / 1024))
+    for url in urls:
+        print('  {:<36} {:>10.2f} ms'.format(url, measure(client, url, requests)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--hot-fraction', type=float, default=0.1)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    app, path = create_benchmark_app()
+    seed(app, users=args.users, posts=args.posts)
+    client = login(app.test_client())
+    per_page = app.config['POSTS_PER_PAGE']
+    # user1大约有posts / users个帖子，取最后一页附近(归档后在归档表里)
+    deep_page = max(args.posts // args.users // per_page - 1, 1)
+    urls = ['/', '/explore', '/user/user1/', '/user/user1/?page={}'.format(deep_page)]
+
+    print('before archiving ({} posts)'.format(args.posts))
+    report(app, client, urls, args.requests, path)
+
+    from app import db
+    from app.archive import archive_posts
+    cutoff = datetime.utcnow() - timedelta(minutes=int(args.posts * args.hot_fraction))
+    with app.app_context():
+        start = time.perf_counter()
+        archived = archive_posts(db.engine, cutoff, batch_size=5000)
+        elapsed = time.perf_counter() - start
+        db.session.execute('VACUUM')
+    print('archived {} posts in {:.1f}s ({:.0f} rows/s)'.format(archived, elapsed, archived / elapsed))
+
+    print('after archiving')
+    report(app, client, urls, args.requests, path)
+
+
+if __name__ == '__main__':
+    main()
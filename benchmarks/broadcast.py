@@ -0,0 +1,83 @@
+'''
+    群发私信(app/broadcast.py)的benchmark: 一个用户有很多粉丝时，群发的总用时和每秒发出的私信数，
+    和按send_message的方式一条条发(ORM对象 + new_messages_num() + add_notification + commit)对比。
+
+        python benchmarks/broadcast.py
+        python benchmarks/broadcast.py --followers 50000 --chunk-size 2000
+
+    一条条发太慢，只发--baseline个粉丝，再按速度估算全部发完的时间。
+'''
+import argparse
+import time
+
+from seed import create_benchmark_app, seed
+
+
+def add_followers(app, followed_id, followers_count):
+    from app import db
+    from app.models import followers
+    with app.app_context():
+        db.session.execute(followers.delete().where(followers.c.followed_id == followed_id))
+        db.session.execute(followers.insert(), [
+            {'follower_id': id, 'followed_id': followed_id}
+            for id in range(1, followers_count + 2) if id != followed_id
+        ])
+        db.session.commit()
+
+
+def one_by_one(app, sender_id, limit):
+    '''send_message原来的做法，返回每秒私信数'''
+    from app import db
+    from app.models import User, Message
+    with app.app_context():
+        sender = User.query.get(sender_id)
+        recipients = sender.followers.order_by(User.id).limit(limit).all()
+        start = time.perf_counter()
+        for user in recipients:
+            db.session.add(Message(author=sender, recipient=user, body='one by one'))
+            db.session.commit()
+            user.add_notification('unread_message_count', user.new_messages_num())
+            db.session.commit()
+        elapsed = time.perf_counter() - start
+    return len(recipients) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--followers', type=int, default=50000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--baseline', type=int, default=500)
+    args = parser.parse_args()
+
+    app, path = create_benchmark_app()
+    seed(app, users=args.followers + 1, posts=0, follows_per_user=0)
+    add_followers(app, 1, args.followers)
+
+    rate = one_by_one(app, 1, args.baseline)
+    print('one by one: {:.0f} messages/s, {:.0f}s for {} followers (estimated)'.format(
+        rate, args.followers / rate, args.followers))
+
+    from app import db
+    from app.broadcast import send_broadcast
+    from app.models import Broadcast, User
+    with app.app_context():
+        broadcast = Broadcast(sender=User.query.get(1), body='broadcast', recipients_total=args.followers)
+        db.session.add(broadcast)
+        db.session.commit()
+        state = {'last': 0.0}
+
+        def report(done, total, rate):
+            now = time.monotonic()
+            if now - state['last'] >= 2 or done >= total:
+                state['last'] = now
+                print('  {}/{} followers, {:.0f} messages/s'.format(done, total, rate))
+
+        start = time.perf_counter()
+        sent = send_broadcast(db.engine, broadcast.id, chunk_size=args.chunk_size, progress=report)
+        elapsed = time.perf_counter() - start
+    print('broadcast:  {:.0f} messages/s, {:.1f}s for {} followers (chunk size {})'.format(
+        sent / elapsed, elapsed, sent, args.chunk_size))
+
+
+if __name__ == '__main__':
+    main()
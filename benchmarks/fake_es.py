@@ -0,0 +1,154 @@
+'''
+    本地的假Elasticsearch，只实现了search.py用到的三个接口(index/delete/_search)，可以注入延迟和错误，
+    用来在没有Elasticsearch的机器上检查超时、熔断和降级，也给load test用。
+
+        python benchmarks/fake_es.py --port 9201 --latency 0.5 --error-rate 0.3
+        export ELASTICSEARCH_URL=http://localhost:9201
+
+    也可以在代码里用: server = start_fake_es(port=0, latency=0.1); server.server_port; server.shutdown()
+'''
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class FakeElasticsearchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, error_status=503):
+        HTTPServer.__init__(self, address, _Handler)
+        # 这几个属性可以在运行时修改，例如测试时先正常，再让它变慢
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.documents = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    _doc_path = re.compile(r'^/([^/]+)/([^/]+)/([^/_][^/]*)$')
+    _search_path = re.compile(r'^/([^/]+)/(?:[^/]+/)?_search')
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+
+    def _inject(self):
+        '''按配置sleep，按概率返回错误。返回True表示已经返回了错误'''
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            self._body()
+            self._send(server.error_status, {'error': 'injected failure', 'status': server.error_status})
+            return True
+        return False
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        if self._inject():
+            return
+        match = self._doc_path.match(self.path.split('?')[0])
+        if not match:
+            return self._send(400, {'error': 'unsupported path'})
+        index, _, doc_id = match.groups()
+        with self.server.lock:
+            self.server.documents.setdefault(index, {})[doc_id] = self._body()
+        self._send(201, {'_index': index, '_id': doc_id, 'result': 'created'})
+
+    def do_DELETE(self):
+        if self._inject():
+            return
+        match = self._doc_path.match(self.path.split('?')[0])
+        if not match:
+            return self._send(400, {'error': 'unsupported path'})
+        index, _, doc_id = match.groups()
+        with self.server.lock:
+            found = self.server.documents.get(index, {}).pop(doc_id, None)
+        if found is None:
+            return self._send(404, {'_index': index, '_id': doc_id, 'result': 'not_found'})
+        self._send(200, {'_index': index, '_id': doc_id, 'result': 'deleted'})
+
+    def _search(self):
+        if self._inject():
+            return
+        match = self._search_path.match(self.path)
+        body = self._body()
+        index = match.group(1) if match else ''
+        query = body.get('query', {}).get('multi_match', {}).get('query', '').lower()
+        words = query.split()
+        with self.server.lock:
+            docs = list(self.server.documents.get(index, {}).items())
+        # 简单的"全文搜索": 任意一个词出现在任意字段里就算命中，命中的词越多分数越高
+        hits = []
+        for doc_id, source in docs:
+            text = ' '.join(str(v) for v in source.values()).lower()
+            score = sum(1 for w in words if w in text)
+            if score:
+                hits.append((score, doc_id, source))
+        hits.sort(key=lambda h: (-h[0], h[1]))
+        start, size = body.get('from', 0), body.get('size', 10)
+        self._send(200, {
+            'took': 1, 'timed_out': False,
+            'hits': {'total': len(hits), 'max_score': hits[0][0] if hits else None,
+                     'hits': [{'_index': index, '_type': index, '_id': doc_id, '_score': score, '_source': source}
+                              for score, doc_id, source in hits[start:start + size]]}})
+
+    def do_GET(self):
+        if '_search' in self.path:
+            return self._search()
+        self._send(200, {'name': 'fake-es', 'version': {'number': '6.3.0'}})
+
+    def do_POST(self):
+        if '_search' in self.path:
+            return self._search()
+        self.do_PUT()
+
+
+def start_fake_es(host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, error_status=503):
+    '''在后台线程里启动，返回server对象'''
+    server = FakeElasticsearchServer((host, port), latency, error_rate, error_status)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9201)
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求sleep多少秒')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回错误的概率(0~1)')
+    parser.add_argument('--error-status', type=int, default=503)
+    args = parser.parse_args()
+    server = FakeElasticsearchServer((args.host, args.port), args.latency, args.error_rate, args.error_status)
+    print('fake Elasticsearch listening on http://{}:{}'.format(args.host, server.server_port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
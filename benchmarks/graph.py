@@ -0,0 +1,106 @@
+'''
+    关注关系图(app/graph.py)的benchmark: 构建时间、每条边占的内存、is_following/计数的延迟。
+
+        python benchmarks/graph.py                          # 默认1000万条边
+        python benchmarks/graph.py --edges 100000000 --users 5000000
+
+    1亿条边时两个方向的CSR大约800MB(每条边4字节x2)，构建要几分钟(纯Python逐条append)，需要足够的内存。
+    延迟是每次调用前后各取一次perf_counter_ns，本身会多算几十纳秒。
+    对比项是同样的边放进Python的set，只用1%的样本估算每条边的字节数(整个放进去内存不够)。
+'''
+import argparse
+import random
+import sys
+import time
+
+from seed import ROOT  # noqa: F401 (把项目根目录加到sys.path)
+
+from app.graph import FollowGraph
+
+
+def generate_edges(users, edges, rng):
+    '''按(follower, followed)排好序地产生边，每个用户关注的人数服从指数分布，平均edges / users'''
+    average = edges / users
+    produced = 0
+    for follower in range(1, users + 1):
+        degree = min(users - 1, edges - produced, int(rng.expovariate(1 / average)))
+        followed = [user for user in rng.sample(range(1, users + 1), degree + 1) if user != follower][:degree]
+        for user in sorted(followed):
+            yield follower, user
+        produced += degree
+        if produced >= edges:
+            break
+
+
+def set_bytes_per_edge(users, sample_edges, rng):
+    edges = set()
+    for _ in range(sample_edges):
+        edges.add((rng.randint(1, users), rng.randint(1, users)))
+    size = sys.getsizeof(edges) + sum(sys.getsizeof(edge) for edge in edges)
+    # 元组里的int是小整数缓存以外的对象，也算上
+    size += sum(sys.getsizeof(a) + sys.getsizeof(b) for a, b in edges)
+    return size / len(edges)
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def time_calls(fn, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter_ns()
+        fn(*args)
+        samples.append(time.perf_counter_ns() - start)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--edges', type=int, default=10000000)
+    parser.add_argument('--lookups', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    graph = FollowGraph()
+    start = time.perf_counter()
+    graph.load(generate_edges(args.users, args.edges, rng), args.users, 0)
+    build = time.perf_counter() - start
+    edges = len(graph._out.neighbors)
+    print('users {}, edges {}, build {:.1f}s'.format(args.users, edges, build))
+    print('CSR {:.1f} MB, {:.2f} bytes/edge (both directions, offsets included)'.format(
+        graph.nbytes / 1e6, graph.nbytes / max(edges, 1)))
+    print('python set of tuples (estimated): {:.1f} bytes/edge, one direction only'.format(
+        set_bytes_per_edge(args.users, max(edges // 100, 1000), rng)))
+
+    pairs = [(rng.randint(1, args.users), rng.randint(1, args.users)) for _ in range(args.lookups)]
+    # 一半查询是真的存在的边
+    for i in range(0, len(pairs), 2):
+        follower = pairs[i][0]
+        followed = graph.followed_ids(follower)
+        if followed:
+            pairs[i] = (follower, rng.choice(followed))
+    users = [(a,) for a, _ in pairs]
+    for name, fn, call_args in (
+            ('is_following', graph.is_following, pairs),
+            ('follower_count', graph.follower_count, users),
+            ('followed_count', graph.followed_count, users)):
+        p50, p99 = time_calls(fn, call_args)
+        print('{:<16} p50 {:>6} ns   p99 {:>6} ns'.format(name, p50, p99))
+
+    # overlay里有变更时的查询和compact
+    for follower, followed in pairs[:args.lookups // 10]:
+        graph.apply(follower, followed, not graph.is_following(follower, followed))
+    p50, p99 = time_calls(graph.is_following, pairs)
+    print('{:<16} p50 {:>6} ns   p99 {:>6} ns   (overlay {} changes)'.format(
+        'is_following', p50, p99, graph.overlay_size))
+    start = time.perf_counter()
+    graph.compact()
+    print('compact {:.1f}s'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
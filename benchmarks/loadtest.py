@@ -0,0 +1,407 @@
+'''
+    多进程闭环(closed-loop)压测: 在本地启动app(gunicorn的flask serve，没装gunicorn就用Werkzeug的多线程服务器)，
+    数据库是seed.py生成的SQLite，搜索用fake_es.py，多个进程里的虚拟用户按会话脚本请求网站。
+
+        python benchmarks/loadtest.py
+        python benchmarks/loadtest.py --processes 4 --users 25 --duration 120 --workers 4 --threads 2
+        python benchmarks/loadtest.py --think 0.5:70,5:30 --mix browse=30,post=20,message=10
+
+    @ 会话: 每个虚拟用户登录一个seed用户，做--session-length个动作(按--mix的权重随机选)，登出，再换一个用户。
+        browse          首页翻1~3页
+        explore         explore翻1~3页
+        popup           一次/user_cards取5个用户的卡片(页面预取悬停卡片)，偶尔/user/<username>/popup
+        notifications   轮询/notifications
+        post            发帖(写post表，同步写进fake ES)
+        message         给随机用户发私信
+        search          搜索一个常见的词
+        follow          关注/取关随机用户
+    @ 闭环: 每个虚拟用户收到响应之后think一会儿再发下一个请求，所以服务变慢时请求也会变少(和真实用户一样)。
+      --think是think time的混合分布，"0.5:70,5:30"表示70%的停顿平均0.5秒、30%平均5秒(都是指数分布)，0表示不停顿。
+    @ 每--interval秒输出一行: 吞吐、延迟的p50/p95/p99、错误(5xx和连接错误)、被限流的(429/503)、
+      数据库锁竞争: 事务提交的平均耗时、超过100ms的比例和"database is locked"的次数(SQLite的写锁是整个库的，
+      写多了事务会排队等锁，超过busy timeout就报database is locked)。这些是服务端的metrics(METRICS_DIR，所有worker加起来)。
+      最后按动作输出总的统计。
+    @ 限流(app/my_extensions/ratelimit.py)默认是开着的，被限流的请求单独统计，--no-rate-limit关掉。
+'''
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+from seed import create_benchmark_app, seed
+
+DEFAULT_MIX = 'browse=30,explore=15,popup=20,notifications=15,post=5,message=5,search=5,follow=5'
+WORDS = ('flask', 'python', 'sqlite', 'search', 'hello', 'lorem', 'blog')
+
+
+# ---------------------------------------------------------------- 服务端(单独的进程)
+
+def serve(options):
+    '''--serve: 在这个进程里创建app并启动服务，options是父进程传过来的JSON'''
+    os.environ['ELASTICSEARCH_URL'] = options['es_url']
+    os.environ['METRICS_DIR'] = options['metrics_dir']
+    app, _ = create_benchmark_app(options['database'])
+    from app import db, metrics, ratelimiter
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    if not options['rate_limit']:
+        ratelimiter.limits = {}
+
+    commit_time = metrics.histogram('loadtest_commit_seconds', '事务提交(flush + COMMIT)的耗时，包括等SQLite写锁的时间')
+    locked = metrics.counter('loadtest_db_locked_total', '"database is locked"错误的次数')
+
+    @event.listens_for(db.session, 'before_commit')
+    def before_commit(session):
+        session.info['loadtest_commit_start'] = time.perf_counter()
+
+    @event.listens_for(db.session, 'after_commit')
+    def after_commit(session):
+        start = session.info.pop('loadtest_commit_start', None)
+        if start is not None:
+            commit_time.observe(time.perf_counter() - start)
+
+    @event.listens_for(db.session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop('loadtest_commit_start', None)
+
+    @event.listens_for(Engine, 'handle_error')
+    def handle_error(context):
+        if 'database is locked' in str(context.original_exception):
+            locked.inc()
+
+    host, port = '127.0.0.1', options['port']
+    if options['server'] == 'gunicorn':
+        from app.serve import serve as gunicorn_serve
+        gunicorn_serve(app, bind='{}:{}'.format(host, port), workers=options['workers'],
+                       threads=options['threads'], max_requests=0)
+    else:
+        from werkzeug.serving import make_server
+        make_server(host, port, app, threaded=True).serve_forever()
+
+
+def start_server(args, database, es_url, metrics_dir):
+    options = {'database': database, 'port': args.port, 'server': args.server, 'workers': args.workers,
+               'threads': args.threads, 'es_url': es_url, 'metrics_dir': metrics_dir,
+               'rate_limit': not args.no_rate_limit}
+    # 日志(logs/)写在临时目录里
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', json.dumps(options)],
+                            cwd=metrics_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for_server(base, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base + '/login/', timeout=2).read()
+            return
+        except (OSError, urllib.error.URLError):
+            time.sleep(0.5)
+    raise RuntimeError('server did not start')
+
+
+def scrape(base):
+    '''从/metrics取(提交次数, 提交总耗时, 超过100ms的提交次数, database is locked次数)'''
+    text = urllib.request.urlopen(base + '/metrics', timeout=10).read().decode()
+
+    def value(pattern):
+        match = re.search('^' + pattern + r' (\S+)$', text, re.M)
+        return float(match.group(1)) if match else 0.0
+    count = value('loadtest_commit_seconds_count')
+    return (count, value('loadtest_commit_seconds_sum'),
+            count - value(r'loadtest_commit_seconds_bucket\{le="0\.1"\}'), value('loadtest_db_locked_total'))
+
+
+# ---------------------------------------------------------------- 客户端
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    '''不跟随重定向，302本身就算一个成功的请求'''
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class VirtualUser:
+    def __init__(self, base, users, think, mix, session_length, record, rng, deadline):
+        self.base = base
+        self.deadline = deadline
+        self.users = users
+        self.think_mix = think
+        self.actions = [name for name, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.session_length = session_length
+        self.record = record
+        self.rng = rng
+        self.opener = None
+        self.since = 0.0
+
+    def request(self, action, path, data=None):
+        if time.monotonic() >= self.deadline:
+            return None, b''
+        start = time.perf_counter()
+        status = 0
+        body = b''
+        try:
+            response = self.opener.open(self.base + path, urllib.parse.urlencode(data).encode() if data else None,
+                                        timeout=60)
+            body = response.read()
+            status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except Exception:
+            status = 0
+        self.record(action, status, time.perf_counter() - start, time.monotonic())
+        return status, body
+
+    def think(self):
+        mean = self.rng.choices([mean for mean, _ in self.think_mix], [weight for _, weight in self.think_mix])[0]
+        if mean > 0:
+            time.sleep(max(min(self.rng.expovariate(1 / mean), self.deadline - time.monotonic()), 0))
+
+    def other_user(self):
+        return 'user{}'.format(self.rng.randint(1, self.users))
+
+    def session(self):
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect())
+        self.since = 0.0
+        username = self.other_user()
+        self.request('login', '/login/', {'username': username, 'password': 'x'})
+        for _ in range(self.session_length):
+            if time.monotonic() >= self.deadline:
+                return
+            self.think()
+            getattr(self, 'do_' + self.rng.choices(self.actions, self.weights)[0])()
+        self.request('logout', '/logout/')
+
+    def do_browse(self):
+        for page in range(1, self.rng.randint(1, 3) + 1):
+            if page > 1:
+                self.think()
+            self.request('browse', '/index/?page={}'.format(page))
+
+    def do_explore(self):
+        for page in range(1, self.rng.randint(1, 3) + 1):
+            if page > 1:
+                self.think()
+            self.request('explore', '/explore?page={}'.format(page))
+
+    def do_popup(self):
+        if self.rng.random() < 0.2:
+            self.request('popup', '/user/{}/popup'.format(self.other_user()))
+        else:
+            self.request('popup', '/user_cards?' + urllib.parse.urlencode(
+                [('u', self.other_user()) for _ in range(5)]))
+
+    def do_notifications(self):
+        status, body = self.request('notifications', '/notifications?since={}'.format(self.since))
+        if status == 200:
+            notifications = json.loads(body.decode())
+            if notifications:
+                self.since = notifications[-1]['timestamp']
+
+    def do_post(self):
+        words = ' '.join(self.rng.choice(WORDS) for _ in range(12))
+        self.request('post', '/index/', {'title': 'load test {}'.format(self.rng.choice(WORDS)), 'body': words})
+
+    def do_message(self):
+        self.request('message', '/send_messages/{}'.format(self.other_user()), {'message': 'hello from load test'})
+
+    def do_search(self):
+        self.request('search', '/search?q={}'.format(self.rng.choice(WORDS)))
+
+    def do_follow(self):
+        action = 'follow' if self.rng.random() < 0.7 else 'unfollow'
+        self.request('follow', '/{}/{}'.format(action, self.other_user()))
+
+
+def client_process(index, args, base, mix, think, deadline, queue):
+    '''一个客户端进程: args.users个虚拟用户线程，每秒把新的记录(动作, 状态码, 延迟, 完成时间)发给父进程'''
+    records = []
+    lock = threading.Lock()
+
+    def record(action, status, latency, finished):
+        with lock:
+            records.append((action, status, latency, finished))
+
+    def run(seed_value):
+        rng = random.Random(seed_value)
+        user = VirtualUser(base, args.seed_users, think, mix, args.session_length, record, rng, deadline)
+        # 错开启动时间，不要所有用户同时登录
+        time.sleep(rng.random() * min(args.interval, 2))
+        while time.monotonic() < deadline:
+            user.session()
+
+    def flush():
+        with lock:
+            batch, records[:] = list(records), []
+        queue.put(batch)
+
+    threads = [threading.Thread(target=run, args=(index * 100000 + i,), daemon=True) for i in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+            flush()
+    flush()
+    queue.put(None)
+
+
+# ---------------------------------------------------------------- 统计
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(p / 100 * len(values))) - 1)]
+
+
+def classify(status):
+    if status in (429, 503):
+        return 'throttled'
+    if status == 0 or status >= 500:
+        return 'error'
+    return 'ok'
+
+
+def parse_weights(text, cast=float):
+    items = []
+    for item in text.split(','):
+        name, _, weight = item.partition('=' if '=' in item else ':')
+        items.append((cast(name), float(weight or 1)))
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=2, help='客户端进程数')
+    parser.add_argument('--users', type=int, default=10, help='每个客户端进程的虚拟用户数')
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--interval', type=float, default=5, help='每隔多少秒输出一次')
+    parser.add_argument('--think', default='1', help='think time(秒)的混合分布，例如 0.5:70,5:30')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='动作的权重')
+    parser.add_argument('--session-length', type=int, default=20, help='每次登录做多少个动作')
+    parser.add_argument('--server', choices=('gunicorn', 'werkzeug'), default=None,
+                        help='默认装了gunicorn就用gunicorn')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--seed-users', type=int, default=1000)
+    parser.add_argument('--seed-posts', type=int, default=20000)
+    parser.add_argument('--es-latency', type=float, default=0.0, help='fake ES每个请求的延迟')
+    parser.add_argument('--no-rate-limit', action='store_true')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(json.loads(args.serve))
+
+    if args.server is None:
+        try:
+            import gunicorn  # noqa: F401
+            args.server = 'gunicorn'
+        except ImportError:
+            args.server = 'werkzeug'
+    mix = parse_weights(args.mix, str)
+    unknown = [name for name, _ in mix if not hasattr(VirtualUser, 'do_' + name)]
+    if unknown:
+        parser.error('unknown actions: {}'.format(', '.join(unknown)))
+    think = parse_weights(args.think if ':' in args.think else args.think + ':1')
+
+    app, database = create_benchmark_app()
+    seed(app, users=args.seed_users, posts=args.seed_posts, follows_per_user=20)
+    from fake_es import start_fake_es
+    from app.models import Post
+    es = start_fake_es(latency=args.es_latency)
+    with app.app_context():
+        es.documents['post'] = {str(id): {'body': body} for id, body in Post.query.with_entities(Post.id, Post.body)}
+    metrics_dir = tempfile.mkdtemp(prefix='allenblog-loadtest-')
+    server = start_server(args, database, 'http://127.0.0.1:{}'.format(es.server_port), metrics_dir)
+    base = 'http://127.0.0.1:{}'.format(args.port)
+    try:
+        wait_for_server(base)
+        run(args, base, mix, think)
+    finally:
+        server.terminate()
+        server.wait()
+        es.shutdown()
+
+
+def run(args, base, mix, think):
+    print('{} server ({} workers x {} threads), {} client processes x {} users, think {}, {}s'.format(
+        args.server, args.workers, args.threads, args.processes, args.users, args.think, args.duration))
+    print('{:>6} {:>8} {:>8} {:>8} {:>8} {:>7} {:>9} {:>10} {:>9} {:>7}'.format(
+        'time', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'throttled', 'commit ms', 'slow (%)', 'locked'))
+    queue = multiprocessing.Queue()
+    started = time.monotonic()
+    deadline = started + args.duration
+    processes = [multiprocessing.Process(target=client_process, args=(i, args, base, mix, think, deadline, queue))
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    # 按完成时间分到每--interval秒一段(time.monotonic()在同一台机器的进程之间是同一个时钟)，
+    # 客户端每秒发一次，所以一段结束1秒多之后才输出。--duration之后才返回的请求算在最后一段里
+    last_tick = max(int(math.ceil(args.duration / args.interval)) - 1, 0)
+    totals = {}
+    windows = {}
+    printed = 0
+    last_db = scrape(base)
+    running = len(processes)
+
+    def report(tick, end):
+        nonlocal last_db
+        window = windows.pop(tick, [])
+        db = scrape(base)
+        commits, commit_time, slow, locked = (db[i] - last_db[i] for i in range(4))
+        last_db = db
+        latencies = [latency * 1000 for _, status, latency in window if classify(status) == 'ok']
+        print('{:>6.0f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>7} {:>9} {:>10.1f} {:>9.1f} {:>7.0f}'.format(
+            end - started, len(window) / (end - (started + tick * args.interval)),
+            percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99),
+            sum(1 for _, status, _ in window if classify(status) == 'error'),
+            sum(1 for _, status, _ in window if classify(status) == 'throttled'),
+            commit_time / commits * 1000 if commits else 0, slow / commits * 100 if commits else 0, locked))
+
+    while running:
+        batch = queue.get()
+        if batch is None:
+            running -= 1
+            continue
+        for action, status, latency, finished in batch:
+            tick = min(int((finished - started) // args.interval), last_tick)
+            windows.setdefault(tick, []).append((action, status, latency))
+            totals.setdefault(action, []).append((status, latency))
+        while printed < last_tick and time.monotonic() > started + (printed + 1) * args.interval + 1.5:
+            report(printed, started + (printed + 1) * args.interval)
+            printed += 1
+    for tick in range(printed, last_tick + 1):
+        report(tick, min(started + (tick + 1) * args.interval, deadline))
+    for process in processes:
+        process.join()
+
+    print('\n{:<14} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10}'.format(
+        'action', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'throttled'))
+    everything = [item for results in totals.values() for item in results]
+    for action, results in sorted(totals.items()) + [('total', everything)]:
+        latencies = [latency * 1000 for status, latency in results if classify(status) == 'ok']
+        errors = sum(1 for status, _ in results if classify(status) == 'error')
+        throttled = sum(1 for status, _ in results if classify(status) == 'throttled')
+        print('{:<14} {:>8} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>7.2%} {:>9.2%}'.format(
+            action, len(results), len(results) / args.duration, percentile(latencies, 50), percentile(latencies, 95),
+            percentile(latencies, 99), errors / len(results) if results else 0,
+            throttled / len(results) if results else 0))
+
+
+if __name__ == '__main__':
+    main()
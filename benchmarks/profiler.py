@@ -0,0 +1,70 @@
+'''
+    采样profiler(app/my_extensions/profiler.py)的开销: 不profile、按默认比例抽样、每个请求都profile时的请求延迟。
+
+        python benchmarks/profiler.py
+        python benchmarks/profiler.py --requests 2000 --interval 0.001
+
+    三种设置轮流跑--rounds轮，每轮每种--requests个请求(首页、explore、个人主页轮流)，取每种设置各轮平均延迟的中位数。
+    最后输出/_profile的汇总和首页最热的几个栈。
+'''
+import argparse
+import os
+import statistics
+import time
+
+from seed import create_benchmark_app, login, seed
+
+URLS = ('/index/', '/explore', '/user/user1/')
+TOKEN = 'benchmark'
+
+
+def measure(client, requests):
+    start = time.perf_counter()
+    for i in range(requests):
+        response = client.get(URLS[i % len(URLS)])
+        assert response.status_code == 200, response.status_code
+    return (time.perf_counter() - start) / requests * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=None, help='采样间隔(秒)，默认用config里的')
+    args = parser.parse_args()
+
+    os.environ['PROFILER_ENABLED'] = '1'
+    os.environ['PROFILER_TOKEN'] = TOKEN
+    app, path = create_benchmark_app()
+    seed(app, users=100, posts=5000)
+    from app import profiler
+    if args.interval:
+        profiler.base_interval = profiler.interval = args.interval
+    client = login(app.test_client())
+
+    default_rate = app.config['PROFILER_SAMPLE_RATE']
+    settings = [('off', 0.0, []), ('sample {:.0%}'.format(default_rate), default_rate, []),
+                ('every request', 0.0, ['main.*'])]
+    results = {name: [] for name, _, _ in settings}
+    measure(client, len(URLS) * 5)
+    for _ in range(args.rounds):
+        for name, rate, endpoints in settings:
+            profiler.sample_rate, profiler.endpoints = rate, endpoints
+            results[name].append(measure(client, args.requests))
+
+    base = statistics.median(results['off'])
+    for name, _, _ in settings:
+        latency = statistics.median(results[name])
+        print('{:<16} {:>7.2f} ms/request  {:>+6.1%}'.format(name, latency, latency / base - 1))
+
+    headers = {'X-Profiler-Token': TOKEN}
+    print(client.get('/_profile', headers=headers).get_data(as_text=True))
+    lines = client.get('/_profile?endpoint=main.index', headers=headers).get_data(as_text=True).splitlines()
+    print('hottest main.index stacks (leaf frames):')
+    for line in sorted(lines, key=lambda line: -int(line.rsplit(' ', 1)[1]))[:5]:
+        stack, count = line.rsplit(' ', 1)
+        print('  {:>5} {}'.format(count, ';'.join(stack.split(';')[-3:])))
+
+
+if __name__ == '__main__':
+    main()
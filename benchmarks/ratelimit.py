@@ -0,0 +1,91 @@
+'''
+    限流(app/my_extensions/ratelimit.py)每个请求的开销。
+
+        python benchmarks/ratelimit.py
+        python benchmarks/ratelimit.py --processes 8 --keys 100000
+
+    1. 整个请求: /notifications在没有限流、进程内存、mmap文件三种设置下的延迟(限额设得很大，不会被拒绝)
+    2. 令牌桶本身: 进程内存和mmap文件两种存储，一次take()多少微秒；多个进程同时take()同一个文件时的总吞吐
+'''
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from seed import create_benchmark_app, login, seed
+
+
+def take_many(buckets, keys, count):
+    start = time.perf_counter()
+    for i in range(count):
+        buckets.take('main.search\0{}'.format(i % keys), 1e9, 1e9, time.time())
+    return time.perf_counter() - start
+
+
+def _worker(path, keys, count, results):
+    from app.my_extensions.ratelimit import _MmapBuckets
+    results.put(take_many(_MmapBuckets(path, 65536, 256), keys, count))
+
+
+def buckets_benchmark(keys, count, processes):
+    from app.my_extensions.ratelimit import _MemoryBuckets, _MmapBuckets
+    path = os.path.join(tempfile.mkdtemp(prefix='allenblog-ratelimit-'), 'ratelimit.mmap')
+    for name, buckets in (('memory', _MemoryBuckets()), ('mmap', _MmapBuckets(path, 65536, 256))):
+        elapsed = take_many(buckets, keys, count)
+        print('  {:<8} {:>6.2f} us/take'.format(name, elapsed / count * 1e6))
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_worker, args=(path, keys, count, results)) for _ in range(processes)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    print('  mmap, {} processes: {:.0f} takes/s in total'.format(processes, processes * count / elapsed))
+
+
+def request_benchmark(requests, rounds):
+    app, path = create_benchmark_app(RATELIMIT_FILE=None)
+    seed(app, users=10, posts=100)
+    from app import ratelimiter
+    from app.my_extensions.ratelimit import _MemoryBuckets, _MmapBuckets
+    client = login(app.test_client())
+    mmap_path = os.path.join(os.path.dirname(path), 'ratelimit.mmap')
+    settings = [('no limit', {}, _MemoryBuckets()),
+                ('memory', {'main.notifications': (1e9, 1e9)}, _MemoryBuckets()),
+                ('mmap', {'main.notifications': (1e9, 1e9)}, _MmapBuckets(mmap_path, 65536, 256))]
+    results = {name: [] for name, _, _ in settings}
+    for _ in range(rounds):
+        for name, limits, buckets in settings:
+            ratelimiter.limits, ratelimiter.buckets = limits, buckets
+            start = time.perf_counter()
+            for _ in range(requests):
+                assert client.get('/notifications').status_code == 200
+            results[name].append((time.perf_counter() - start) / requests * 1e6)
+    base = statistics.median(results['no limit'])
+    for name, _, _ in settings:
+        latency = statistics.median(results[name])
+        print('  {:<8} {:>8.1f} us/request  {:>+6.1f} us'.format(name, latency, latency - base))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--takes', type=int, default=200000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    # 先create_app(它会设置DATABASE_URL)，再import app下的模块
+    print('GET /notifications')
+    request_benchmark(args.requests, args.rounds)
+    print('token buckets ({} keys)'.format(args.keys))
+    buckets_benchmark(args.keys, args.takes, args.processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+'''
+    响应压缩和流式渲染的benchmark: 每种组合下的time-to-first-byte、总耗时、传输的字节数。
+
+        python benchmarks/response.py
+        python benchmarks/response.py --posts 20000 --per-page 50 --requests 50
+
+    TTFB是从发起请求到WSGI返回第一块数据的时间(用test client，不含网络)。
+'''
+import argparse
+import statistics
+import time
+
+from seed import create_benchmark_app, login, seed
+
+
+def measure(client, url, accept_encoding, requests):
+    ttfb, total, size = [], [], 0
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get(url, headers={'Accept-Encoding': accept_encoding}, buffered=False)
+        chunks = iter(response.response)
+        first = next(chunks, b'')
+        ttfb.append(time.perf_counter() - start)
+        size = len(first) + sum(len(chunk) for chunk in chunks)
+        total.append(time.perf_counter() - start)
+        response.close()
+    return statistics.median(ttfb), statistics.median(total), size, response.headers.get('Content-Encoding')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--per-page', type=int, default=25)
+    parser.add_argument('--requests', type=int, default=30)
+    args = parser.parse_args()
+
+    app, path = create_benchmark_app(POSTS_PER_PAGE=args.per_page)
+    seed(app, users=args.users, posts=args.posts)
+    client = login(app.test_client())
+    print('database: {}, {} posts, {} per page'.format(path, args.posts, args.per_page))
+    print('{:<10} {:<10} {:<10} {:>10} {:>10} {:>10}'.format(
+        'url', 'render', 'encoding', 'TTFB ms', 'total ms', 'bytes'))
+    for url in ('/explore', '/'):
+        for stream in (False, True):
+            app.config['STREAM_TEMPLATES'] = stream
+            for accept in ('identity', 'gzip', 'br'):
+                ttfb, total, size, encoding = measure(client, url, accept, args.requests)
+                print('{:<10} {:<10} {:<10} {:>10.2f} {:>10.2f} {:>10}'.format(
+                    url, 'stream' if stream else 'buffered', encoding or 'identity', ttfb * 1000, total * 1000, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''
+    benchmarks共用: 在临时SQLite数据库上创建app，并用Core executemany批量插入用户、post、关注关系。
+    (app/fake.py用Faker一条条插入，几千条以上太慢)
+
+    所有用户的密码都是'x'，用户名是user1, user2, ...
+'''
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def create_benchmark_app(database_path=None, **config):
+    '''返回(app, database_path)。config会覆盖app.config'''
+    if database_path is None:
+        database_path = os.path.join(tempfile.mkdtemp(prefix='allenblog-bench-'), 'bench.db')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database_path
+    os.environ.setdefault('CONFIG', 'production')
+    from app import create_app, db
+    app = create_app(os.environ['CONFIG'])
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config.update(config)
+    with app.app_context():
+        db.create_all()
+    return app, database_path
+
+
+def seed(app, users=100, posts=1000, follows_per_user=10, batch_size=5000, seed_value=0):
+    from werkzeug.security import generate_password_hash
+    from app import db
+    from app.models import User, Post, followers
+
+    rng = random.Random(seed_value)
+    password_hash = generate_password_hash('x')
+    now = datetime.utcnow()
+    with app.app_context():
+        conn = db.engine.connect()
+        _insert(conn, User.__table__, ({
+            'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+            'password_hash': password_hash, 'about_me': 'I am user {}'.format(i), 'last_seen': now,
+        } for i in range(1, users + 1)), batch_size)
+        _insert(conn, Post.__table__, ({
+            'id': i, 'title': 'Post {} {}'.format(i, rng.choice(['hello', 'flask', 'python', 'sqlite', 'search'])),
+            'body': ' '.join(rng.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'flask', 'blog'])
+                             for _ in range(20)),
+            'timestamp': now - timedelta(minutes=posts - i), 'user_id': rng.randint(1, users),
+        } for i in range(1, posts + 1)), batch_size)
+        _insert(conn, followers, ({
+            'follower_id': follower, 'followed_id': followed,
+        } for follower in range(1, users + 1)
+            for followed in sorted(set(rng.randint(1, users) for _ in range(follows_per_user)) - {follower})),
+            batch_size)
+        conn.close()
+
+
+def _insert(conn, table, rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            conn.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        conn.execute(table.insert(), batch)
+
+
+def login(client, username='user1', password='x'):
+    response = client.post('/login/', data={'username': username, 'password': password})
+    assert response.status_code == 302, response.status_code
+    return client
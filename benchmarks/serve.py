@@ -0,0 +1,111 @@
+'''
+    flask serve(app/serve.py)的benchmark: 不同worker数时每秒处理的请求数。
+
+        pip install gunicorn
+        python benchmarks/serve.py
+        python benchmarks/serve.py --workers 1,2,4,8 --clients 16 --duration 20
+
+    每个worker数启动一次flask serve(单独的进程，监听本地端口)，--clients个客户端进程各自登录一个用户，
+    不停地(没有think time)轮流请求首页、explore、个人主页，统计duration秒内的请求数和错误数。
+    客户端和服务端在同一台机器上抢CPU，结果只能用来比较不同的worker数。
+'''
+import argparse
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+from seed import ROOT, create_benchmark_app, seed
+
+URLS = ('/index/', '/explore', '/user/user1/')
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start on port {}'.format(port))
+
+
+def login(base, username):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+    page = opener.open(base + '/login/').read().decode()
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+    opener.open(base + '/login/', urllib.parse.urlencode(
+        {'csrf_token': token, 'username': username, 'password': 'x'}).encode()).read()
+    return opener
+
+
+def client(base, username, duration, results):
+    opener = login(base, username)
+    done = errors = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        try:
+            opener.open(base + URLS[done % len(URLS)]).read()
+        except Exception:
+            errors += 1
+        done += 1
+    results.put((done, errors))
+
+
+def run(port, clients, duration):
+    base = 'http://127.0.0.1:{}'.format(port)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client, args=(base, 'user{}'.format(i + 1), duration, results))
+                 for i in range(clients)]
+    for process in processes:
+        process.start()
+    done = errors = 0
+    for _ in processes:
+        d, e = results.get()
+        done, errors = done + d, errors + e
+    for process in processes:
+        process.join()
+    return done, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    app, path = create_benchmark_app()
+    seed(app, users=args.users, posts=args.posts)
+    env = dict(os.environ, FLASK_APP='manage.py', DATABASE_URL='sqlite:///' + path)
+
+    print('{} CPUs, {} clients, {}s each'.format(multiprocessing.cpu_count(), args.clients, args.duration))
+    for workers in [int(w) for w in args.workers.split(',')]:
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'flask', 'serve', '-b', '127.0.0.1:{}'.format(args.port),
+             '-w', str(workers), '--threads', str(args.threads)],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(args.port)
+            done, errors = run(args.port, args.clients, args.duration)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        print('  {:>2} workers x {} threads: {:>7.1f} requests/s, {} errors'.format(
+            workers, args.threads, done / args.duration, errors))
+
+
+if __name__ == '__main__':
+    main()
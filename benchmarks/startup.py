@@ -0,0 +1,76 @@
+'''
+    启动耗时benchmark: import manage(也就是create_app)要多久，时间花在哪些模块上。
+
+    用 python -X importtime 在新进程里import，多跑几次取中位数，按顶层包汇总cumulative时间。
+
+        python benchmarks/startup.py
+        python benchmarks/startup.py --runs 10 --module manage --top 15
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+    '''返回 (wall time, {包或app的模块: cumulative微秒})'''
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                          cwd=ROOT, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                          universal_newlines=True, check=True)
+    wall = time.perf_counter() - start
+    packages = {}
+    pending = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # 格式是" " + 每层缩进两个空格 + 模块名, level 0是被import的module自己。
+        # 输出是后序的(子模块在父模块之前)，所以先把level 2的攒着，遇到它们的父模块(level 1)再决定归到哪里
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if level == 2:
+            pending.append((name, int(cumulative)))
+        elif level == 1:
+            if name == 'app':
+                # manage -> app -> flask/app.xxx..., 展开app包，按第三方包和本项目各模块分别统计
+                for child, us in pending:
+                    key = child if child.startswith('app.') else child.split('.')[0]
+                    packages[key] = packages.get(key, 0) + us
+            else:
+                top = name.split('.')[0]
+                packages[top] = packages.get(top, 0) + int(cumulative)
+            pending = []
+    return wall, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='manage')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    walls = []
+    samples = {}
+    for _ in range(args.runs):
+        wall, packages = import_times(args.module)
+        walls.append(wall)
+        for name, us in packages.items():
+            samples.setdefault(name, []).append(us)
+
+    print('import {}: median wall time {:.1f} ms over {} runs (includes interpreter startup)'.format(
+        args.module, statistics.median(walls) * 1000, args.runs))
+    print('{:<40} {:>12}'.format('module', 'median ms'))
+    rows = sorted(((statistics.median(v) / 1000.0, k) for k, v in samples.items()), reverse=True)
+    for ms, name in rows[:args.top]:
+        print('{:<40} {:>12.1f}'.format(name, ms))
+
+
+if __name__ == '__main__':
+    main()
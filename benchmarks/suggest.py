@@ -0,0 +1,77 @@
+'''
+    自动补全前缀索引(app/suggest.py)的benchmark: 构建时间、内存、查询和插入延迟。
+    不需要数据库，直接用随机生成的标题。
+
+        python benchmarks/suggest.py                 # 默认100万条标题
+        python benchmarks/suggest.py --titles 100000 --queries 20000
+'''
+import argparse
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.suggest import PrefixIndex  # noqa: E402
+
+
+def random_title(rng):
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9)))
+             for _ in range(rng.randint(1, 4))]
+    return ' '.join(words).capitalize()[:32]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--titles', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=100000)
+    parser.add_argument('--inserts', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    titles = [random_title(rng) for _ in range(args.titles)]
+
+    index = PrefixIndex(max_entries=args.titles + args.inserts)
+    start = time.perf_counter()
+    index.build(('post', i, title) for i, title in enumerate(titles, 1))
+    build_time = time.perf_counter() - start
+    # 排好序的list + 其中的字符串 + id到条目的dict(条目字符串和list共用，不重复计算)
+    memory = sys.getsizeof(index._entries) + sum(sys.getsizeof(e) for e in index._entries) + \
+        sum(sys.getsizeof(d) + sum(sys.getsizeof(k) for k in d) for d in index._by_id.values())
+    print('build {:,} titles: {:.2f} s, {:.1f} MB ({:.0f} bytes/entry)'.format(
+        len(index), build_time, memory / 2 ** 20, memory / max(len(index), 1)))
+
+    # 前缀取已有标题的前1~4个字符，模拟用户在输入
+    prefixes = []
+    for _ in range(args.queries):
+        title = rng.choice(titles)
+        prefixes.append(title[:rng.randint(1, min(4, len(title)))])
+    latencies = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        index.search(prefix, 10)
+        latencies.append(time.perf_counter() - start)
+    print('search (limit 10) x {:,}: p50 {:.1f} us, p99 {:.1f} us, max {:.1f} us'.format(
+        len(latencies), statistics.median(latencies) * 1e6, percentile(latencies, 0.99) * 1e6, max(latencies) * 1e6))
+
+    latencies = []
+    for i in range(args.inserts):
+        title = random_title(rng)
+        start = time.perf_counter()
+        index.add('post', args.titles + i + 1, title)
+        latencies.append(time.perf_counter() - start)
+    print('insert x {:,}: p50 {:.1f} us, p99 {:.1f} us'.format(
+        len(latencies), statistics.median(latencies) * 1e6, percentile(latencies, 0.99) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
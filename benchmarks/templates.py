@@ -0,0 +1,81 @@
+'''
+    模板字节码缓存和预热(app/my_extensions/template_cache.py)的效果: 重启之后第一个请求的延迟。
+
+        python benchmarks/templates.py
+        python benchmarks/templates.py --runs 10
+
+    每次都启动一个新的Python进程(相当于重启了一个worker)，登录之后请求首页、explore、个人主页，
+    记下每个页面第一次和第二次请求的延迟。四种设置:
+        no cache        没有字节码缓存，不预热(原来的样子)
+        bytecode cache  flask templates compile预先编译过的字节码缓存
+        warm-up         启动时预热(flask serve在master里做的)，没有字节码缓存
+        both            两个都有
+    预热的用时单独列出来: flask serve是在fork之前做的，不算在worker的请求里。
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from seed import create_benchmark_app, login, seed
+
+URLS = ('/index/', '/explore', '/user/user1/')
+MODES = ('no cache', 'bytecode cache', 'warm-up', 'both')
+
+
+def child(mode, database_path, cache_dir):
+    os.environ['TEMPLATE_CACHE_DIR'] = cache_dir
+    app, _ = create_benchmark_app(database_path)
+    from app import template_cache
+    if mode in ('no cache', 'warm-up'):
+        app.jinja_env.bytecode_cache = None
+    warm_up = 0.0
+    if mode in ('warm-up', 'both'):
+        warm_up = template_cache.warm_up(app)[1]
+    client = login(app.test_client())
+    result = {'warm_up': warm_up}
+    for url in URLS:
+        for attempt in ('first', 'second'):
+            start = time.perf_counter()
+            assert client.get(url).status_code == 200
+            result['{} {}'.format(url, attempt)] = time.perf_counter() - start
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(*args.child)
+
+    cache_dir = tempfile.mkdtemp(prefix='allenblog-jinja-')
+    os.environ['TEMPLATE_CACHE_DIR'] = cache_dir
+    app, path = create_benchmark_app()
+    seed(app, users=100, posts=2000)
+    from app import template_cache
+    count, elapsed = template_cache.compile(app)
+    print('flask templates compile: {} templates in {:.0f}ms'.format(count, elapsed * 1000))
+
+    results = {mode: [] for mode in MODES}
+    for _ in range(args.runs):
+        for mode in MODES:
+            output = subprocess.run([sys.executable, __file__, '--child', mode, path, cache_dir],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+            results[mode].append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    keys = ['warm_up'] + ['{} {}'.format(url, attempt) for url in URLS for attempt in ('first', 'second')]
+    print('median of {} runs, ms'.format(args.runs))
+    print('{:<22}'.format('') + ''.join('{:>16}'.format(mode) for mode in MODES))
+    for key in keys:
+        print('{:<22}'.format(key) + ''.join(
+            '{:>16.1f}'.format(statistics.median(run[key] for run in results[mode]) * 1000) for mode in MODES))
+
+
+if __name__ == '__main__':
+    main()
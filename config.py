@@ -13,6 +13,90 @@ class Config:
     POSTS_PER_PAGE = 5
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'hard-to-guess'
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 每个Elasticsearch节点的连接池大小(keep-alive连接数)，和请求的默认超时(秒)
+    ELASTICSEARCH_MAXSIZE = int(os.environ.get('ELASTICSEARCH_MAXSIZE') or 10)
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or 10)
+    # /search是用户在等的，超时要短。超时是一次调用的总时间，重试也算在里面
+    ELASTICSEARCH_SEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_SEARCH_TIMEOUT') or 2)
+    ELASTICSEARCH_MAX_RETRIES = 1
+    # 连续失败多少次后熔断，熔断多少秒后再试探
+    ELASTICSEARCH_BREAKER_THRESHOLD = 5
+    ELASTICSEARCH_BREAKER_RESET = 30
+    # 搜索结果缓存(见app/search_cache.py)，MAX_ENTRIES为0表示不缓存
+    SEARCH_CACHE_MAX_ENTRIES = 10000
+    SEARCH_CACHE_TTL = 300
+    SEARCH_CACHE_MAX_STALE_GENERATIONS = 0
+    # 搜索框自动补全(见app/suggest.py)
+    SUGGEST_ENABLED = True
+    SUGGEST_MAX_ENTRIES = 1000000
+    # 自托管的静态文件(flask assets build)，见app/my_extensions/assets.py
+    ASSETS_DIR = os.path.join(base_dir, 'app', 'static', 'dist')
+    ASSETS_SOURCE_DIR = os.environ.get('ASSETS_SOURCE_DIR')
+    # 响应压缩(见app/my_extensions/compress.py)
+    COMPRESS_ENABLED = True
+    COMPRESS_MIN_SIZE = 500
+    # 列表页(index/explore)流式渲染(见app/streaming.py)
+    STREAM_TEMPLATES = os.environ.get('STREAM_TEMPLATES') == '1'
+    STREAM_BUFFER_SIZE = 16 * 1024
+    # 本地生成的identicon头像(见app/my_extensions/avatars.py)，False时用gravatar
+    AVATAR_LOCAL = os.environ.get('AVATAR_LOCAL', '1') == '1'
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or os.path.join(base_dir, 'avatars')
+    AVATAR_SIZES = (32, 64, 70, 128, 256)
+    # 进程内的关注关系图(见app/graph.py)，每个worker都要占内存(每条关注关系约8字节)，默认关闭
+    SOCIAL_GRAPH_ENABLED = os.environ.get('SOCIAL_GRAPH_ENABLED') == '1'
+    # 最多每多少秒查一次其他进程的关注/取关；overlay超过多少条时合并进CSR
+    SOCIAL_GRAPH_CATCHUP_INTERVAL = 1.0
+    SOCIAL_GRAPH_OVERLAY_LIMIT = 100000
+    # 首页和个人主页上"你可能认识的人"显示几个(flask recommend who-to-follow离线计算)
+    WHO_TO_FOLLOW_SIZE = 5
+    # /user_cards一次最多查多少个用户
+    USER_CARDS_MAX = 100
+    # flask archive posts默认把多少天以前的帖子搬到归档表(见app/archive.py)
+    ARCHIVE_POSTS_OLDER_THAN_DAYS = 365
+    # 后台任务(见app/my_extensions/jobs.py)，False时delay()直接同步执行
+    JOBS_ENABLED = os.environ.get('JOBS_ENABLED') == '1'
+    JOBS_DATABASE = os.environ.get('JOBS_DATABASE') or os.path.join(base_dir, 'jobs.db')
+    # running超过多少秒还没完成的任务当作worker已经死了，让别的worker重新执行
+    JOBS_VISIBILITY_TIMEOUT = 300
+    JOBS_RETRY_BACKOFF = 2
+    # 群发私信(/broadcast)每批(每个事务)发给多少个粉丝
+    BROADCAST_CHUNK_SIZE = 1000
+    # 为True时create_app总是初始化Flask-Migrate(默认只有flask db命令时才初始化)
+    EAGER_MIGRATE = False
+    # Jinja字节码缓存的目录，None表示不用(见app/my_extensions/template_cache.py)，flask templates compile预先编译
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or os.path.join(base_dir, '.jinja_cache')
+    # flask serve在fork之前加载所有模板
+    TEMPLATE_WARM_UP = True
+    # Prometheus metrics, 多个worker进程时要设置METRICS_DIR(见app/my_extensions/metrics.py)
+    METRICS_ENABLED = True
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_PATH = '/metrics'
+    # 设置了token时/metrics要带上token(Authorization: Bearer)，没设置时只有本机直接来的请求能看
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+    # 采样profiler(见app/my_extensions/profiler.py)，PROFILER_ENDPOINTS的请求都profile，其他的按PROFILER_SAMPLE_RATE抽样
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED') == '1'
+    PROFILER_ENDPOINTS = [e for e in os.environ.get('PROFILER_ENDPOINTS', '').split(',') if e]
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0.01))
+    # 采样间隔(秒)，采样线程占用的时间超过PROFILER_MAX_OVERHEAD时自动加大
+    PROFILER_INTERVAL = 0.005
+    PROFILER_MAX_OVERHEAD = 0.01
+    # 不设置就没有/_profile
+    PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN')
+    # 限流和过载保护(见app/my_extensions/ratelimit.py)。endpoint -> (每秒多少个请求, 最多攒多少个)，按用户(没登录按IP)算
+    RATELIMIT_ENABLED = True
+    RATELIMIT_LIMITS = {
+        'main.search': (1, 10),
+        'main.suggest': (10, 30),
+        'main.user_popup': (5, 30),
+        'main.user_cards': (2, 10),
+        # 页面每10秒轮询一次，多开几个标签页也够用
+        'main.notifications': (1, 10),
+    }
+    # 每个进程同时处理的请求数上限，超过的直接返回503，None表示不限制(多线程的worker才需要)
+    RATELIMIT_MAX_IN_FLIGHT = None
+    # 所有worker共用的令牌桶文件
+    RATELIMIT_FILE = os.environ.get('RATELIMIT_FILE') or os.path.join(base_dir, 'ratelimit.mmap')
 
     @staticmethod
     def init_app(app):
@@ -32,6 +116,16 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     TESTRING = True
     CSRF_ENABLED = False
+    WTF_CSRF_ENABLED = False
+    # tests/conftest.py会换成每个测试自己的临时文件
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 测试不依赖环境变量，也不写仓库目录里的文件
+    ELASTICSEARCH_URL = None
+    JOBS_ENABLED = False
+    METRICS_DIR = None
+    RATELIMIT_FILE = None
+    TEMPLATE_CACHE_DIR = None
 
 
 class ProductionConfig(Config):
@@ -1,7 +1,7 @@
 import os
-from app import create_app, db
-from app.models import User, Post, Notification, Message
-from app.fake import fake_users, fake_posts
+import click
+from app import create_app, db, assets, avatars, jobs, template_cache
+from app.models import User, Post, Notification, Message, FollowChange
 
 
 app = create_app(os.getenv('CONFIG') or 'production')
@@ -9,7 +9,155 @@ app = create_app(os.getenv('CONFIG') or 'production')
 
 @app.shell_context_processor
 def make_shell_context():
+    # app.fake会import Faker(很慢)，只有flask shell才需要，所以在这里才import
+    from app.fake import fake_users, fake_posts
     return {'db':db, 'User':User, 'Post':Post, 'fake_users':fake_users, 'fake_posts':fake_posts, 'Message':Message, 'Notification':Notification}
 
+@app.cli.group('assets')
+def assets_cli():
+    '''自托管的静态文件'''
+
+
+@assets_cli.command('build')
+@click.option('--source-dir', default=None, help='先在这个目录里找同名文件(内网环境)，默认用ASSETS_SOURCE_DIR')
+def build_assets(source_dir):
+    '''把Bootstrap、jQuery、moment.js复制到app/static/dist，文件名带hash，并生成.gz/.br'''
+    assets.build(source_dir or app.config['ASSETS_SOURCE_DIR'])
+
+
+@app.cli.group('templates')
+def templates_cli():
+    '''Jinja模板'''
+
+
+@templates_cli.command('compile')
+@click.option('--clear', is_flag=True, help='先清空字节码缓存')
+def compile_templates(clear):
+    '''把所有模板编译进TEMPLATE_CACHE_DIR(部署时执行一次，worker启动后不用再编译)'''
+    if not app.config['TEMPLATE_CACHE_DIR']:
+        raise click.ClickException('TEMPLATE_CACHE_DIR is not configured')
+    count, elapsed = template_cache.compile(app, clear=clear)
+    click.echo('compiled {} templates into {} in {:.0f}ms'.format(count, app.config['TEMPLATE_CACHE_DIR'],
+                                                                 elapsed * 1000))
+
+
+@app.cli.group('avatars')
+def avatars_cli():
+    '''本地生成的identicon头像'''
+
+
+@avatars_cli.command('prerender')
+@click.option('--sizes', default='64,70', help='逗号分隔的尺寸')
+@click.option('--batch-size', default=1000)
+def prerender_avatars(sizes, batch_size):
+    '''为所有用户预先生成头像到AVATAR_CACHE_DIR'''
+    sizes = [int(size) for size in sizes.split(',')]
+    last_id, total = 0, 0
+    while True:
+        ids = [id for id, in db.session.query(User.id).filter(User.id > last_id)
+               .order_by(User.id).limit(batch_size)]
+        if not ids:
+            break
+        total += avatars.prerender(ids, sizes)
+        last_id = ids[-1]
+    click.echo('rendered {} avatars into {}'.format(total, avatars.cache_dir))
+
+
+@app.cli.group('graph')
+def graph_cli():
+    '''进程内的关注关系图'''
+
+
+@graph_cli.command('prune')
+@click.option('--keep-hours', default=24, help='保留最近多少小时的关注/取关记录')
+def prune_follow_changes(keep_hours):
+    '''删除旧的FollowChange。比所有worker启动时间都早的记录已经没用了(启动时是从followers表整个加载的)'''
+    from datetime import datetime, timedelta
+    cutoff = datetime.utcnow() - timedelta(hours=keep_hours)
+    count = FollowChange.query.filter(FollowChange.timestamp < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    click.echo('deleted {} follow changes older than {}'.format(count, cutoff))
+
+
+@app.cli.group('recommend')
+def recommend_cli():
+    '''离线计算的推荐'''
+
+
+@recommend_cli.command('who-to-follow')
+@click.option('--top-k', default=20, help='每个用户保存几个推荐')
+@click.option('--chunk-size', default=10000, help='每次计算多少个用户(决定每个进程的内存)')
+@click.option('--processes', default=0, help='进程数，默认CPU核数')
+def who_to_follow(top_k, chunk_size, processes):
+    '''朋友的朋友，按共同关注的人数排序，写进follow_suggestion表(需要numpy和scipy)'''
+    from app.recommend import MissingDependency, compute_who_to_follow, print_progress
+    try:
+        written = compute_who_to_follow(db.engine, top_k=top_k, chunk_size=chunk_size,
+                                        processes=processes or None, progress=print_progress(click.echo))
+    except MissingDependency as e:
+        raise click.ClickException(str(e))
+    click.echo('wrote {} suggestions'.format(written))
+
+
+@app.cli.group('archive')
+def archive_cli():
+    '''冷热分离'''
+
+
+@archive_cli.command('posts')
+@click.option('--older-than-days', default=None, type=int, help='默认用ARCHIVE_POSTS_OLDER_THAN_DAYS')
+@click.option('--batch-size', default=1000)
+@click.option('--sleep', default=0.0, help='每批之间sleep多少秒')
+def archive_old_posts(older_than_days, batch_size, sleep):
+    '''把旧帖子从post表搬到post_archive表'''
+    from datetime import datetime, timedelta
+    from app.archive import archive_posts
+    days = older_than_days if older_than_days is not None else app.config['ARCHIVE_POSTS_OLDER_THAN_DAYS']
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    count = archive_posts(db.engine, cutoff, batch_size=batch_size, sleep=sleep,
+                          progress=lambda archived: click.echo('archived {} posts'.format(archived)))
+    click.echo('archived {} posts older than {}'.format(count, cutoff))
+
+
+@app.cli.group('jobs')
+def jobs_cli():
+    '''后台任务'''
+
+
+@jobs_cli.command('worker')
+@click.option('--processes', default=2, help='worker进程数')
+@click.option('--poll-interval', default=1.0, help='队列空的时候每隔多少秒查一次')
+def jobs_worker(processes, poll_interval):
+    '''启动worker进程执行后台任务(JOBS_ENABLED=1时web进程才会把任务放进队列)'''
+    jobs.run_workers(app, processes=processes, poll_interval=poll_interval)
+
+
+@jobs_cli.command('status')
+def jobs_status():
+    '''队列里各状态的任务数和延迟'''
+    due, lag, counts = jobs.stats()
+    click.echo('due {}, lag {:.1f}s, {}'.format(due, lag, ', '.join(
+        '{} {}'.format(status, count) for status, count in sorted(counts.items()))))
+
+
+@app.cli.command('serve', with_appcontext=False)
+@click.option('-b', '--bind', default='127.0.0.1:8000', help='监听的地址')
+@click.option('-w', '--workers', default=0, help='worker进程数，默认CPU核数 * 2 + 1')
+@click.option('--threads', default=1, help='每个worker的线程数')
+@click.option('--max-requests', default=10000, help='worker处理这么多请求之后重启(0表示不重启)')
+@click.option('--max-requests-jitter', default=1000, help='max-requests加上0 ~ jitter的随机数')
+@click.option('--timeout', default=30, help='worker多少秒没有响应就杀掉重启')
+@click.option('--graceful-timeout', default=30, help='重启时等待worker处理完请求的秒数')
+def serve_app(bind, workers, threads, max_requests, max_requests_jitter, timeout, graceful_timeout):
+    '''用gunicorn启动生产环境的web服务(preload + prefork，kill -HUP平滑重启worker)'''
+    # 不能在app context里运行: fork出来的worker会继承它，所有请求就共用同一个g了
+    from app.serve import MissingDependency, serve
+    try:
+        serve(app, bind=bind, workers=workers or None, threads=threads, max_requests=max_requests,
+              max_requests_jitter=max_requests_jitter, timeout=timeout, graceful_timeout=graceful_timeout)
+    except MissingDependency as e:
+        raise click.ClickException(str(e))
+
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,45 @@
+'''
+    pytest的fixture。
+
+        python -m pytest -q
+
+    app用TestingConfig，数据库、后台任务队列、头像缓存都在每个测试自己的临时目录里。
+    造数据和登录用benchmarks/seed.py(用户名user1, user2, ...，密码都是'x')，假的Elasticsearch是benchmarks/fake_es.py。
+'''
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+
+@pytest.fixture
+def app(tmp_path):
+    from app import avatars, create_app, db, jobs
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'test.db')
+    jobs.path = str(tmp_path / 'jobs.db')
+    avatars.cache_dir = str(tmp_path / 'avatars')
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def fake_es():
+    from fake_es import start_fake_es
+    server = start_fake_es()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,63 @@
+'''冷热分离(app/archive.py)和跨热表/归档表的读取'''
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.archive import archive_posts
+from app.models import Post, PostArchive, User
+
+
+@pytest.fixture
+def archived_app(app):
+    from seed import seed
+    seed(app, users=2, posts=40)
+    with app.app_context():
+        moved = archive_posts(db.engine, datetime.utcnow() - timedelta(minutes=20), batch_size=7)
+        assert moved == 20
+    return app
+
+
+def test_archive_moves_old_posts(archived_app):
+    with archived_app.app_context():
+        assert Post.query.count() == 20
+        assert PostArchive.query.count() == 20
+        assert Post.query.order_by(Post.timestamp).first().timestamp > \
+            PostArchive.query.order_by(PostArchive.timestamp.desc()).first().timestamp
+
+
+def test_posts_page_continues_into_archive(archived_app):
+    with archived_app.app_context():
+        user = User.query.get(1)
+        expected = sorted([(p.timestamp, p.id) for p in Post.query.filter_by(user_id=1)] +
+                          [(p.timestamp, p.id) for p in PostArchive.query.filter_by(user_id=1)], reverse=True)
+        seen, page = [], 1
+        while True:
+            pagination = user.posts_page(page, 3)
+            seen += [(p.timestamp, p.id) for p in pagination.items]
+            if not pagination.has_next:
+                break
+            page += 1
+        assert seen == expected
+        assert pagination.total == len(expected)
+
+
+def test_get_only_returns_hot_posts(archived_app):
+    with archived_app.app_context():
+        archived_id = PostArchive.query.first().id
+        hot_id = Post.query.first().id
+        assert Post.query.get(archived_id) is None
+        assert isinstance(Post.query.get(hot_id), Post)
+        assert isinstance(Post.get_including_archived(archived_id), PostArchive)
+        assert isinstance(Post.get_including_archived(hot_id), Post)
+        assert Post.get_including_archived(10 ** 6) is None
+
+
+def test_hydrate_and_search_return_lists(archived_app):
+    with archived_app.app_context():
+        archived_id = PostArchive.query.first().id
+        hot_id = Post.query.first().id
+        posts = Post.hydrate([hot_id, 10 ** 6, archived_id])
+        assert [p.id for p in posts] == [hot_id, archived_id]
+        # 没有配置Elasticsearch时没有结果，也是list
+        assert Post.search('lorem', 1, 5) == ([], 0)
@@ -0,0 +1,44 @@
+'''自托管的静态文件(app/my_extensions/assets.py)'''
+import os
+
+import pytest
+
+from app import assets
+
+
+@pytest.fixture
+def built(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(assets, 'directory', str(tmp_path / 'dist'))
+    monkeypatch.setattr(assets, 'manifest', {})
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'app.js').write_text('var x = 1;\n' * 200)
+    return assets.build(str(source), assets=[('app.js', 'app.js')], log=lambda message: None)
+
+
+def test_build_writes_gzip_and_brotli_variants(built):
+    pytest.importorskip('brotli')
+    files = os.listdir(assets.directory)
+    hashed = built['app.js']
+    assert {hashed, hashed + '.gz', hashed + '.br', 'manifest.json'} <= set(files)
+
+
+def test_serve_picks_encoding(app, client, built):
+    url = '/assets/' + built['app.js']
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'Content-Encoding' not in client.get(url).headers
+    assert client.get('/assets/' + built['app.js'] + '.gz').status_code == 404
+
+
+def test_build_warns_without_brotli(app, tmp_path, monkeypatch):
+    import app.my_extensions.assets as assets_module
+    monkeypatch.setattr(assets_module, '_brotli', lambda: None)
+    monkeypatch.setattr(assets, 'directory', str(tmp_path / 'dist'))
+    monkeypatch.setattr(assets, 'manifest', {})
+    (tmp_path / 'app.js').write_text('var x = 1;\n' * 200)
+    messages = []
+    assets.build(str(tmp_path), assets=[('app.js', 'app.js')], log=messages.append)
+    assert any('brotli is not installed' in message for message in messages)
+    assert not any(name.endswith('.br') for name in os.listdir(assets.directory))
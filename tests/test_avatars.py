@@ -0,0 +1,27 @@
+'''本地生成的头像(app/my_extensions/avatars.py)'''
+import os
+
+from app import avatars
+
+
+def test_avatar_for_existing_user(app, client):
+    from seed import seed
+    seed(app, users=2, posts=0)
+    response = client.get('/avatar/1/64')
+    assert response.status_code == 200
+    assert response.data.startswith(b'\x89PNG')
+    assert os.path.exists(os.path.join(avatars.cache_dir, '64', '1.png'))
+
+
+def test_avatar_for_missing_user_is_not_rendered(app, client):
+    from seed import seed
+    seed(app, users=2, posts=0)
+    for user_id in (3, 4, 1000):
+        assert client.get('/avatar/{}/64'.format(user_id)).status_code == 404
+    assert not os.path.exists(os.path.join(avatars.cache_dir, '64'))
+
+
+def test_avatar_size_must_be_allowed(app, client):
+    from seed import seed
+    seed(app, users=1, posts=0)
+    assert client.get('/avatar/1/65').status_code == 404
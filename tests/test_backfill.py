@@ -0,0 +1,136 @@
+'''分批回填(app/backfill.py): 按主键分批、跳过空洞、断点续跑和flask backfill命令'''
+import os
+
+import pytest
+from sqlalchemy import text
+
+from app import backfill as backfill_module
+from seed import seed
+
+NAME = 'test_about_me'
+
+
+@pytest.fixture
+def calls(app, monkeypatch):
+    '''注册一个把user.about_me改成'filled'的backfill，返回每批的(start, stop)'''
+    monkeypatch.setattr(backfill_module, '_backfills', {})
+    calls = []
+
+    @backfill_module.backfill(NAME, 'user')
+    def fill_about_me(conn, start, stop):
+        '''测试用'''
+        calls.append((start, stop))
+        return conn.execute(text("UPDATE user SET about_me = 'filled' WHERE id >= :start AND id < :stop"),
+                            start=start, stop=stop).rowcount
+
+    seed(app, users=50, posts=0)
+    return calls
+
+
+def filled(app):
+    from app import db
+    with app.app_context():
+        return db.engine.execute(text("SELECT COUNT(*) FROM user WHERE about_me = 'filled'")).scalar()
+
+
+def checkpoint(app):
+    from app.models import BackfillCheckpoint
+    with app.app_context():
+        return BackfillCheckpoint.query.get(NAME)
+
+
+def run(app, **kwargs):
+    from app import db
+    with app.app_context():
+        return backfill_module.run_backfill(db.engine, NAME, **kwargs)
+
+
+def test_runs_in_batches(app, calls):
+    progress = []
+    assert run(app, batch_size=20, progress=lambda state, rate, eta: progress.append(state['last_id'])) == 50
+    assert calls == [(1, 21), (21, 41), (41, 51)]
+    assert progress == [20, 40, 50]
+    assert filled(app) == 50
+    assert checkpoint(app).finished_at is not None
+    assert checkpoint(app).rows_done == 50
+
+    # 已经完成的不再跑
+    assert run(app, batch_size=20) == 0
+    assert len(calls) == 3
+
+
+def test_skips_primary_key_gaps(app, calls):
+    from app import db
+    with app.app_context():
+        db.engine.execute(text('DELETE FROM user WHERE id > 5 AND id <= 45'))
+    assert run(app, batch_size=10) == 10
+    assert calls == [(1, 11), (46, 51)]
+
+
+def test_rows_added_after_start_are_left_alone(app, calls):
+    from app import db
+    progress_calls = []
+
+    def add_user(state, rate, eta):
+        if not progress_calls:
+            with app.app_context():
+                db.engine.execute(text("INSERT INTO user (id, username, about_me) VALUES (100, 'late', 'new')"))
+        progress_calls.append(state)
+
+    run(app, batch_size=20, progress=add_user)
+    assert calls[-1] == (41, 51)
+    assert checkpoint(app).max_id == 50
+
+
+def test_resumes_from_checkpoint(app, calls, monkeypatch):
+    job = backfill_module._backfills[NAME]
+    fill = job.fn
+
+    def fail_on_third_batch(conn, start, stop):
+        if len(calls) == 2:
+            calls.append((start, stop))
+            raise RuntimeError('interrupted')
+        return fill(conn, start, stop)
+
+    monkeypatch.setattr(job, 'fn', fail_on_third_batch)
+    with pytest.raises(RuntimeError):
+        run(app, batch_size=10)
+    # 失败那一批的UPDATE和断点一起回滚了
+    assert filled(app) == 20
+    assert checkpoint(app).last_id == 20
+    assert checkpoint(app).finished_at is None
+
+    monkeypatch.setattr(job, 'fn', fill)
+    del calls[:]
+    assert run(app, batch_size=10) == 30
+    assert calls == [(21, 31), (31, 41), (41, 51)]
+    assert filled(app) == 50
+    assert checkpoint(app).rows_done == 50
+
+
+def test_restart(app, calls):
+    run(app, batch_size=25)
+    del calls[:]
+    assert run(app, batch_size=25, restart=True) == 50
+    assert calls == [(1, 26), (26, 51)]
+
+
+def test_command(app, calls):
+    directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=['backfill', '-d', directory])
+    assert result.exit_code == 0
+    assert 'not started' in result.output
+
+    result = runner.invoke(args=['backfill', NAME, '-d', directory, '--batch-size', '20'])
+    assert result.exit_code == 0, result.output
+    assert 'done, 50 rows updated' in result.output
+    assert filled(app) == 50
+
+    result = runner.invoke(args=['backfill', '-d', directory])
+    assert 'finished at' in result.output
+
+    result = runner.invoke(args=['backfill', 'missing', '-d', directory])
+    assert result.exit_code != 0
+    assert 'unknown backfill missing' in result.output
@@ -0,0 +1,48 @@
+'''群发私信(/broadcast)'''
+import threading
+import time
+
+from app import broadcast as broadcast_module
+from app.models import Broadcast, Message
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_broadcast_runs_in_background_without_job_queue(app, client, monkeypatch):
+    from seed import login, seed
+    seed(app, users=20, posts=0, follows_per_user=10)
+    assert not app.config['JOBS_ENABLED']
+
+    # 让发送卡住，请求也要马上返回
+    release = threading.Event()
+    send_broadcast = broadcast_module.send_broadcast
+
+    def blocked_send_broadcast(*args, **kwargs):
+        release.wait(10)
+        return send_broadcast(*args, **kwargs)
+    monkeypatch.setattr(broadcast_module, 'send_broadcast', blocked_send_broadcast)
+
+    login(client)
+    response = client.post('/broadcast', data={'message': 'hello followers'})
+    assert response.status_code == 302
+    with app.app_context():
+        broadcast = Broadcast.query.one()
+        assert broadcast.finished_at is None
+        total = broadcast.recipients_total
+    assert total > 0
+
+    release.set()
+
+    def finished():
+        with app.app_context():
+            return Broadcast.query.one().finished_at is not None
+    assert wait_for(finished)
+    with app.app_context():
+        assert Message.query.filter_by(body='hello followers').count() == total
@@ -0,0 +1,99 @@
+'''ResilientElasticsearch(app/my_extensions/es_client.py)的熔断、时间预算和降级，用benchmarks/fake_es.py'''
+import time
+
+import pytest
+from elasticsearch.exceptions import TransportError
+
+from app.my_extensions.es_client import CircuitOpenError, ElasticsearchUnavailable, ResilientElasticsearch
+
+QUERY = {'query': {'multi_match': {'query': 'flask', 'fields': ['*']}}}
+
+
+def make_client(server, **kwargs):
+    return ResilientElasticsearch('http://127.0.0.1:{}'.format(server.server_port), **kwargs)
+
+
+def search(es):
+    return es.call('search', index='post', doc_type='post', body=QUERY)
+
+
+def test_breaker_opens_after_threshold_failures(fake_es):
+    fake_es.error_rate = 1.0
+    es = make_client(fake_es, max_retries=0, failure_threshold=3, reset_timeout=60)
+    for _ in range(3):
+        with pytest.raises(ElasticsearchUnavailable) as excinfo:
+            search(es)
+        assert not isinstance(excinfo.value, CircuitOpenError)
+    assert es.breaker.state == es.breaker.OPEN
+
+    requests = fake_es.requests
+    with pytest.raises(CircuitOpenError):
+        search(es)
+    # 熔断时不发请求
+    assert fake_es.requests == requests
+
+
+def test_half_open_recovers(fake_es):
+    fake_es.error_rate = 1.0
+    es = make_client(fake_es, max_retries=0, failure_threshold=1, reset_timeout=0.2)
+    with pytest.raises(ElasticsearchUnavailable):
+        search(es)
+    with pytest.raises(CircuitOpenError):
+        search(es)
+
+    # half-open的试探请求失败: 继续open
+    time.sleep(0.25)
+    with pytest.raises(ElasticsearchUnavailable):
+        search(es)
+    assert es.breaker.state == es.breaker.OPEN
+
+    # 试探请求成功: 关闭
+    fake_es.error_rate = 0.0
+    time.sleep(0.25)
+    assert search(es)['hits']['total'] == 0
+    assert es.breaker.state == es.breaker.CLOSED
+    search(es)
+
+
+def test_retries_stay_within_timeout_budget(fake_es):
+    fake_es.latency = 0.5
+    es = make_client(fake_es, max_retries=3, operation_timeouts={'search': 0.2})
+    start = time.monotonic()
+    with pytest.raises(ElasticsearchUnavailable):
+        search(es)
+    assert time.monotonic() - start < 0.4
+
+
+def test_fast_failures_are_retried(fake_es):
+    fake_es.error_rate = 1.0
+    es = make_client(fake_es, max_retries=2, operation_timeouts={'search': 5})
+    start = time.monotonic()
+    with pytest.raises(ElasticsearchUnavailable):
+        search(es)
+    assert fake_es.requests == 3
+    # 重试之前不sleep
+    assert time.monotonic() - start < 1
+
+
+def test_error_body_not_from_elasticsearch(fake_es):
+    # 例如代理返回的502，body不是Elasticsearch的格式
+    fake_es.error_rate = 1.0
+    fake_es.error_status = 502
+    es = make_client(fake_es, max_retries=0)
+    with pytest.raises(ElasticsearchUnavailable) as excinfo:
+        search(es)
+    assert '502' in str(excinfo.value)
+    assert isinstance(excinfo.value.__cause__, TransportError)
+    assert es.breaker._failures == 1
+
+
+def test_search_page_degrades_when_elasticsearch_fails(app, client, fake_es):
+    from seed import login, seed
+    seed(app, users=2, posts=5)
+    fake_es.error_rate = 1.0
+    fake_es.error_status = 502
+    app.elasticsearch = make_client(fake_es, max_retries=0)
+    login(client)
+    response = client.get('/search?q=proxyfailure')
+    assert response.status_code == 200
+    assert fake_es.requests == 1
@@ -0,0 +1,171 @@
+'''进程内的关注关系图(app/graph.py)'''
+import threading
+
+import pytest
+
+from app.graph import CSR, FollowGraph, social_graph
+
+EDGES = [(1, 2), (1, 3), (2, 3), (3, 1), (4, 1)]
+
+
+def make_graph(edges=EDGES, max_id=4):
+    graph = FollowGraph()
+    graph.load(iter(sorted(edges)), max_id, last_seq=0)
+    return graph
+
+
+def test_csr_and_transpose():
+    out = CSR.from_sorted(iter([(1, 2), (1, 2), (1, 3), (3, 1)]), 3)
+    assert list(out.row(1)) == [2, 3]
+    assert out.contains(1, 3) and not out.contains(3, 2)
+    # 超过max_id的用户
+    assert out.degree(100) == 0
+    reverse = out.transpose(3)
+    assert list(reverse.row(1)) == [3]
+    assert list(reverse.row(2)) == [1]
+
+
+def test_overlay_apply_is_idempotent():
+    graph = make_graph()
+    graph.apply(2, 1, True)
+    graph.apply(2, 1, True)
+    graph.apply(1, 2, False)
+    graph.apply(1, 2, False)
+    assert graph.is_following(2, 1)
+    assert not graph.is_following(1, 2)
+    assert graph.followed_ids(2) == [1, 3]
+    assert graph.follower_ids(1) == [2, 3, 4]
+    assert graph.followed_count(1) == 1
+    assert graph.follower_count(2) == 0
+    assert graph.overlay_size == 2
+    # 撤销overlay里的变更
+    graph.apply(2, 1, False)
+    graph.apply(1, 2, True)
+    assert graph.overlay_size == 0
+    assert graph.followed_ids(1) == [2, 3]
+
+
+def test_compact_merges_overlay():
+    graph = make_graph()
+    graph.apply(2, 1, True)
+    graph.apply(1, 2, False)
+    # 新用户，id比加载时的max_id大
+    graph.apply(7, 4, True)
+    assert graph.compact()
+    assert graph.overlay_size == 0
+    assert graph.followed_ids(1) == [3]
+    assert graph.followed_ids(2) == [1, 3]
+    assert graph.follower_ids(4) == [7]
+    assert graph.is_following(7, 4)
+
+
+def test_changes_during_background_compaction_are_kept(monkeypatch):
+    graph = make_graph()
+    graph.apply(2, 1, True)
+    started, release = threading.Event(), threading.Event()
+    rebuilt = graph._rebuilt
+
+    def slow_rebuilt(*args):
+        started.set()
+        release.wait(5)
+        return rebuilt(*args)
+    monkeypatch.setattr(graph, '_rebuilt', slow_rebuilt)
+
+    thread = graph.compact_in_background()
+    assert started.wait(5)
+    assert graph.compacting
+    assert graph.compact_in_background() is None
+    # 重建期间查询和更新都不用等
+    graph.apply(3, 2, True)
+    graph.apply(2, 1, False)
+    assert graph.is_following(3, 2) and not graph.is_following(2, 1)
+    release.set()
+    thread.join(5)
+
+    assert not graph.compacting
+    assert graph.is_following(3, 2)
+    assert not graph.is_following(2, 1)
+    assert graph.followed_ids(2) == [3]
+    assert graph.follower_ids(2) == [1, 3]
+
+
+@pytest.fixture
+def graph_app(app):
+    from seed import seed
+    app.config['SOCIAL_GRAPH_ENABLED'] = True
+    seed(app, users=5, posts=0, follows_per_user=0)
+    social_graph.load(iter([]), 5, last_seq=0)
+    return app
+
+
+def test_catch_up_applies_changes_from_other_processes(graph_app):
+    from app import db
+    from app.models import FollowChange
+    with graph_app.app_context():
+        db.session.add(FollowChange(follower_id=1, followed_id=2, following=True))
+        db.session.add(FollowChange(follower_id=3, followed_id=2, following=True))
+        db.session.add(FollowChange(follower_id=1, followed_id=2, following=False))
+        db.session.commit()
+        social_graph.catch_up(interval=0, overlay_limit=1000, batch_size=2)
+        assert social_graph.last_seq == 3
+        assert not social_graph.is_following(1, 2)
+        assert social_graph.follower_ids(2) == [3]
+
+
+def test_catch_up_compacts_large_overlay(graph_app):
+    from app import db
+    from app.models import FollowChange
+    with graph_app.app_context():
+        for followed_id in (2, 3, 4):
+            db.session.add(FollowChange(follower_id=1, followed_id=followed_id, following=True))
+        db.session.commit()
+        social_graph.catch_up(interval=0, overlay_limit=2)
+    # 后台线程
+    for thread in threading.enumerate():
+        if thread.name == 'social-graph-compact':
+            thread.join(5)
+    assert social_graph.overlay_size == 0
+    assert social_graph.followed_ids(1) == [2, 3, 4]
+
+
+def test_follow_changes_not_recorded_when_graph_disabled(app):
+    from seed import seed
+    from app import db
+    from app.models import FollowChange, User
+    seed(app, users=2, posts=0, follows_per_user=0)
+    assert not app.config['SOCIAL_GRAPH_ENABLED']
+    with app.app_context():
+        User.query.get(1).follow(User.query.get(2))
+        db.session.commit()
+        assert User.query.get(1).is_following(User.query.get(2))
+        assert FollowChange.query.count() == 0
+
+
+def test_follow_updates_graph_after_commit(graph_app):
+    from time import monotonic
+    from app import db
+    from app.models import FollowSuggestion, User
+    # 不让catch up把本进程的变更补上
+    social_graph._last_catch_up = monotonic() + 3600
+    with graph_app.app_context():
+        db.session.add(FollowSuggestion(user_id=1, suggested_id=2, score=1))
+        db.session.commit()
+        User.query.get(1).follow(User.query.get(2))
+        User.query.get(3).follow(User.query.get(2))
+        db.session.commit()
+        assert social_graph.is_following(1, 2)
+        assert social_graph.follower_ids(2) == [1, 3]
+        assert FollowSuggestion.query.count() == 0
+
+        User.query.get(1).unfollow(User.query.get(2))
+        db.session.commit()
+        assert not social_graph.is_following(1, 2)
+
+        # rollback的不算
+        User.query.get(4).follow(User.query.get(2))
+        db.session.flush()
+        db.session.rollback()
+        User.query.get(5).follow(User.query.get(1))
+        db.session.commit()
+        assert not social_graph.is_following(4, 2)
+        assert social_graph.is_following(5, 1)
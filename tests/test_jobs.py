@@ -0,0 +1,42 @@
+'''后台任务队列(app/my_extensions/jobs.py)'''
+import threading
+
+from app import jobs
+
+
+@jobs.job()
+def record(value):
+    pass
+
+
+def run_in_thread(fn, *args):
+    errors = []
+
+    def target():
+        try:
+            fn(*args)
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    return errors
+
+
+def test_delay_from_several_threads(app, monkeypatch):
+    monkeypatch.setattr(jobs, 'enabled', True)
+    # 主线程先建立连接，其他线程不能用它
+    record.delay(0)
+    assert run_in_thread(record.delay, 1) == []
+    assert run_in_thread(record.delay, 2) == []
+    due, _, counts = jobs.stats()
+    assert due == 3
+    assert counts == {'pending': 3}
+
+
+def test_claim_from_another_thread(app):
+    jobs.enqueue(record.name, (1,))
+    claimed = []
+    assert run_in_thread(lambda: claimed.append(jobs.claim('test'))) == []
+    assert claimed[0][1] == record.name
+    assert jobs.stats()[2] == {'running': 1}
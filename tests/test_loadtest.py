@@ -0,0 +1,92 @@
+'''benchmarks/loadtest.py: 参数解析、统计，以及虚拟用户的会话脚本对着真的服务器跑一遍'''
+import argparse
+import queue
+import random
+import threading
+import time
+
+import pytest
+from werkzeug.serving import make_server
+
+import loadtest
+from app import ratelimiter
+from seed import seed
+
+
+def test_parse_weights():
+    assert loadtest.parse_weights('browse=30,post=5', str) == [('browse', 30.0), ('post', 5.0)]
+    assert loadtest.parse_weights('0.5:70,5:30') == [(0.5, 70.0), (5.0, 30.0)]
+    # 不写权重就是1
+    assert loadtest.parse_weights('browse,search', str) == [('browse', 1.0), ('search', 1.0)]
+    with pytest.raises(ValueError):
+        loadtest.parse_weights('x:1')
+
+
+def test_percentile():
+    values = list(range(100, 0, -1))
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile(values, 100) == 100
+    assert loadtest.percentile([7], 95) == 7
+    assert loadtest.percentile([], 95) == 0.0
+
+
+def test_classify():
+    assert [loadtest.classify(status) for status in (200, 302, 404, 429, 503, 500, 0)] == [
+        'ok', 'ok', 'ok', 'throttled', 'throttled', 'error', 'error']
+
+
+@pytest.fixture
+def server(app, monkeypatch):
+    seed(app, users=5, posts=30)
+    monkeypatch.setattr(ratelimiter, 'limits', {})
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_virtual_user_session(server):
+    records = []
+    # 每个动作都做到
+    mix = [(name, 1) for name, _ in loadtest.parse_weights(loadtest.DEFAULT_MIX, str)]
+    user = loadtest.VirtualUser(server, 5, [(0, 1)], mix, 40, lambda *record: records.append(record),
+                                random.Random(0), time.monotonic() + 60)
+    user.session()
+
+    actions = [action for action, _, _, _ in records]
+    assert actions[0] == 'login' and actions[-1] == 'logout'
+    assert set(actions) == {'login', 'logout'} | {name for name, _ in mix}
+    assert [record for record in records if loadtest.classify(record[1]) != 'ok'] == []
+    # 请求都带着登录的session: 读的页面是200，不是被重定向回登录页
+    reads = {'browse', 'explore', 'popup', 'notifications', 'search'}
+    assert {status for action, status, _, _ in records if action in reads} == {200}
+    assert all(latency >= 0 for _, _, latency, _ in records)
+
+
+def test_virtual_user_stops_at_deadline(server):
+    records = []
+    user = loadtest.VirtualUser(server, 5, [(0, 1)], [('browse', 1)], 1000, lambda *record: records.append(record),
+                                random.Random(0), time.monotonic() + 0.5)
+    start = time.monotonic()
+    user.session()
+    assert time.monotonic() - start < 5
+    assert 'logout' not in [action for action, _, _, _ in records]
+
+
+def test_client_process_reports_batches(server):
+    args = argparse.Namespace(users=2, seed_users=5, session_length=5, interval=0.1)
+    results = queue.Queue()
+    loadtest.client_process(0, args, server, [('notifications', 1), ('popup', 1)], [(0, 1)],
+                            time.monotonic() + 1, results)
+    batches = []
+    while True:
+        batch = results.get(timeout=1)
+        if batch is None:
+            break
+        batches.append(batch)
+    records = [record for batch in batches for record in batch]
+    assert {action for action, _, _, _ in records} >= {'login', 'notifications', 'popup'}
+    assert all(loadtest.classify(status) == 'ok' for _, status, _, _ in records)
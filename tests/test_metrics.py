@@ -0,0 +1,129 @@
+'''/metrics(app/my_extensions/metrics.py)的访问控制、导出格式和多进程的mmap存储'''
+import multiprocessing
+
+import pytest
+
+from app.my_extensions.metrics import Metrics, _MmapStore
+
+
+@pytest.fixture
+def metrics(app):
+    return app.extensions['metrics']
+
+
+def test_metrics_allowed_from_localhost(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert b'# TYPE http_request_duration_seconds histogram' in response.data
+
+
+def test_metrics_hidden_from_other_ips(client):
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    assert response.status_code == 404
+
+
+def test_metrics_hidden_behind_reverse_proxy(client):
+    # nginx转发过来的请求remote_addr也是127.0.0.1
+    response = client.get('/metrics', headers={'X-Forwarded-For': '10.0.0.1'})
+    assert response.status_code == 404
+
+
+def test_metrics_token(client, metrics, monkeypatch):
+    monkeypatch.setattr(metrics, 'token', 'secret')
+    # 配置了token之后，本机来的请求也要带token
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    assert client.get('/metrics?token=secre').status_code == 404
+
+    remote = {'REMOTE_ADDR': '10.0.0.1'}
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'},
+                      environ_base=remote).status_code == 200
+    assert client.get('/metrics', headers={'X-Metrics-Token': 'secret'}, environ_base=remote).status_code == 200
+    assert client.get('/metrics?token=secret', environ_base=remote).status_code == 200
+
+
+def _sample(client, line_prefix):
+    for line in client.get('/metrics').get_data(as_text=True).splitlines():
+        if line.startswith(line_prefix + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0.0
+
+
+def test_request_latency_recorded(client):
+    # metrics是模块级的实例，其他测试的请求也记在里面，所以比较前后的差
+    sample = 'http_request_duration_seconds_count{endpoint="main.login",method="GET",status="200"}'
+    before = _sample(client, sample)
+    client.get('/login/')
+    client.get('/login/')
+    assert _sample(client, sample) == before + 2
+
+
+def test_exposition_format():
+    metrics = Metrics()
+    requests = metrics.counter('jobs_total', '任务数', ['queue'])
+    depth = metrics.gauge('queue_depth', '队列长度')
+    latency = metrics.histogram('job_seconds', '耗时', buckets=(0.1, 1))
+    requests.labels(queue='mail').inc()
+    requests.labels(queue='mail').inc(2)
+    depth.inc(5)
+    depth.dec(2)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(3)
+
+    lines = metrics.generate_latest().splitlines()
+    assert '# TYPE jobs_total counter' in lines
+    assert 'jobs_total{queue="mail"} 3.0' in lines
+    assert 'queue_depth 3.0' in lines
+    # bucket是累加的
+    assert lines[lines.index('# TYPE job_seconds histogram') + 1:] == [
+        'job_seconds_bucket{le="0.1"} 1.0',
+        'job_seconds_bucket{le="1.0"} 2.0',
+        'job_seconds_bucket{le="+Inf"} 3.0',
+        'job_seconds_sum 3.55',
+        'job_seconds_count 3.0',
+    ]
+
+
+def _worker(directory):
+    store = _MmapStore(directory)
+    store.inc('["counter", "requests_total", "", []]', 2)
+    store.set('["gauge", "queue_depth", "", []]', 7)
+
+
+def test_mmap_store_sums_processes(tmp_path):
+    store = _MmapStore(str(tmp_path))
+    store.inc('["counter", "requests_total", "", []]', 1)
+    store.set('["gauge", "queue_depth", "", []]', 3)
+
+    process = multiprocessing.get_context('fork').Process(target=_worker, args=(str(tmp_path),))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    # 退出了的进程: counter保留，gauge不算
+    totals = dict(store.collect())
+    assert totals['["counter", "requests_total", "", []]'] == 3
+    assert totals['["gauge", "queue_depth", "", []]'] == 3
+
+
+def test_mmap_store_reopens_existing_file(tmp_path):
+    key = '["counter", "requests_total", "", []]'
+    store = _MmapStore(str(tmp_path))
+    for _ in range(5):
+        store.inc(key, 1)
+    # 同一个pid重新打开(例如重新初始化了extension)，接着原来的值加
+    store = _MmapStore(str(tmp_path))
+    store.inc(key, 1)
+    assert dict(store.collect())[key] == 6
+
+
+def test_mmap_file_grows(tmp_path):
+    store = _MmapStore(str(tmp_path))
+    keys = ['["counter", "c{}", "", []]'.format(i) for i in range(3000)]
+    for key in keys:
+        store.inc(key, 1)
+    totals = dict(store.collect())
+    assert len(totals) == len(keys)
+    assert all(totals[key] == 1 for key in keys)
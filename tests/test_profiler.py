@@ -0,0 +1,77 @@
+'''采样profiler(app/my_extensions/profiler.py): 选哪些请求、折叠栈和/_profile的token'''
+import time
+
+import pytest
+
+from app import profiler
+
+
+def busy_loop():
+    deadline = time.perf_counter() + 0.2
+    while time.perf_counter() < deadline:
+        pass
+    return 'done'
+
+
+@pytest.fixture
+def profiled_app(app):
+    app.config.update(PROFILER_ENABLED=True, PROFILER_TOKEN='secret', PROFILER_ENDPOINTS=['slow.*'],
+                      PROFILER_SAMPLE_RATE=0)
+    profiler.init_app(app)
+    app.add_url_rule('/slow', 'slow.busy', busy_loop)
+    app.add_url_rule('/other', 'other', busy_loop)
+    profiler.reset()
+    yield app
+    profiler.reset()
+
+
+def export(client, token='secret', **params):
+    return client.get('/_profile', query_string=params, headers={'X-Profiler-Token': token})
+
+
+def test_profile_requires_token(profiled_app):
+    client = profiled_app.test_client()
+    assert client.get('/_profile').status_code == 404
+    assert export(client, token='wrong').status_code == 404
+    assert client.get('/_profile?token=secret').status_code == 200
+    assert export(client).status_code == 200
+
+
+def test_no_route_without_token(app):
+    app.config.update(PROFILER_ENABLED=True, PROFILER_TOKEN=None)
+    profiler.init_app(app)
+    assert app.test_client().get('/_profile').status_code == 404
+
+
+def test_collapsed_stacks_of_selected_endpoint(profiled_app):
+    client = profiled_app.test_client()
+    assert client.get('/slow').data == b'done'
+
+    summary = export(client).get_data(as_text=True)
+    assert summary.startswith('# pid ')
+    assert 'slow.busy ' in summary
+
+    lines = export(client, endpoint='slow.busy').get_data(as_text=True).splitlines()
+    assert lines
+    stacks = dict(line.rsplit(' ', 1) for line in lines)
+    assert all(int(count) > 0 for count in stacks.values())
+    # 从Flask的wsgi_app开始，最里层是请求里正在跑的函数
+    assert all(stack.startswith('flask/app.py:wsgi_app;') for stack in stacks)
+    assert any(stack.endswith('tests/test_profiler.py:busy_loop') for stack in stacks)
+
+    assert export(client, reset=1).data == b'reset\n'
+    assert export(client, endpoint='slow.busy').data == b''
+
+
+def test_other_endpoints_not_profiled(profiled_app):
+    client = profiled_app.test_client()
+    client.get('/other')
+    assert profiler.samples == 0
+    assert export(client, endpoint='other').data == b''
+
+
+def test_max_stacks(profiled_app):
+    profiler.max_stacks = 2
+    for stack in ('a', 'b', 'c', 'd', 'a'):
+        profiler._record('slow.busy', stack)
+    assert profiler.collapsed('slow.busy') == '[truncated] 2\na 2\nb 1\n'
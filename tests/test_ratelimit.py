@@ -0,0 +1,125 @@
+'''限流和过载保护(app/my_extensions/ratelimit.py): 429和Retry-After、按用户的令牌桶、503、多进程共用的mmap桶'''
+import multiprocessing
+
+import pytest
+from sqlalchemy import event
+
+from app import db, ratelimiter
+from app.my_extensions.ratelimit import _MemoryBuckets, _MmapBuckets
+from seed import login, seed
+
+
+@pytest.fixture
+def limited_app(app, monkeypatch):
+    seed(app, users=2, posts=0)
+    # 每1000秒补一个令牌，最多攒2个: 第三个请求一定被拒绝
+    monkeypatch.setattr(ratelimiter, 'limits', {'main.notifications': (0.001, 2)})
+    return app
+
+
+def test_rejects_with_retry_after(limited_app):
+    client = login(limited_app.test_client())
+    assert client.get('/notifications').status_code == 200
+    assert client.get('/notifications').status_code == 200
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with limited_app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get('/notifications')
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 429
+    # 还差一个令牌，每秒补0.001个
+    assert 990 <= int(response.headers['Retry-After']) <= 1000
+    # 在加载current_user之前就拒绝了
+    assert statements == []
+
+    # 别的endpoint不受影响
+    assert client.get('/index/').status_code == 200
+
+
+def test_buckets_are_per_user(limited_app):
+    first = login(limited_app.test_client(), 'user1')
+    second = login(limited_app.test_client(), 'user2')
+    for _ in range(2):
+        assert first.get('/notifications').status_code == 200
+    assert first.get('/notifications').status_code == 429
+    assert second.get('/notifications').status_code == 200
+
+
+def test_anonymous_requests_limited_by_ip(limited_app, monkeypatch):
+    monkeypatch.setattr(ratelimiter, 'limits', {'main.login': (0.001, 1)})
+    client = limited_app.test_client()
+    assert client.get('/login/').status_code == 200
+    assert client.get('/login/').status_code == 429
+    other = {'REMOTE_ADDR': '10.0.0.2'}
+    assert client.get('/login/', environ_base=other).status_code == 200
+
+
+def test_max_in_flight(app, monkeypatch):
+    monkeypatch.setattr(ratelimiter, 'max_in_flight', 2)
+    client = app.test_client()
+    assert client.get('/login/').status_code == 200
+    # 请求结束之后计数减回去
+    assert ratelimiter._in_flight == 0
+
+    # 相当于已经有两个请求在处理
+    monkeypatch.setattr(ratelimiter, '_in_flight', 2)
+    response = client.get('/login/')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert ratelimiter._in_flight == 2
+
+
+def test_token_bucket_refills():
+    buckets = _MemoryBuckets()
+    assert buckets.take('k', 1, 2, now=100)[0]
+    assert buckets.take('k', 1, 2, now=100)[0]
+    assert not buckets.take('k', 1, 2, now=100)[0]
+    assert not buckets.take('k', 1, 2, now=100.5)[0]
+    assert buckets.take('k', 1, 2, now=101)[0]
+    # 最多攒burst个
+    assert buckets.take('k', 1, 2, now=1000)[0]
+    assert buckets.take('k', 1, 2, now=1000)[0]
+    assert not buckets.take('k', 1, 2, now=1000)[0]
+
+
+def _take(path, results):
+    buckets = _MmapBuckets(path, slots=64, stripes=4)
+    results.put([buckets.take('shared', 0.001, 10, now=100)[0] for _ in range(4)])
+
+
+def test_mmap_buckets_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'ratelimit.mmap')
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=_take, args=(path, results)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    allowed = sum(sum(results.get(timeout=10)) for _ in processes)
+    for process in processes:
+        process.join()
+    # 三个进程一共只拿到10个令牌
+    assert allowed == 10
+
+    buckets = _MmapBuckets(path, slots=64, stripes=4)
+    assert not buckets.take('shared', 0.001, 10, now=100)[0]
+    assert buckets.take('other', 0.001, 10, now=100)[0]
+
+
+def test_mmap_buckets_evict_oldest_when_full(tmp_path):
+    # 只有一段8个槽，第9个key要覆盖最久没更新的
+    buckets = _MmapBuckets(str(tmp_path / 'ratelimit.mmap'), slots=8, stripes=1)
+    for i in range(8):
+        assert buckets.take('key{}'.format(i), 0.001, 1, now=100 + i)[0]
+        assert not buckets.take('key{}'.format(i), 0.001, 1, now=100 + i)[0]
+    assert buckets.take('key8', 0.001, 1, now=200)[0]
+    # key0被挤掉了，重新从满的桶开始
+    assert buckets.take('key0', 0.001, 1, now=200)[0]
+    assert not buckets.take('key7', 0.001, 1, now=200)[0]
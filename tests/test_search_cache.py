@@ -0,0 +1,35 @@
+'''搜索结果缓存(app/search_cache.py)的TTL和generation'''
+import time
+
+from app.search_cache import QueryCache
+
+
+def test_generation_match_does_not_extend_ttl():
+    cache = QueryCache(ttl=0.1)
+    key = cache.key('post', 'Flask', 1, 5)
+    cache.set(key, [1, 2], 2, cache.generation('post'))
+    assert cache.get(key) == ([1, 2], 2)
+    time.sleep(0.15)
+    # generation没变也过期了(别的worker的写入不会bump本进程的generation)
+    assert cache.get(key) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_bump_generation_invalidates_before_ttl():
+    cache = QueryCache(ttl=60)
+    key = cache.key('post', 'flask', 1, 5)
+    cache.set(key, [1], 1, cache.generation('post'))
+    cache.bump_generation('post')
+    assert cache.get(key) is None
+    # Elasticsearch不可用时还可以拿旧结果
+    assert cache.get_stale(key) == ([1], 1)
+
+
+def test_stale_generations_allowed_within_ttl():
+    cache = QueryCache(ttl=0.1, max_stale_generations=1)
+    key = cache.key('post', 'flask', 1, 5)
+    cache.set(key, [1], 1, cache.generation('post'))
+    cache.bump_generation('post')
+    assert cache.get(key) == ([1], 1)
+    cache.bump_generation('post')
+    assert cache.get(key) is None
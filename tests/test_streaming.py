@@ -0,0 +1,17 @@
+'''流式渲染(app/streaming.py)'''
+
+
+def test_streamed_page_pops_flashed_messages(app, client):
+    from seed import login, seed
+    seed(app, users=2, posts=3)
+    app.config['STREAM_TEMPLATES'] = True
+    login(client)
+
+    response = client.post('/index/', data={'title': 'streamed', 'body': 'flash once'})
+    assert response.status_code == 302
+    response = client.get('/index/')
+    assert response.is_streamed
+    assert b'You added a new post!' in response.data
+    # 第二次不能再显示
+    assert b'You added a new post!' not in client.get('/index/').data
+    assert b'You added a new post!' not in client.get('/explore').data
@@ -0,0 +1,41 @@
+'''/suggest只查内存里的前缀索引，不碰数据库'''
+import threading
+import time
+
+from sqlalchemy import event
+
+from app import db
+from app.suggest import suggest_index
+
+
+def test_suggest_does_not_touch_database(app, client):
+    from seed import login, seed
+    seed(app, users=3, posts=10)
+    login(client)
+    # 第一个请求触发后台加载前缀索引
+    client.get('/suggest?q=post')
+    deadline = time.monotonic() + 10
+    while not suggest_index.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    statements = []
+    request_thread = threading.get_ident()
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if threading.get_ident() == request_thread:
+            statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get('/suggest?q=post')
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200
+    assert response.get_json()
+    assert statements == []
+
+
+def test_suggest_requires_login(client):
+    assert client.get('/suggest?q=post').status_code == 302
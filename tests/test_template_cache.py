@@ -0,0 +1,63 @@
+'''模板的字节码缓存和预热(app/my_extensions/template_cache.py)'''
+import os
+
+import pytest
+
+from app import create_app, template_cache
+
+
+def cached_app(directory):
+    app = create_app('testing')
+    app.config['TEMPLATE_CACHE_DIR'] = str(directory)
+    template_cache.init_app(app)
+    return app
+
+
+def no_parse(*args, **kwargs):
+    raise AssertionError('template parsed instead of loaded from the bytecode cache')
+
+
+def test_no_bytecode_cache_by_default(app):
+    assert app.jinja_env.bytecode_cache is None
+    with pytest.raises(RuntimeError):
+        template_cache.compile(app)
+
+
+def test_compile_writes_every_template(tmp_path):
+    app = cached_app(tmp_path / 'cache')
+    count, _ = template_cache.compile(app)
+    names = app.jinja_env.list_templates()
+    assert count == len(names)
+    # bootstrap/的模板也算
+    assert 'base.html' in names and any(name.startswith('bootstrap/') for name in names)
+    assert len(os.listdir(str(tmp_path / 'cache'))) == count
+
+
+def test_new_process_loads_from_bytecode_cache(tmp_path, monkeypatch):
+    template_cache.compile(cached_app(tmp_path / 'cache'))
+
+    # 相当于新启动的worker: 内存里没有模板，只有磁盘上的字节码
+    app = cached_app(tmp_path / 'cache')
+    monkeypatch.setattr(app.jinja_env, '_parse', no_parse)
+    count, _ = template_cache.warm_up(app)
+    assert count == len(app.jinja_env.list_templates())
+    response = app.test_client().get('/login/')
+    assert response.status_code == 200
+
+
+def test_compile_clear(tmp_path):
+    app = cached_app(tmp_path / 'cache')
+    template_cache.compile(app)
+    stale = tmp_path / 'cache' / '__jinja2_stale.cache'
+    stale.write_bytes(b'')
+    template_cache.compile(app, clear=True)
+    assert not stale.exists()
+    assert os.listdir(str(tmp_path / 'cache'))
+
+
+def test_warm_up_fills_memory_cache(app, monkeypatch):
+    count, _ = template_cache.warm_up(app)
+    assert count == len(app.jinja_env.cache)
+    # 请求里不用再编译
+    monkeypatch.setattr(app.jinja_env, '_parse', no_parse)
+    assert app.test_client().get('/login/').status_code == 200
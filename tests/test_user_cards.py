@@ -0,0 +1,82 @@
+'''/user_cards一次取回多个用户的名片，查询次数不随用户数增加'''
+from sqlalchemy import event, text
+
+from app import db
+from seed import login, seed
+
+
+def cards(client, *usernames):
+    response = client.get('/user_cards', query_string=[('u', name) for name in usernames])
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def count(app, sql, **params):
+    with app.app_context():
+        return db.engine.execute(text(sql), **params).scalar()
+
+
+def test_user_cards(app, client):
+    seed(app, users=6, posts=0, follows_per_user=3)
+    login(client)
+    with app.app_context():
+        db.engine.execute(text('DELETE FROM followers WHERE follower_id = 1'))
+        db.engine.execute(text('INSERT INTO followers (follower_id, followed_id) VALUES (1, 2)'))
+
+    # 重复的和不存在的用户名都忽略
+    data = cards(client, 'user2', 'user3', 'nobody', 'user2', 'user1')
+    assert sorted(data) == ['user1', 'user2', 'user3']
+    for name in data:
+        id = int(name[4:])
+        card = data[name]
+        assert card['id'] == id
+        assert card['url'] == '/user/{}/'.format(name)
+        assert card['followers'] == count(app, 'SELECT COUNT(*) FROM followers WHERE followed_id = :id', id=id)
+        assert card['following'] == count(app, 'SELECT COUNT(*) FROM followers WHERE follower_id = :id', id=id)
+    assert data['user2']['is_following'] and data['user2']['follow_url'] == '/unfollow/user2'
+    assert not data['user3']['is_following'] and data['user3']['follow_url'] == '/follow/user3'
+    assert data['user1']['is_self'] and not data['user2']['is_self']
+    assert data['user1']['about_me'] == 'I am user 1'
+
+
+def test_user_cards_empty(app, client):
+    seed(app, users=1, posts=0)
+    login(client)
+    assert cards(client) == {}
+
+
+def test_user_cards_max(app, client):
+    seed(app, users=5, posts=0)
+    login(client)
+    app.config['USER_CARDS_MAX'] = 2
+    assert sorted(cards(client, 'user5', 'user4', 'user3')) == ['user4', 'user5']
+
+
+def test_query_count_does_not_grow(app, client):
+    seed(app, users=20, posts=0, follows_per_user=5)
+    login(client)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        cards(client, 'user2', 'user3')
+        two = len(statements)
+        del statements[:]
+        data = cards(client, *['user{}'.format(i) for i in range(2, 21)])
+        many = len(statements)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    assert len(data) == 19
+    assert many == two
+
+
+def test_user_cards_requires_login(app, client):
+    seed(app, users=1, posts=0)
+    response = client.get('/user_cards?u=user1')
+    assert response.status_code == 302
+    assert '/login' in response.headers['Location']